@@ -0,0 +1,692 @@
+import os
+import hmac
+import json
+import time
+import select
+import socket
+import struct
+import ipaddress
+from typing import List, Dict, Tuple, Iterator, Optional, TYPE_CHECKING
+
+from remote_que.logger import logger
+from remote_que.config import DEFAULT_AGENT_GPU_POLL, DEFAULT_TELEMETRY_BACKEND
+from remote_que.config import DEFAULT_AGENT_CONNECT_TIMEOUT, AGENT_TOKEN_ENV
+from remote_que.events import Wakeup, ChildWatcher
+from remote_que.run_process import SingleMachineSlot, START_PENDING, START_CRASHED
+from remote_que.telemetry import TelemetryBackend, get_telemetry_backend, TELEMETRY_BACKENDS
+from remote_que.storage import json_default
+
+if TYPE_CHECKING:
+    import pandas as pd
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+# Node agent protocol. Frames: 4 byte payload length, 1 byte codec, payload (msgpack if
+# installed on the sending side, else json). A frame holds one message (dict with "type").
+#
+# manager -> agent:
+#     auth        {"token"} (first message - other messages of unauthenticated connections are
+#                 not handled, the connection is closed; agent state is sent after auth)
+#     launch      {"jobs": [{"command_id", "command", "gpus", "log_start_confirm", "cpus",
+#                            "limits"}]} (cpus - cores to pin to, limits - cgroup limits or None)
+#     kill        {"command_ids": [...]} (SIGTERM to the proc tree, SIGKILL after a grace period)
+#     signal      {"command_ids": [...], "signal": int} (e.g. SIGSTOP / SIGCONT to the proc tree)
+#     shutdown    {}
+# agent -> manager (batched - one "events" message per agent loop):
+#     events      {"events": [...]}, each event one of:
+#         hello       {"machine", "jobs": [{"command_id", "start_state", "return_code"}]}
+#         started     {"command_id", "ok"}
+#         confirmed   {"command_id", "start_state"}
+#         exited      {"command_id", "return_code"}
+#         gpu         {"infos": [changed gpu infos], "procs": [...] or None if unchanged}
+
+FRAME_HEADER = struct.Struct(">IB")
+CODEC_JSON = 0
+CODEC_MSGPACK = 1
+
+
+def encode_frame(message: dict) -> bytes:
+    if msgpack is not None:
+        payload = msgpack.packb(message, default=json_default, use_bin_type=True)
+        return FRAME_HEADER.pack(len(payload), CODEC_MSGPACK) + payload
+
+    payload = json.dumps(message, default=json_default, separators=(",", ":")).encode()
+    return FRAME_HEADER.pack(len(payload), CODEC_JSON) + payload
+
+
+class FrameReader:
+    """ Incremental frame decoder (socket reads may hold partial / several frames) """
+    def __init__(self):
+        self._buffer = bytearray()
+
+    def feed(self, data: bytes) -> List[dict]:
+        self._buffer += data
+        messages = []
+
+        while len(self._buffer) >= FRAME_HEADER.size:
+            length, codec = FRAME_HEADER.unpack_from(self._buffer)
+            end = FRAME_HEADER.size + length
+            if len(self._buffer) < end:
+                break
+
+            payload = bytes(self._buffer[FRAME_HEADER.size:end])
+            del self._buffer[:end]
+
+            if codec == CODEC_MSGPACK:
+                assert msgpack is not None, "Received msgpack frame - pip install msgpack"
+                messages.append(msgpack.unpackb(payload, raw=False))
+            else:
+                messages.append(json.loads(payload))
+
+        return messages
+
+
+def parse_address(address: str) -> Tuple[int, object]:
+    """ <host:port> -> TCP (<:port> - loopback), anything else is a Unix socket path """
+    host, sep, port = address.rpartition(":")
+    if sep and port.isdigit() and "/" not in address:
+        return socket.AF_INET, (host or "127.0.0.1", int(port))
+    return socket.AF_UNIX, address
+
+
+def is_loopback(host: str) -> bool:
+    if host == "localhost":
+        return True
+    try:
+        return ipaddress.ip_address(host).is_loopback
+    except ValueError:
+        return False  # host name
+
+
+def read_token(token_file: str = None) -> Optional[str]:
+    """ Agent token from token_file, else from the AGENT_TOKEN_ENV environment variable """
+    if token_file is not None:
+        with open(token_file) as f:
+            return f.read().strip() or None
+    return os.environ.get(AGENT_TOKEN_ENV) or None
+
+
+class AgentConnection:
+    def __init__(self, sock: socket.socket):
+        self.sock = sock
+        self.closed = False
+        self._reader = FrameReader()
+
+    def fileno(self) -> int:
+        return self.sock.fileno()
+
+    def send(self, message: dict) -> bool:
+        if self.closed:
+            return False
+        try:
+            self.sock.sendall(encode_frame(message))
+        except OSError:
+            self.close()
+        return not self.closed
+
+    def receive(self) -> List[dict]:
+        """ Call when socket is readable """
+        try:
+            data = self.sock.recv(65536)
+        except (BlockingIOError, InterruptedError):
+            return []
+        except OSError:
+            data = b""
+
+        if not data:
+            self.close()
+            return []
+        return self._reader.feed(data)
+
+    def close(self) -> None:
+        if not self.closed:
+            self.closed = True
+            self.sock.close()
+
+
+class NodeAgent:
+    """ Owns the que procs of one node and pushes their state changes (and GPU telemetry
+        changes) to connected que managers. The manager does not probe procs / GPUs itself.
+
+        Connections must authenticate with token (auth message) before any other message is
+        handled. Without a token the agent only listens on a Unix socket (owner only) or a
+        loopback address (e.g. reached through an ssh tunnel).
+    """
+    def __init__(self, address: str, stdout_folder: str, machine: str = None,
+                 telemetry_backend: str = DEFAULT_TELEMETRY_BACKEND,
+                 gpu_poll: float = DEFAULT_AGENT_GPU_POLL, token: str = None,
+                 **backend_kwargs):
+        family, addr = parse_address(address)
+        if family != socket.AF_UNIX and not is_loopback(addr[0]) and token is None:
+            raise ValueError(f"Agent address {address} is not a loopback address - set a token "
+                             f"(--token-file or {AGENT_TOKEN_ENV}) or reach the agent through "
+                             f"an ssh tunnel")
+
+        self.address = address
+        self.token = token
+        self.stdout_folder = stdout_folder
+        self.machine = socket.gethostname() if machine is None else machine
+        self.gpu_poll = gpu_poll
+        self.telemetry = get_telemetry_backend(telemetry_backend, **backend_kwargs)
+
+        self._slots = dict()  # type: Dict[int, SingleMachineSlot]
+        self._starting = set()
+        self._exited = dict()  # command_id -> return code (reported on reconnect)
+        self._connections = dict()  # type: Dict[int, AgentConnection]
+        self._authenticated = set()  # fds of connections that sent a valid auth message
+        self._events = []
+        self._gpu_infos = dict()  # index -> last sent info
+        self._gpu_procs = None
+        self._next_gpu_poll = 0.
+        self._running = False
+
+        if family == socket.AF_UNIX and os.path.exists(addr):
+            os.unlink(addr)
+        self._server = socket.socket(family, socket.SOCK_STREAM)
+        self._server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._server.bind(addr)
+        if family == socket.AF_UNIX:
+            os.chmod(addr, 0o600)
+        self._server.listen()
+
+        self._wakeup = Wakeup()
+        self._child_watcher = ChildWatcher(self._wakeup)
+        self._wakeup.register_fd(self._server.fileno(), self._accept)
+
+    # -- Connections
+    def _accept(self) -> bool:
+        sock, _ = self._server.accept()
+        connection = AgentConnection(sock)
+        fd = connection.fileno()
+        self._connections[fd] = connection
+        self._wakeup.register_fd(fd, lambda: self._on_message(fd))
+        return True
+
+    def _authenticate(self, fd: int, message: dict) -> None:
+        """ Check the auth message & send the full state to the new manager (it may be
+            reattaching after a restart) """
+        connection = self._connections[fd]
+        token = message.get("token") if message["type"] == "auth" else None
+        if self.token is not None and \
+                not hmac.compare_digest(str(token or "").encode(), self.token.encode()):
+            logger.warning(f"[NodeAgent] Connection rejected - invalid token "
+                           f"({message['type']} message)")
+            connection.close()
+            return
+        if message["type"] != "auth":
+            logger.warning(f"[NodeAgent] Connection rejected - {message['type']} before auth")
+            connection.close()
+            return
+        self._authenticated.add(fd)
+
+        jobs = [{"command_id": command_id, "start_state": slot.start_state, "return_code": None}
+                for command_id, slot in self._slots.items()]
+        jobs += [{"command_id": command_id, "start_state": None, "return_code": return_code}
+                 for command_id, return_code in self._exited.items()]
+        connection.send({"type": "events", "events": [
+            {"type": "hello", "machine": self.machine, "jobs": jobs},
+            {"type": "gpu", "infos": list(self._gpu_infos.values()), "procs": self._gpu_procs},
+        ]})
+
+    def _on_message(self, fd: int) -> bool:
+        connection = self._connections[fd]
+        for message in connection.receive():
+            if connection.closed:
+                break
+            if fd not in self._authenticated:
+                self._authenticate(fd, message)
+                continue
+
+            handler = getattr(self, f"_handle_{message['type']}", None)
+            if handler is None:
+                logger.warning(f"[NodeAgent] Unknown message {message['type']}")
+            else:
+                handler(message)
+
+        self._drop_closed()
+        return True
+
+    def _drop_closed(self) -> None:
+        for fd, connection in list(self._connections.items()):
+            if connection.closed:
+                self._wakeup.unregister_fd(fd)
+                del self._connections[fd]
+                self._authenticated.discard(fd)
+
+    def _handle_launch(self, message: dict) -> None:
+        for job in message["jobs"]:
+            command_id = job["command_id"]
+            slot = SingleMachineSlot(job["gpus"], self.stdout_folder, wait_time_start=0,
+                                     log_start_confirm=job.get("log_start_confirm"),
+                                     machine=self.machine,
+                                     cpus=job.get("cpus"), limits=job.get("limits"))
+            ok = slot.start_command(command_id, job["command"], None)
+            self._slots[command_id] = slot
+            self._starting.add(command_id)
+            self._events.append({"type": "started", "command_id": command_id, "ok": ok})
+
+        # GPU usage changed
+        self._next_gpu_poll = 0.
+
+    def _handle_kill(self, message: dict) -> None:
+        for command_id in message["command_ids"]:
+            slot = self._slots.get(command_id)
+            if slot is not None:
+                slot.stop()
+
+    def _handle_signal(self, message: dict) -> None:
+        for command_id in message["command_ids"]:
+            slot = self._slots.get(command_id)
+            if slot is not None:
+                slot.signal(message["signal"])
+
+    def _handle_shutdown(self, message: dict) -> None:
+        self._running = False
+
+    def _handle_ack(self, message: dict) -> None:
+        # Manager recorded exits -> no need to report them again on reconnect
+        for command_id in message["command_ids"]:
+            self._exited.pop(command_id, None)
+
+    # -- State
+    def _check_procs(self) -> None:
+        for command_id in list(self._starting):
+            start_state = self._slots[command_id].check_start()
+            if start_state != START_PENDING:
+                self._starting.discard(command_id)
+                self._events.append({"type": "confirmed", "command_id": command_id,
+                                     "start_state": start_state})
+
+        for command_id, slot in list(self._slots.items()):
+            slot.rotate_output()
+            if command_id not in self._starting and not slot.is_running:
+                return_code = slot.kill()
+                del self._slots[command_id]
+                self._exited[command_id] = return_code
+                self._events.append({"type": "exited", "command_id": command_id,
+                                     "return_code": return_code})
+                self._next_gpu_poll = 0.
+
+    def _check_gpus(self) -> None:
+        if time.monotonic() < self._next_gpu_poll:
+            return
+        self._next_gpu_poll = time.monotonic() + self.gpu_poll
+
+        try:
+            infos, procs = self.telemetry.sample(self.machine)
+        except Exception as e:
+            logger.warning(f"[NodeAgent] GPU telemetry failed ({e})")
+            return
+
+        # Send only changed GPUs (& procs list if it changed)
+        changed = [info for info in infos if self._gpu_infos.get(info["index"]) != info]
+        procs = sorted(procs, key=lambda p: (p["index"], str(p["pid"])))
+        procs_changed = procs != self._gpu_procs
+
+        if len(changed) > 0 or procs_changed:
+            self._gpu_infos.update({info["index"]: info for info in changed})
+            self._gpu_procs = procs
+            self._events.append({"type": "gpu", "infos": changed,
+                                 "procs": procs if procs_changed else None})
+
+    def _timeout(self) -> float:
+        timeout = max(0., self._next_gpu_poll - time.monotonic())
+        for command_id in self._starting:
+            timeout = min(timeout, self._slots[command_id].next_start_check())
+        return timeout
+
+    def serve_forever(self) -> None:
+        logger.info(f"[NodeAgent] {self.machine} listening on {self.address}")
+        self._running = True
+        while self._running:
+            self._check_procs()
+            self._check_gpus()
+
+            if len(self._events) > 0:
+                message = {"type": "events", "events": self._events}
+                for fd, connection in list(self._connections.items()):
+                    if fd in self._authenticated:
+                        connection.send(message)
+                self._events = []
+                self._drop_closed()
+
+            self._wakeup.wait(self._timeout())
+            self._child_watcher.pending()
+
+        self.close()
+
+    def close(self) -> None:
+        for slot in self._slots.values():
+            slot.kill()
+        self._slots.clear()
+
+        for connection in self._connections.values():
+            connection.close()
+        self._connections.clear()
+
+        self._server.close()
+        family, addr = parse_address(self.address)
+        if family == socket.AF_UNIX and os.path.exists(addr):
+            os.unlink(addr)
+
+        self._child_watcher.close()
+        self._wakeup.close()
+
+
+class AgentClient:
+    """ Que manager side of a node agent connection. State is only updated from pushed events
+        (on wakeup - see register) so reading it costs nothing per pass.
+    """
+    def __init__(self, machine: str, address: str,
+                 connect_timeout: float = DEFAULT_AGENT_CONNECT_TIMEOUT, token: str = None):
+        self.machine = machine
+        self.address = address
+
+        family, addr = parse_address(address)
+        sock = socket.socket(family, socket.SOCK_STREAM)
+        sock.settimeout(connect_timeout)
+        sock.connect(addr)
+        sock.settimeout(None)
+        self._connection = AgentConnection(sock)
+        self._connection.send({"type": "auth", "token": token})
+
+        self.jobs = dict()  # command_id -> {"started", "start_state", "return_code", "exited"}
+        self.gpu_infos = dict()  # index -> info
+        self.gpu_procs = []
+        self._launch_batch = []
+        self._changed = False
+        self.hello = False  # full agent state received (first message)
+        self._wakeup = None  # type: Wakeup
+        self._fd = None
+
+    def fileno(self) -> int:
+        return self._connection.fileno()
+
+    @property
+    def connected(self) -> bool:
+        return not self._connection.closed
+
+    def register(self, wakeup: Wakeup) -> None:
+        self._wakeup, self._fd = wakeup, self.fileno()
+        wakeup.register_fd(self._fd, self.poll)
+
+    def poll(self) -> bool:
+        """ Apply received events. Returns True if any proc changed state """
+        changed = False
+        exited = []
+        for message in self._connection.receive():
+            for event in message.get("events", []):
+                changed = self._apply(event, exited) or changed
+
+        if len(exited) > 0:
+            self._connection.send({"type": "ack", "command_ids": exited})
+
+        # Agent lost -> its procs are no longer running
+        if self._connection.closed:
+            logger.warning(f"[AgentClient] Lost connection to agent {self.machine}")
+            if self._wakeup is not None:
+                self._wakeup.unregister_fd(self._fd)
+                self._wakeup = None
+            changed = True
+
+        self._changed = self._changed or changed
+        return changed
+
+    def _apply(self, event: dict, exited: list) -> bool:
+        event_type = event["type"]
+
+        if event_type == "gpu":
+            self.gpu_infos.update({info["index"]: info for info in event["infos"]})
+            if event["procs"] is not None:
+                self.gpu_procs = [dict(p, machine=self.machine) for p in event["procs"]]
+            return False
+
+        if event_type == "hello":
+            self.hello = True
+            for job in event["jobs"]:
+                state = self._job(job["command_id"])
+                if job["return_code"] is not None:
+                    state.update({"exited": True, "return_code": job["return_code"]})
+                    exited.append(job["command_id"])
+                else:
+                    state["start_state"] = job["start_state"]
+            return True
+
+        state = self._job(event["command_id"])
+        if event_type == "started":
+            state["started"] = event["ok"]
+        elif event_type == "confirmed":
+            state["start_state"] = event["start_state"]
+        elif event_type == "exited":
+            state.update({"exited": True, "return_code": event["return_code"]})
+            exited.append(event["command_id"])
+        return True
+
+    def _job(self, command_id: int) -> dict:
+        state = self.jobs.get(command_id)
+        if state is None:
+            state = self.jobs[command_id] = dict({"started": True, "start_state": START_PENDING,
+                                                  "return_code": None, "exited": False})
+        return state
+
+    def wait_hello(self, timeout: float) -> bool:
+        """ Block until the full agent state is received (procs to reattach after a restart) """
+        end_time = time.monotonic() + timeout
+        while not self.hello and self.connected:
+            remaining = end_time - time.monotonic()
+            if remaining <= 0 or len(select.select([self], [], [], remaining)[0]) == 0:
+                break
+            self.poll()
+        return self.hello
+
+    def changed(self) -> bool:
+        """ True if any proc changed state since last call """
+        changed, self._changed = self._changed, False
+        return changed
+
+    def launch(self, command_id: int, command: str, gpus: List[str],
+               log_start_confirm: str = None, cpus: List[int] = None,
+               limits: dict = None) -> None:
+        """ Queued until flush() - all procs started in a pass are sent in one message """
+        self._job(command_id)
+        self._launch_batch.append({"command_id": command_id, "command": command,
+                                   "gpus": list(gpus), "log_start_confirm": log_start_confirm,
+                                   "cpus": cpus, "limits": limits})
+
+    def flush(self) -> None:
+        if len(self._launch_batch) > 0:
+            self._connection.send({"type": "launch", "jobs": self._launch_batch})
+            self._launch_batch = []
+
+    def kill(self, command_ids: List[int]) -> None:
+        self._connection.send({"type": "kill", "command_ids": list(command_ids)})
+
+    def signal(self, command_ids: List[int], sig: int) -> None:
+        self._connection.send({"type": "signal", "command_ids": list(command_ids),
+                               "signal": int(sig)})
+
+    def forget(self, command_id: int) -> None:
+        self.jobs.pop(command_id, None)
+
+    def shutdown(self) -> None:
+        self._connection.send({"type": "shutdown"})
+
+    def close(self) -> None:
+        self._connection.close()
+
+
+class AgentSlot:
+    """ SingleMachineSlot interface for a proc owned by a node agent """
+    def __init__(self, client: AgentClient, gpus: List[str], log_start_confirm: str = None,
+                 cpus: List[int] = None, limits: dict = None):
+        self.client = client
+        self.machine = client.machine
+        self.gpus = ",".join([str(x) for x in gpus])
+        self.cpus = cpus
+        self.limits = limits
+        self._log_start_confirm = log_start_confirm
+        self._command_id = None
+        self._que_data = None
+
+    def start_command(self, command_id: int, command: str, que_data: "pd.Series") -> bool:
+        self._command_id = command_id
+        self._que_data = que_data
+        self.client.launch(command_id, command, self.gpus.split(","), self._log_start_confirm,
+                           self.cpus, self.limits)
+        return True
+
+    async def start_command_async(self, command_id: int, command: str,
+                                  que_data: "pd.Series") -> bool:
+        return self.start_command(command_id, command, que_data)
+
+    def reattach(self, command_id: int, que_data: "pd.Series") -> None:
+        """ Track a proc the agent kept running while the que manager was down """
+        self._command_id = command_id
+        self._que_data = que_data
+
+    def proc_info(self) -> dict:
+        return dict({"machine": self.machine, "gpus": self.gpus, "cpus": self.cpus,
+                     "agent": True})
+
+    @property
+    def _state(self) -> dict:
+        return self.client.jobs.get(self._command_id) or dict({
+            "started": False, "start_state": START_CRASHED, "return_code": None, "exited": True
+        })
+
+    def pids(self) -> List[int]:
+        return []
+
+    def tail(self, no_lines: int = None, stderr: bool = False) -> List[str]:
+        # Output stays on the agent node
+        return []
+
+    @property
+    def id(self):
+        return self._command_id
+
+    @property
+    def que_data(self) -> "pd.Series":
+        return self._que_data
+
+    @property
+    def start_state(self) -> int:
+        return self._state["start_state"]
+
+    @property
+    def confirmed_start(self) -> bool:
+        return self.start_state != START_PENDING
+
+    def check_start(self) -> int:
+        return self.start_state
+
+    def next_start_check(self) -> float:
+        # Confirmation is pushed by the agent
+        return float("inf")
+
+    @property
+    def is_running(self) -> bool:
+        return self.client.connected and not self._state["exited"]
+
+    @property
+    def crashed(self) -> bool:
+        return self._state["exited"] and self._state["return_code"] != 0
+
+    @property
+    def finished(self) -> bool:
+        return self._state["exited"]
+
+    def clean(self):
+        self.client.forget(self._command_id)
+
+    def stop(self) -> None:
+        if self.is_running:
+            self.client.kill([self._command_id])
+
+    def signal(self, sig: int) -> bool:
+        if not self.is_running:
+            return False
+        self.client.signal([self._command_id], sig)
+        return True
+
+    def kill(self) -> int:
+        if self.is_running:
+            self.client.kill([self._command_id])
+        return self._state["return_code"]
+
+
+class AgentTelemetryBackend(TelemetryBackend):
+    """ GPU telemetry pushed by node agents (no sampling by the que manager) """
+    name = "agent"
+
+    def __init__(self, clients: Dict[str, AgentClient]):
+        self.clients = clients
+
+    def gpu_info(self, machine: str) -> List[dict]:
+        return list(self.clients[machine].gpu_infos.values())
+
+    def gpu_procs(self, machine: str) -> List[dict]:
+        return self.clients[machine].gpu_procs
+
+
+def parse_agents(agents: str) -> Dict[str, str]:
+    """ <machine=address,...> -> {machine: address} """
+    result = dict()
+    for agent in agents.split(","):
+        machine, _, address = agent.partition("=")
+        result[machine] = address if address else machine
+    return result
+
+
+def iter_events(clients: List[AgentClient], timeout: float) -> Iterator[AgentClient]:
+    """ Wait up to timeout for clients with new state (for scripts / benchmarks) """
+    wakeup = Wakeup()
+    for client in clients:
+        client.register(wakeup)
+
+    end_time = time.monotonic() + timeout
+    while time.monotonic() < end_time:
+        wakeup.wait(end_time - time.monotonic())
+        for client in clients:
+            if client.changed():
+                yield client
+
+    for client in clients:
+        wakeup.unregister_fd(client.fileno())
+    wakeup.close()
+
+
+def argparse_menu():
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Remote que node agent - owns que procs of "
+                                                 "this node and pushes their state to the "
+                                                 "que manager.")
+    parser.add_argument('address', type=str,
+                        help='Listen address: <host:port> (TCP, <:port> - loopback) or a Unix '
+                             'socket path. Non-loopback addresses need a token.')
+    parser.add_argument('stdout_folder', type=str, help='Folder for procs stdout / stderr.')
+    parser.add_argument('--machine', type=str, default=None,
+                        help='Machine name (default: host name).')
+    parser.add_argument('--telemetry-backend', default=DEFAULT_TELEMETRY_BACKEND, type=str,
+                        choices=list(TELEMETRY_BACKENDS.keys()), help='GPU telemetry source.')
+    parser.add_argument('--gpu-poll', default=DEFAULT_AGENT_GPU_POLL, type=float,
+                        help='Seconds between GPU telemetry samples.')
+    parser.add_argument('--token-file', default=None, type=str,
+                        help=f'File with the shared token que managers authenticate with '
+                             f'(default: {AGENT_TOKEN_ENV} environment variable).')
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = argparse_menu()
+    token = read_token(args.__dict__.pop("token_file"))
+    agent = NodeAgent(token=token, **args.__dict__)
+    try:
+        agent.serve_forever()
+    except KeyboardInterrupt:
+        agent.close()
@@ -0,0 +1,69 @@
+import os
+import errno
+import threading
+
+from remote_que.config import CGROUP_ROOT, DEFAULT_CGROUP_PIDS_MAX
+
+
+# Procs are moved to cgroup CGROUP_ROOT/proc_<command_id> (command ids are unique on a machine,
+# as the proc pid / status files - a cgroup is never inherited from another job, unlike with
+# reused PIDs). The cgroup is removed once the proc is reaped (see remove_cgroup)
+CPU_PERIOD = 100000  # cpu.max period (us)
+REMOVE_RETRY = 0.5  # seconds between removal attempts of a cgroup with procs left in it
+REMOVE_ATTEMPTS = 20
+
+
+def cgroup_path(command_id: int) -> str:
+    return f"{CGROUP_ROOT}/proc_{command_id}"
+
+
+def cgroup_command(path: str, cpus: int = -1, host_mem: float = -1,
+                   pids_max: int = DEFAULT_CGROUP_PIDS_MAX) -> str:
+    """ Shell prefix moving the proc shell ($$ - inherited by the whole proc tree) to cgroup v2
+        path limited to cpus cores (cpu.max), host_mem MiB (memory.max) & pids_max tasks.
+        Best effort - nothing is limited where cgroup v2 is not writable (no root / delegation).
+        Empty cgroups left by ended procs (e.g. of a killed que manager) are removed first """
+    root = CGROUP_ROOT
+    limits = [f"echo {int(pids_max)} > {path}/pids.max"]
+    if cpus > 0:
+        limits.append(f"echo '{int(cpus) * CPU_PERIOD} {CPU_PERIOD}' > {path}/cpu.max")
+    if host_mem > 0:
+        limits.append(f"echo {int(host_mem) * 2**20} > {path}/memory.max")
+
+    return f"(rmdir {root}/proc_*; mkdir -p {path} && " \
+           f"echo '+cpu +memory +pids' > {root}/cgroup.subtree_control; " \
+           f"{'; '.join(limits)}; echo $$ > {path}/cgroup.procs) 2>/dev/null; "
+
+
+def remove_cgroup_command(path: str) -> str:
+    """ Shell command removing cgroup path of an ended proc - procs left in it are SIGKILLed
+        first (detached, does not wait) """
+    return f"(rmdir {path} || (echo 1 > {path}/cgroup.kill; sleep 1; rmdir {path})) " \
+           f"</dev/null >/dev/null 2>&1 &"
+
+
+def kill_cgroup(path: str) -> bool:
+    """ SIGKILL all procs in the cgroup of a local proc (also the ones that left its process
+        group). False if the proc has no cgroup """
+    try:
+        with open(os.path.join(path, "cgroup.kill"), "w") as f:
+            f.write("1")
+    except OSError:
+        return False
+    return True
+
+
+def remove_cgroup(path: str, attempts: int = REMOVE_ATTEMPTS) -> None:
+    """ Remove the cgroup of a reaped local proc. Procs still in it are SIGKILLed - removal is
+        retried from a timer thread until they are gone (does not block) """
+    try:
+        os.rmdir(path)
+        return
+    except OSError as e:
+        if e.errno != errno.EBUSY or attempts <= 0:
+            return  # no cgroup (or not writable)
+
+    kill_cgroup(path)
+    timer = threading.Timer(REMOVE_RETRY, remove_cgroup, (path, attempts - 1))
+    timer.daemon = True
+    timer.start()
@@ -1,48 +1,395 @@
-from remote_que.run_remote_que import start_remote_que
+import os
+import sys
+import glob
+import json
+import time
+import getpass
+import argparse
+from datetime import datetime
+from typing import List
 
+# Only light modules at import time (no pandas / nvgpu) - status commands start fast. Heavy
+# modules are imported by the commands that need them.
+from remote_que.config import DEFAULT_QUE_PRIORITY, DEFAULT_MAX_EXPANSIONS
+from remote_que.config import STATE_QUE, STATE_STARTED, STATE_RUNNING, STATE_FINISHED
+from remote_que.config import STATE_CRASHED, STATE_CRASHED_START, STATE_SUSPENDED
+from remote_que.config import get_manager_lock_file, get_stats_file, get_control_file
+from remote_que.config import get_manager_log_file, DEFAULT_STORAGE, STORAGE_BACKENDS
+from remote_que.job_index import JobIndex
 
-def start_que():
-    print("Hello world!")
+STATES = [STATE_QUE, STATE_STARTED, STATE_RUNNING, STATE_SUSPENDED, STATE_FINISHED,
+          STATE_CRASHED, STATE_CRASHED_START]
+ENDED_STATES = [STATE_FINISHED, STATE_CRASHED, STATE_CRASHED_START]
+
+TIME_UNITS = dict({"s": 1, "m": 60, "h": 3600, "d": 24 * 3600})
+FOLLOW_POLL = 0.5  # seconds between log file checks with --follow
+TAIL_BLOCK = 1 << 16
+
+
+def parse_time(value: str) -> float:
+    """ Absolute time from a relative age (e.g. 30m, 2h, 1d), a timestamp or an ISO date """
+    if value[-1:] in TIME_UNITS and value[:-1].replace(".", "", 1).isdigit():
+        return time.time() - float(value[:-1]) * TIME_UNITS[value[-1]]
+    try:
+        return float(value)
+    except ValueError:
+        return datetime.fromisoformat(value).timestamp()
+
+
+def _format_time(t: float) -> str:
+    return "-" if t is None else datetime.fromtimestamp(t).strftime("%Y-%m-%d %H:%M:%S")
+
+
+def print_jobs(jobs: List[dict]) -> None:
+    print(f"{'command_id':>14} {'state':<13} {'user':<10} {'prio':>4} {'updated':<19}  command")
+    for job in jobs:
+        data = job["data"] or dict()
+        updated = max(job["times"].values(), default=None)
+        info = "" if len(job["info"]) <= 0 else f"  {json.dumps(job['info'])}"
+        print(f"{job['command_id']:>14} {job['state']:<13} {str(data.get('user', '-')):<10} "
+              f"{str(data.get('que_priority', '-')):>4} {_format_time(updated):<19}  "
+              f"{data.get('shell_command', '')}{info}")
+
+
+def _filters(args: argparse.Namespace) -> dict:
+    return dict({
+        "users": args.user,
+        "since": None if args.since is None else parse_time(args.since),
+        "until": None if args.until is None else parse_time(args.until),
+    })
 
 
 # -- View
-def view_que():
-    pass
+def view_status(args: argparse.Namespace):
+    """ Job counts per state & que manager state (indexed - no que / state files are read) """
+    from remote_que.locking import QueLock
+
+    manager_lock = QueLock(get_manager_lock_file(args.results_folder), timeout=0)
+    if manager_lock.is_held_by_other():
+        print(f"Que manager: running (PID {manager_lock.owner()})")
+    else:
+        print("Que manager: not running")
+
+    stats_file = get_stats_file(args.results_folder)
+    if os.path.isfile(stats_file):
+        with open(stats_file, "r") as f:
+            stats = json.load(f)
+        counters = stats.get("counters", dict())
+        uptime = stats.get("uptime")
+        uptime = "-" if uptime is None else f"{uptime:.0f}s"
+        print(f"Stats ({_format_time(stats.get('time'))}): uptime {uptime}, "
+              f"{counters.get('passes', 0)} passes, {counters.get('jobs_started', 0)} started")
+
+    index = JobIndex(args.results_folder)
+    counts = index.counts(**_filters(args))
+    index.close()
+    for state in STATES + sorted(set(counts.keys()) - set(STATES)):
+        print(f"  {state:<14} {counts.get(state, 0)}")
+
+
+def view_jobs(args: argparse.Namespace):
+    """ List jobs filtered by state / user / last update time """
+    index = JobIndex(args.results_folder)
+    print_jobs(index.jobs(states=args.state, limit=args.limit, **_filters(args)))
+    index.close()
+
+
+def view_que(args: argparse.Namespace):
+    args.state = [STATE_QUE]
+    view_jobs(args)
+
+
+def view_running(args: argparse.Namespace):
+    args.state = [STATE_STARTED, STATE_RUNNING, STATE_SUSPENDED]
+    view_jobs(args)
+    if args.tail:
+        print_tails(args.results_folder)
+
+
+def print_tails(results_folder: str) -> None:
+    """ Last output lines of running jobs kept in memory by the que manager (stats file - no
+        output file is read) """
+    stats_file = get_stats_file(results_folder)
+    if not os.path.isfile(stats_file):
+        return
+
+    with open(stats_file, "r") as f:
+        stats = json.load(f)
+    print(f"Output ({_format_time(stats.get('time'))}):")
+    for command_id, lines in stats.get("tails", dict()).items():
+        print(f"  -- {command_id}")
+        for line in lines:
+            print(f"  {line}")
+
+
+def view_crashed(args: argparse.Namespace):
+    args.state = [STATE_CRASHED, STATE_CRASHED_START]
+    view_jobs(args)
+
+
+def write_views(args: argparse.Namespace):
+    """ Regenerate the csv state files (.started.csv, .running.csv, ...) from job storage """
+    from remote_que.storage import get_storage
+
+    storage = get_storage(args.storage, args.results_folder)
+    written = storage.write_views()
+    storage.close()
+    print(f"Wrote {len(written)} views ({', '.join(written)})")
+
+
+def tail_offset(path: str, no_lines: int) -> int:
+    """ Byte offset of the last no_lines lines of file (read backwards by blocks) """
+    with open(path, "rb") as f:
+        end = f.seek(0, os.SEEK_END)
+        if no_lines <= 0:
+            return end
 
+        offset, found = end, 0
+        while offset > 0:
+            size = min(TAIL_BLOCK, offset)
+            offset -= size
+            f.seek(offset)
+            block = f.read(size)
+            if offset + size == end and block.endswith(b"\n"):
+                block = block[:-1]
+            found += block.count(b"\n")
+            if found >= no_lines:
+                # Start after the no_lines-th newline from the end of this block
+                extra = found - no_lines
+                idx = -1
+                for _ in range(extra + 1):
+                    idx = block.index(b"\n", idx + 1)
+                return offset + idx + 1
+        return 0
 
-def view_running():
-    pass
 
+def follow_file(path: str, offset: int = None, no_lines: int = 10, follow: bool = False) -> int:
+    """ Print file from byte offset (default: last no_lines lines). With follow, print
+        appended bytes until interrupted (reopened when the file is rotated / truncated).
+        Returns the offset after the last printed byte """
+    out = sys.stdout.buffer
+    while not os.path.isfile(path):
+        if not follow:
+            print(f"No log file {path}", file=sys.stderr)
+            return 0
+        time.sleep(FOLLOW_POLL)
 
-def view_crashed():
-    pass
+    offset = tail_offset(path, no_lines) if offset is None else offset
+    f = open(path, "rb")
+    inode = os.fstat(f.fileno()).st_ino
+    try:
+        while True:
+            f.seek(offset)
+            data = f.read()
+            out.write(data)
+            out.flush()
+            offset += len(data)
+            if not follow:
+                return offset
 
+            time.sleep(FOLLOW_POLL)
+            try:
+                st = os.stat(path)
+            except FileNotFoundError:
+                continue  # being rotated
+            if st.st_ino != inode or st.st_size < offset:
+                # Rest of the rotated segment (renamed file), then the new / truncated file
+                # from its start
+                f.seek(offset)
+                out.write(f.read())
+                f.close()
+                f = open(path, "rb")
+                inode, offset = os.fstat(f.fileno()).st_ino, 0
+    except KeyboardInterrupt:
+        return offset
+    finally:
+        f.close()
 
-def view_log():
-    pass
 
+def view_log(args: argparse.Namespace):
+    """ Que manager log """
+    follow_file(get_manager_log_file(args.results_folder), args.offset, args.lines, args.follow)
 
-def view_proc_log():
-    pass
+
+def view_proc_log(args: argparse.Namespace):
+    """ Proc stdout / stderr (current output segment) """
+    suffix = "err" if args.stderr else "out"
+    path = os.path.join(args.results_folder, f"proc_{args.command_id}_{suffix}")
+    follow_file(path, args.offset, args.lines, args.follow)
 
 
 # -- Edit
-def edit_que():
-    pass
+def edit_que(args: argparse.Namespace):
+    from remote_que.run_remote_que import edit_que_data
+
+    edit_que_data(args.results_folder)
+
+
+def submit_to_que(args: argparse.Namespace):
+    """ Submit jobs: shell commands from the command line and/or jsonl / csv batch files """
+    from remote_que.submit import make_job, read_jobs_file, submit_jobs
+    from remote_que.template import TemplateError
+
+    resource = json.loads(args.resource) if args.resource is not None else None
+    if len(args.after) > 0:
+        resource = dict(resource or dict(), depends_on=args.after)
+    jobs = [make_job(cmd, que_priority=args.priority, preferred_resource=resource,
+                     user=args.user) for cmd in args.shell_command]
+    for file_path in args.file:
+        jobs += list(read_jobs_file(file_path))
+
+    try:
+        command_ids = submit_jobs(args.results_folder, jobs, max_expansions=args.max_expansions)
+    except TemplateError as e:
+        sys.exit(f"[ERROR] {e}")
+    if len(command_ids) > 0:
+        print(f"Submitted {len(command_ids)} jobs (ids {command_ids[0]} - {command_ids[-1]})")
+
+
+def send_control(results_folder: str, request: dict) -> None:
+    """ Append a control request for the que manager (single write - lines never interleave) """
+    request = dict(request, user=getpass.getuser(), t=time.time())
+    with open(get_control_file(results_folder), "a") as f:
+        f.write(json.dumps(request) + "\n")
+
+
+def stop_running(args: argparse.Namespace):
+    """ Kill running procs (recorded as crashed with stopped=True) """
+    send_control(args.results_folder, dict({"type": "stop", "command_ids": args.command_id}))
+    print(f"Stop requested for {args.command_id}")
+
+
+def stop_que(args: argparse.Namespace):
+    """ Que manager starts no new procs and exits once running procs end """
+    send_control(args.results_folder, dict({"type": "stop_que"}))
+    print("Que stop requested")
+
+
+def clean(args: argparse.Namespace):
+    """ Remove output files (and rotated segments) of ended jobs """
+    states = ENDED_STATES if args.crashed else [STATE_FINISHED]
+    until = None if args.older_than is None else parse_time(args.older_than)
+
+    index = JobIndex(args.results_folder)
+    jobs = index.jobs(states=states, users=args.user, until=until)
+    index.close()
+
+    no_files, no_bytes = 0, 0
+    for job in jobs:
+        paths = glob.glob(os.path.join(args.results_folder, f"proc_{job['command_id']}_out*"))
+        paths += glob.glob(os.path.join(args.results_folder, f"proc_{job['command_id']}_err*"))
+        for path in paths:
+            no_files += 1
+            no_bytes += os.path.getsize(path)
+            if not args.dry_run:
+                os.remove(path)
+
+    action = "Would remove" if args.dry_run else "Removed"
+    print(f"{action} {no_files} files ({no_bytes / 2**20:.1f} MiB) of {len(jobs)} jobs")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="remote-que", description="Remote launch que of "
+                                                                    "linux commands")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    def add_parser(name: str, func, help: str) -> argparse.ArgumentParser:
+        sub_parser = subparsers.add_parser(name, help=help)
+        sub_parser.add_argument("results_folder", type=str, help="Que manager results folder.")
+        sub_parser.set_defaults(func=func)
+        return sub_parser
+
+    def add_filters(sub_parser: argparse.ArgumentParser) -> None:
+        sub_parser.add_argument("-u", "--user", type=str, action="append", default=None,
+                                help="Only jobs of user (repeat for more users).")
+        sub_parser.add_argument("--since", type=str, default=None,
+                                help="Only jobs updated since (e.g. 30m, 2h, 1d, timestamp or "
+                                     "ISO date).")
+        sub_parser.add_argument("--until", type=str, default=None,
+                                help="Only jobs updated until (same format as --since).")
+
+    def add_list(name: str, func, help: str) -> argparse.ArgumentParser:
+        sub_parser = add_parser(name, func, help)
+        add_filters(sub_parser)
+        sub_parser.add_argument("-n", "--limit", type=int, default=None,
+                                help="Max no. of jobs listed.")
+        return sub_parser
+
+    def add_follow(sub_parser: argparse.ArgumentParser) -> None:
+        sub_parser.add_argument("-n", "--lines", type=int, default=10,
+                                help="No. of last lines printed.")
+        sub_parser.add_argument("-f", "--follow", action="store_true",
+                                help="Print appended output (follows rotated files).")
+        sub_parser.add_argument("--offset", type=int, default=None,
+                                help="Print from this byte offset (instead of last lines).")
+
+    submit_parser = add_parser("submit", submit_to_que, "Submit jobs to que (no editor)")
+    submit_parser.add_argument("shell_command", type=str, nargs="*",
+                               help="Shell command(s) to submit.")
+    submit_parser.add_argument("-f", "--file", type=str, action="append", default=[],
+                               help="Batch of jobs (.jsonl or .csv with que file columns).")
+    submit_parser.add_argument("-p", "--priority", type=int, default=DEFAULT_QUE_PRIORITY,
+                               help="Que priority of command line jobs.")
+    submit_parser.add_argument("-r", "--resource", type=str, default=None,
+                               help='Preferred resource (json) e.g. \'{"no_gpus": 2}\'')
+    submit_parser.add_argument("-a", "--after", type=int, action="append", default=[],
+                               help="Command line jobs start once this job finished "
+                                    "successfully, cancelled if it crashes (repeat for more).")
+    submit_parser.add_argument("-u", "--user", type=str, default=None,
+                               help="Owner of command line jobs (default: current user).")
+    submit_parser.add_argument("--max-expansions", type=int, default=DEFAULT_MAX_EXPANSIONS,
+                               help="Max jobs one command template ([{...}]) expands to - "
+                                    "nothing is submitted if a template expands to more.")
+
+    add_parser("edit", edit_que, "Edit que file (opens editor)")
+
+    status_parser = add_parser("status", view_status, "Job counts & que manager state")
+    add_filters(status_parser)
+
+    list_parser = add_list("list", view_jobs, "List jobs")
+    list_parser.add_argument("-s", "--state", type=str, action="append", default=None,
+                             choices=STATES, help="Only jobs in state (repeat for more).")
+    add_list("que", view_que, "List queued jobs (by priority)")
+    running_parser = add_list("running", view_running, "List started / running / suspended jobs")
+    running_parser.add_argument("-t", "--tail", action="store_true",
+                                help="Also print the last output lines of each job (as of the "
+                                     "last stats file write).")
+    add_list("crashed", view_crashed, "List crashed jobs")
 
+    views_parser = add_parser("views", write_views, "Regenerate csv state files (.started.csv, "
+                                                    ".running.csv, ...) from job storage")
+    views_parser.add_argument("--storage", type=str, default=DEFAULT_STORAGE,
+                              choices=STORAGE_BACKENDS,
+                              help="Job state storage of the que manager.")
 
-def remove_from_que():
-    pass
+    add_follow(add_parser("log", view_log, "Que manager log"))
 
+    proc_log_parser = add_parser("proc-log", view_proc_log, "Proc output")
+    proc_log_parser.add_argument("command_id", type=int, help="Command id of proc.")
+    proc_log_parser.add_argument("-e", "--stderr", action="store_true",
+                                 help="Print stderr instead of stdout.")
+    add_follow(proc_log_parser)
 
-def stop_running():
-    pass
+    stop_parser = add_parser("stop", stop_running, "Kill running procs")
+    stop_parser.add_argument("command_id", type=int, nargs="+", help="Command ids of procs.")
 
+    add_parser("stop-que", stop_que, "Stop que manager once running procs end (no new procs)")
 
-def stop_que():
-    pass
+    clean_parser = add_parser("clean", clean, "Remove output files of finished jobs")
+    clean_parser.add_argument("--crashed", action="store_true",
+                              help="Also remove output of crashed jobs.")
+    clean_parser.add_argument("--older-than", type=str, default=None,
+                              help="Only jobs ended before (e.g. 7d, timestamp or ISO date).")
+    clean_parser.add_argument("-u", "--user", type=str, action="append", default=None,
+                              help="Only jobs of user (repeat for more users).")
+    clean_parser.add_argument("--dry-run", action="store_true",
+                              help="Only print what would be removed.")
 
+    args = parser.parse_args(argv)
+    if args.func is not submit_to_que and not os.path.isdir(args.results_folder):
+        parser.error(f"No results folder {args.results_folder}")
+    args.func(args)
 
-def clean():
-    pass
 
+if __name__ == "__main__":
+    sys.exit(main())
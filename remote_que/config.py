@@ -3,12 +3,30 @@ from collections import OrderedDict
 
 
 LOCK_FILE_NAME = ".lock_que"
+MANAGER_LOCK_FILE_NAME = ".lock_manager"
 QUE_FILE_NAME = "que.csv"
 STARTED_FILE_NAME = ".started.csv"
 CRASHED_FILE_NAME = ".crashed_start.csv"
 FINISHED_FILE_NAME = ".finished.csv"
 CRASHED_START_FILE_NAME = ".crashed.csv"
 RUNNING_FILE_NAME = ".running.csv"
+JOURNAL_FILE_NAME = ".journal"
+DB_FILE_NAME = ".que.db"
+LAST_ID_FILE_NAME = ".last_command_id"
+INVALID_LINES_FILE_NAME = ".invalid_que_lines.csv"
+STATS_FILE_NAME = ".stats.json"
+JOB_INDEX_FILE_NAME = ".job_index.db"
+CONTROL_FILE_NAME = ".control"
+MANAGER_LOG_FILE_NAME = ".que_manager.log"
+
+# Job states (as recorded in the journal)
+STATE_QUE = "queued"
+STATE_STARTED = "started"
+STATE_RUNNING = "running"
+STATE_FINISHED = "finished"
+STATE_CRASHED = "crashed"
+STATE_CRASHED_START = "crashed_start"
+STATE_SUSPENDED = "suspended"  # stopped (SIGSTOP) by a higher priority job, resumed later
 
 DEFAULT_EDITOR = "gedit"
 
@@ -21,33 +39,147 @@ QUE_FILE_HEADER_TYPE = OrderedDict({
 })
 QUE_FILE_HEADER = ",".join(QUE_FILE_HEADER_TYPE.keys())
 
+DEFAULT_MAX_EXPANSIONS = 10000  # max commands one command template line expands to
+
 QUE_FILE_HELP = f"__QUE FILE HELP__:\n" \
                 f"\t Que file should be a parsable comma delimited file with header: \n" \
                 f"\t\t{QUE_FILE_HEADER}\n\n" \
                 f"\t PREFERRED_RESOURCE: preferred_gpu can be set to -1, else process will wait " \
-                f"for preferred_resource to be available\n" \
+                f"for preferred_resource to be available. runtime (seconds) - expected " \
+                f"runtime used for backfill, mem (MiB) - expected peak GPU memory used for " \
+                f"packing jobs on shared GPUs. no_gpus 0 - CPU only proc, cpus - no. of CPU " \
+                f"cores the proc is pinned to, host_mem (MiB) - host memory reserved. " \
+                f"depends_on - command ids / job names (name key) of jobs that must finish " \
+                f"successfully before the proc starts (cancelled if one of them crashes). " \
+                f"checkpoint True - proc saves a checkpoint on SIGUSR1 (when preempted it is " \
+                f"then stopped and requeued instead of suspended). max_gpu_util / " \
+                f"max_mem_bw_util - only GPUs with a rolling SM / memory bandwidth " \
+                f"utilization (%) up to this (small jobs can share underused GPUs)\n" \
                 f"\t SHELL COMMAND: \n" \
-                f"\t\t - can have python code within [{{pattern}}] -> it will be evaluated and \n" \
+                f"\t\t - can have values within [{{pattern}}] (literals, lists, range(...))\n" \
                 f"\t\t\t list elements will distributed to new commands (e.g. [{{{[1,2,3]}}}])\n" \
+                f"\t\t - several patterns -> all combinations; patterns with the same group\n" \
+                f"\t\t\t are zipped (e.g. --lr [{{a:[0.1,0.01]}}] --bs [{{a:[32,64]}}])\n" \
+                f"\t\t - a line expanding to more than {DEFAULT_MAX_EXPANSIONS} commands is " \
+                f"rejected\n" \
                 f"\t USER: owner of process\n" \
                 f"\t COMMAND_ID: leave 0 when adding new line - it will interpreted at runtime"
 
+DEFAULT_QUE_PRIORITY = 1
+
 DEFAULT_RESOURCE = dict({
     "preferred_gpu": -1,  # Index of GPU (or -1 for any gpu)
     "max_procs_on_gpu": 4,  # -1 if any number of processes can run on GPU already
     "min_free_mem": -1,
     "no_gpus": 1,
+    "runtime": -1,  # Expected runtime in seconds (for backfill), -1 to learn from finished jobs
+    "mem": -1,  # Expected peak GPU memory (MiB) per GPU (for packing), -1 to learn
+    "cpus": -1,  # CPU cores the proc is pinned to (NUMA node of its GPUs first), -1 not pinned
+    "host_mem": -1,  # Host memory (MiB) reserved for the proc, -1 not reserved
+    "name": None,  # Job name (depends_on of jobs submitted / edited together may refer to it)
+    "depends_on": [],  # Command ids of jobs that must finish successfully before the proc starts
+    "checkpoint": False,  # Proc saves a checkpoint on SIGUSR1 - preempted by requeue, not suspend
+    "max_gpu_util": -1,  # Max rolling SM utilization (%) of the proc GPUs, -1 not checked
+    "max_mem_bw_util": -1,  # Max rolling memory bandwidth utilization (%), -1 not checked
     # TODO implement selection of machine
 })
 
 DEFAULT_CONFIRM_START_TIMEOUT = 10
 DEFAULT_CONFIRM_START_MAX_WAIT = 360
+DEFAULT_CONFIRM_START_POLL = 1
+
+DEFAULT_TELEMETRY_BACKEND = "nvidia-smi"  # nvidia-smi / nvml / fake
+DEFAULT_TELEMETRY_TTL = 2  # seconds a GPU telemetry snapshot is reused
+
+STORAGE_BACKENDS = ["journal", "sqlite"]
+DEFAULT_STORAGE = "journal"
+DEFAULT_JOURNAL_COMPACT_MIN = 10000  # min journal lines before compaction
+
+DEFAULT_LOCK_TIMEOUT = 60  # seconds to wait for que lock (editors / writers)
+DEFAULT_LOCK_POLL = 0.05  # max seconds between lock attempts
+DEFAULT_QUE_LOCK_WAIT = 1  # seconds que manager waits for que lock each pass
+
+# Backfill - procs may use GPUs reserved for a blocked (bigger) job only if predicted to
+# finish before the reservation (none / easy: one reservation / conservative: all blocked jobs)
+BACKFILL_MODES = ["none", "easy", "conservative"]
+DEFAULT_BACKFILL = "none"  # opt-in (--backfill)
+DEFAULT_RUNTIME_HISTORY = 20  # last runtimes kept per command template / user
+DEFAULT_RUNTIME_QUANTILE = 0.9  # runtime prediction (quantile of history)
+DEFAULT_RUNTIME_ESTIMATE = 24 * 3600  # predicted runtime of running procs with no history
+
+# Fair-share - que order by que_priority + weight * (1 - 2 ** (-usage share / fair share)),
+# usage - GPU hours of each user decayed with half-life (see fairshare.FairShare)
+DEFAULT_FAIR_SHARE_WEIGHT = 0  # max que_priority levels added to users over share (0 - off)
+DEFAULT_FAIR_SHARE_HALF_LIFE = 7 * 24 * 3600  # seconds
+
+# Preemption - blocked jobs suspend (SIGSTOP) running procs with que_priority worse by at least
+# the priority gap (checkpoint procs get SIGUSR1, are stopped after the grace period & requeued)
+DEFAULT_PREEMPT_PRIORITY_GAP = 1
+DEFAULT_PREEMPT_MIN_RUNTIME = 600  # seconds a proc runs (since start / resume) before preemption
+DEFAULT_PREEMPT_CHECKPOINT_GRACE = 300  # seconds between SIGUSR1 & stopping a checkpoint proc
+DEFAULT_PREEMPT_MAX_JOBS = 4  # blocked jobs that may preempt procs per que pass
+
+# GPU utilization sampler (background thread - rolling window per GPU in a ring buffer)
+DEFAULT_UTIL_SAMPLE_INTERVAL = 0  # seconds between utilization samples (0 - off, opt-in)
+DEFAULT_UTIL_WINDOW = 12  # samples kept per GPU (rolling window)
+DEFAULT_UTIL_MIN_SAMPLES = 3  # samples since the last que proc start on a GPU to trust its mean
+
+# GPU packing strategies (see placement.GpuState.select)
+PACKING_STRATEGIES = ["random", "best-fit", "pack", "spread"]
+DEFAULT_PACKING = "random"  # others opt-in (--packing)
+
+# nvidia-smi topo -m link types -> cost (lower - faster link between GPUs)
+GPU_LINK_COSTS = dict({"X": 0, "NV": 1, "PIX": 2, "PXB": 3, "PHB": 4, "NODE": 5, "SYS": 6,
+                       "SOC": 6})
+
+# Machines (que manager host is always run locally)
+DEFAULT_MACHINES = ["0.0.0.0"]
+LOCAL_MACHINES = ["0.0.0.0", "localhost", "127.0.0.1"]
+TRANSPORTS = ["ssh", "local"]  # local - run all machines on this host (testing)
+DEFAULT_TRANSPORT = "ssh"
+DEFAULT_SSH_CONTROL_PERSIST = 600  # seconds an idle ssh master connection is kept open
+DEFAULT_SSH_CONNECT_TIMEOUT = 10
+
+# Node agents (push proc state & GPU telemetry to the que manager)
+DEFAULT_AGENT_GPU_POLL = 2  # seconds between agent GPU samples (only changes are pushed)
+DEFAULT_AGENT_CONNECT_TIMEOUT = 10
+# Shared secret of agents & que managers (else read from --token-file / --agent-token-file).
+# Required for agents listening on non-loopback addresses - they run any command they receive
+AGENT_TOKEN_ENV = "REMOTE_QUE_AGENT_TOKEN"
+
+# Proc control - procs run in their own session (process group); the whole tree is stopped
+# with SIGTERM, then SIGKILL after the grace period
+DEFAULT_KILL_GRACE = 10  # seconds between SIGTERM & SIGKILL
+
+# Optional cgroup v2 limits per proc (cpus -> cpu.max, host_mem -> memory.max, pids.max)
+CGROUP_ROOT = "/sys/fs/cgroup/remote_que"  # parent cgroup of proc_<command_id> cgroups
+DEFAULT_CGROUP_PIDS_MAX = 4096  # max tasks (processes & threads) per proc
+
+DEFAULT_EVENT_POLL_INTERVAL = 1  # seconds between file checks when inotify is not available
+
+# Job output files (written by the procs, rotated to proc_<id>_out.<n>, optionally compressed)
+OUTPUT_COMPRESSIONS = ["none", "gzip", "zstd"]
+DEFAULT_OUTPUT_COMPRESS = "none"
+DEFAULT_OUTPUT_MAX_BYTES = 100 * 2**20  # bytes per output segment (<= 0 - no rotation)
+DEFAULT_OUTPUT_KEEP = 10  # closed segments kept per job output
+DEFAULT_OUTPUT_TAIL_LINES = 100  # last output lines of each job kept in memory
+
+# Que manager metrics (json stats file in results folder & optional Prometheus endpoint)
+DEFAULT_STATS_INTERVAL = 10  # seconds between stats file writes
+DEFAULT_STATS_TAIL_LINES = 10  # last output lines of each running job in the stats
+DEFAULT_METRICS_PORT = None  # local port of the metrics endpoint (None - disabled)
+STAGE_BUCKETS = [0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 60]  # que loop stages (seconds)
+JOB_TIME_BUCKETS = [10, 60, 300, 1800, 3600, 4 * 3600, 12 * 3600, 24 * 3600, 72 * 3600]
 
 
 def get_lock_file(folder: str):
     return os.path.join(folder, LOCK_FILE_NAME)
 
 
+def get_manager_lock_file(folder: str):
+    return os.path.join(folder, MANAGER_LOCK_FILE_NAME)
+
+
 def get_que_file(folder: str):
     return os.path.join(folder, QUE_FILE_NAME)
 
@@ -70,3 +202,35 @@ def get_crash_start_file(folder: str):
 
 def get_finished_file(folder: str):
     return os.path.join(folder, FINISHED_FILE_NAME)
+
+
+def get_journal_file(folder: str):
+    return os.path.join(folder, JOURNAL_FILE_NAME)
+
+
+def get_invalid_lines_file(folder: str):
+    return os.path.join(folder, INVALID_LINES_FILE_NAME)
+
+
+def get_db_file(folder: str):
+    return os.path.join(folder, DB_FILE_NAME)
+
+
+def get_last_id_file(folder: str):
+    return os.path.join(folder, LAST_ID_FILE_NAME)
+
+
+def get_stats_file(folder: str):
+    return os.path.join(folder, STATS_FILE_NAME)
+
+
+def get_job_index_file(folder: str):
+    return os.path.join(folder, JOB_INDEX_FILE_NAME)
+
+
+def get_control_file(folder: str):
+    return os.path.join(folder, CONTROL_FILE_NAME)
+
+
+def get_manager_log_file(folder: str):
+    return os.path.join(folder, MANAGER_LOG_FILE_NAME)
@@ -0,0 +1,150 @@
+from typing import Dict, List, Set, Iterable, Tuple, Any
+
+
+class DependencyError(ValueError):
+    pass
+
+
+def job_parents(preferred_resource: dict) -> List[Any]:
+    """ Parents of a job - preferred_resource depends_on (a command id / job name or a list of
+        them) """
+    parents = preferred_resource.get("depends_on", [])
+    return list(parents) if isinstance(parents, (list, tuple, set)) else [parents]
+
+
+def resolve_dependencies(jobs: List[dict]) -> List[dict]:
+    """ Replace job names in depends_on with the command ids of the jobs (dicts with
+        preferred_resource & allocated command_id) with that name - a name given to a command
+        template names all its expanded jobs. Raises DependencyError for unknown names, self
+        dependencies and cycles.
+    """
+    names = dict()  # name -> command ids
+    for job in jobs:
+        name = job["preferred_resource"].get("name")
+        if name is not None:
+            names.setdefault(name, []).append(job["command_id"])
+
+    resolved, edges = [], dict()
+    for job in jobs:
+        parents = job_parents(job["preferred_resource"])
+        if len(parents) <= 0:
+            resolved.append(job)
+            continue
+
+        parent_ids = []
+        for parent in parents:
+            if isinstance(parent, str):
+                if parent not in names:
+                    raise DependencyError(f"Job {job['command_id']} depends on unknown job name "
+                                          f"<{parent}>")
+                parent_ids.extend(names[parent])
+            elif isinstance(parent, int) and not isinstance(parent, bool):
+                parent_ids.append(parent)
+            else:
+                raise DependencyError(f"Job {job['command_id']} depends_on should be command "
+                                      f"ids or job names (got {parent!r})")
+
+        if job["command_id"] in parent_ids:
+            raise DependencyError(f"Job {job['command_id']} depends on itself")
+
+        edges[job["command_id"]] = parent_ids
+        resource = dict(job["preferred_resource"], depends_on=sorted(set(parent_ids)))
+        resolved.append(dict(job, preferred_resource=resource))
+
+    _check_cycles(edges)
+    return resolved
+
+
+def _check_cycles(edges: Dict[Any, List[Any]]) -> None:
+    """ Iterative DFS over child -> parents edges """
+    done = set()
+    for root in edges:
+        if root in done:
+            continue
+        path, stack = set(), [(root, iter(edges.get(root, [])))]
+        path.add(root)
+        while len(stack) > 0:
+            node, parents = stack[-1]
+            parent = next(parents, None)
+            if parent is None:
+                stack.pop()
+                path.discard(node)
+                done.add(node)
+            elif parent in path:
+                raise DependencyError(f"Dependency cycle through job {parent}")
+            elif parent not in done:
+                path.add(parent)
+                stack.append((parent, iter(edges.get(parent, []))))
+
+
+class DependencyGraph:
+    """ In-memory index of queued jobs waiting for their parents.
+
+        A job is ready when all its parents finished successfully (readiness is one dict
+        lookup). Each job keeps its no. of unfinished parents and each parent the jobs waiting
+        for it, so an ended parent only touches its own children: finished() returns the jobs
+        that became ready, failed() the queued descendants to cancel.
+    """
+    def __init__(self):
+        self._waiting = dict()  # type: Dict[Any, int]  # job -> no. of unfinished parents
+        self._children = dict()  # type: Dict[Any, Set[Any]]  # parent -> waiting jobs
+        self._known = set()  # queued jobs added to the graph
+
+    def __contains__(self, command_id: Any) -> bool:
+        return command_id in self._known
+
+    def __len__(self) -> int:
+        return len(self._waiting)
+
+    def add(self, command_id: Any, parents: Iterable[Tuple[Any, str]]) -> List[Any]:
+        """ Add a queued job with <(parent, parent state)> - None (pending / running parent),
+            "finished" or "failed". Returns failed parents (the job should be cancelled) """
+        self._known.add(command_id)
+
+        failed, pending = [], 0
+        for parent, state in parents:
+            if state == "failed":
+                failed.append(parent)
+            elif state != "finished":
+                self._children.setdefault(parent, set()).add(command_id)
+                pending += 1
+
+        if len(failed) > 0:
+            self.remove(command_id)
+        elif pending > 0:
+            self._waiting[command_id] = pending
+        return failed
+
+    def ready(self, command_id: Any) -> bool:
+        return command_id not in self._waiting
+
+    def waiting(self) -> Dict[Any, int]:
+        return dict(self._waiting)
+
+    def remove(self, command_id: Any) -> None:
+        """ Job left the que (started or cancelled) """
+        self._known.discard(command_id)
+        self._waiting.pop(command_id, None)
+
+    def finished(self, parent: Any) -> List[Any]:
+        """ Parent finished successfully. Returns jobs that became ready """
+        ready = []
+        for child in self._children.pop(parent, ()):
+            if child in self._waiting:
+                self._waiting[child] -= 1
+                if self._waiting[child] <= 0:
+                    del self._waiting[child]
+                    ready.append(child)
+        return ready
+
+    def failed(self, parent: Any) -> List[Any]:
+        """ Parent crashed / was stopped or cancelled. Returns its queued descendants (removed
+            from the graph) """
+        cancelled, stack = [], [parent]
+        while len(stack) > 0:
+            for child in self._children.pop(stack.pop(), ()):
+                if child in self._known:
+                    self.remove(child)
+                    cancelled.append(child)
+                    stack.append(child)
+        return cancelled
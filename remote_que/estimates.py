@@ -0,0 +1,102 @@
+import re
+from collections import deque
+from typing import Dict, Optional, Tuple
+import numpy as np
+
+from remote_que.config import STATE_STARTED, STATE_FINISHED
+from remote_que.config import DEFAULT_RUNTIME_HISTORY, DEFAULT_RUNTIME_QUANTILE
+from remote_que.storage import JobStorage
+
+
+NUMBER_PATTERN = re.compile(r"(?<![A-Za-z_])[-+]?\d+(\.\d*)?([eE][-+]?\d+)?")
+
+# Estimated metrics -> preferred_resource key of a user given value
+METRICS = dict({
+    "runtime": "runtime",  # seconds
+    "gpu_mem": "mem",  # peak GPU memory per GPU (MiB)
+})
+
+
+def command_template(command: str) -> str:
+    """ Command with numeric arguments masked - runs of a hyper-parameter sweep share it
+        (e.g. "train.py --lr 0.1 --seed 3" -> "train.py --lr # --seed #") """
+    return NUMBER_PATTERN.sub("#", " ".join(command.split()))
+
+
+class JobEstimator:
+    """ Job runtime & GPU memory predictions learned from finished jobs: quantile of the last
+        values of the same command template, else of the same user. A value set by the user in
+        preferred_resource ("runtime" seconds, "mem" MiB) takes precedence.
+    """
+    def __init__(self, history: int = DEFAULT_RUNTIME_HISTORY,
+                 quantile: float = DEFAULT_RUNTIME_QUANTILE):
+        self.history = history
+        self.quantile = quantile
+        self._history = dict()  # type: Dict[Tuple[str, str, str], deque]
+        self._templates = dict()  # command -> template
+        self._cache = dict()  # (metric, template / user, key) -> estimate
+
+    def _template(self, command: str) -> str:
+        template = self._templates.get(command)
+        if template is None:
+            template = self._templates[command] = command_template(command)
+        return template
+
+    def _keys(self, data: dict, metric: str):
+        yield metric, "template", self._template(data["shell_command"])
+        yield metric, "user", data["user"]
+
+    def add(self, data: dict, runtime: float = None, gpu_mem: float = None) -> None:
+        """ Record a finished job (data - que row) """
+        for metric, value in [("runtime", runtime), ("gpu_mem", gpu_mem)]:
+            if value is None:
+                continue
+
+            for key in self._keys(data, metric):
+                if key not in self._history:
+                    self._history[key] = deque(maxlen=self.history)
+                self._history[key].append(value)
+                self._cache.pop(key, None)
+
+    def add_job(self, job: dict) -> bool:
+        """ Record a job from storage (if it finished successfully) """
+        if job is None or job["state"] != STATE_FINISHED or job["data"] is None:
+            return False
+
+        times = job["times"]
+        if STATE_STARTED not in times or STATE_FINISHED not in times:
+            return False
+
+        self.add(job["data"], runtime=times[STATE_FINISHED] - times[STATE_STARTED],
+                 gpu_mem=job["info"].get("gpu_mem"))
+        return True
+
+    def load(self, storage: JobStorage) -> int:
+        """ Learn from all finished jobs in storage. Returns no. of jobs used """
+        jobs = sorted(storage.jobs_in_state([STATE_FINISHED]),
+                      key=lambda job: job["times"].get(STATE_FINISHED, 0))
+        return sum([self.add_job(job) for job in jobs])
+
+    def _estimate(self, key: Tuple[str, str, str]) -> Optional[float]:
+        if key not in self._history:
+            return None
+
+        estimate = self._cache.get(key)
+        if estimate is None:
+            estimate = self._cache[key] = float(np.quantile(self._history[key], self.quantile))
+        return estimate
+
+    def estimate(self, data: dict, metric: str = "runtime") -> Optional[float]:
+        """ Predicted metric (runtime / gpu_mem) of que row data, None if unknown """
+        value = data.get("preferred_resource", dict()).get(METRICS[metric], -1)
+        if value is not None and value > 0:
+            return float(value)
+
+        for key in self._keys(data, metric):
+            estimate = self._estimate(key)
+            if estimate is not None:
+                return estimate
+        return None
+
+    def estimate_memory(self, data: dict) -> Optional[float]:
+        return self.estimate(data, "gpu_mem")
@@ -0,0 +1,236 @@
+import os
+import time
+import select
+import signal
+import struct
+import ctypes
+import ctypes.util
+from typing import Callable, List
+
+from remote_que.logger import logger
+
+
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE | IN_DELETE
+
+_INOTIFY_EVENT = struct.Struct("iIII")
+
+
+class Wakeup:
+    """ Single wakeup primitive of the que manager.
+
+        Event sources (signals, inotify, ...) either register a file descriptor or a poller.
+        wait() blocks until one of them reports an event or the timeout expires.
+    """
+    def __init__(self, poll_interval: float = 1.):
+        self._read_fd, self._write_fd = os.pipe()
+        os.set_blocking(self._read_fd, False)
+        os.set_blocking(self._write_fd, False)
+
+        self._poll_interval = poll_interval
+        self._sources = dict({self._read_fd: self._drain})
+        self._pollers = []  # type: List[Callable[[], bool]]
+
+        # asyncio loop watching the sources (see attach)
+        self._loop = None
+        self._callback = None
+
+    def notify(self) -> None:
+        """ Safe to call from signal handlers """
+        try:
+            os.write(self._write_fd, b"\0")
+        except (BlockingIOError, OSError):
+            pass
+
+    def register_fd(self, fd: int, callback: Callable[[], bool]) -> None:
+        self._sources[fd] = callback
+        if self._loop is not None:
+            self._loop.add_reader(fd, self._callback, fd)
+
+    def unregister_fd(self, fd: int) -> None:
+        if self._sources.pop(fd, None) is not None and self._loop is not None:
+            self._loop.remove_reader(fd)
+
+    def add_poller(self, poller: Callable[[], bool]) -> None:
+        self._pollers.append(poller)
+
+    def wait(self, timeout: float) -> bool:
+        """ Returns True if woken by an event, False on timeout """
+        end_time = time.monotonic() + timeout
+
+        while True:
+            remaining = end_time - time.monotonic()
+            if remaining <= 0:
+                return False
+
+            if len(self._pollers) > 0:
+                remaining = min(remaining, self._poll_interval)
+
+            ready, _, _ = select.select(list(self._sources.keys()), [], [], remaining)
+
+            woken = False
+            for fd in ready:
+                woken = self._sources[fd]() or woken
+
+            for poller in self._pollers:
+                woken = poller() or woken
+
+            if woken:
+                return True
+
+    def poll(self) -> bool:
+        """ Run pollers once. Returns True if any reported an event """
+        woken = False
+        for poller in self._pollers:
+            woken = poller() or woken
+        return woken
+
+    @property
+    def poll_interval(self) -> float:
+        """ Max seconds between poll() calls (inf if there are no pollers) """
+        return self._poll_interval if len(self._pollers) > 0 else float("inf")
+
+    def attach(self, loop, callback: Callable[[], None]) -> None:
+        """ Watch event sources from an asyncio loop instead of wait() - callback is called when
+            a source reports an event (pollers must still be run with poll()).
+        """
+        def _on_readable(fd: int) -> None:
+            if self._sources[fd]():
+                callback()
+
+        for fd in list(self._sources.keys()):
+            loop.add_reader(fd, _on_readable, fd)
+        self._loop = loop
+        self._callback = _on_readable
+
+    def detach(self) -> None:
+        if self._loop is not None:
+            for fd in list(self._sources.keys()):
+                self._loop.remove_reader(fd)
+            self._loop = None
+
+    def _drain(self) -> bool:
+        try:
+            while os.read(self._read_fd, 4096):
+                pass
+        except (BlockingIOError, OSError):
+            pass
+        return True
+
+    def close(self) -> None:
+        os.close(self._read_fd)
+        os.close(self._write_fd)
+
+
+class ChildWatcher:
+    """ Wakes up the que manager as soon as a child process exits (SIGCHLD) """
+    def __init__(self, wakeup: Wakeup):
+        self._wakeup = wakeup
+        self._pending = False
+        self._prev_handler = None
+        self.active = False
+
+        try:
+            self._prev_handler = signal.signal(signal.SIGCHLD, self._on_sigchld)
+            self.active = True
+        except (ValueError, AttributeError) as e:
+            # Not in main thread or platform without SIGCHLD -> rely on wait timeout
+            logger.warning(f"[ChildWatcher] Cannot install SIGCHLD handler ({e})")
+
+    def _on_sigchld(self, signum, frame):
+        self._pending = True
+        self._wakeup.notify()
+
+    def pending(self) -> bool:
+        """ True if any child exited since last call (not only que procs, e.g. nvidia-smi) """
+        pending, self._pending = self._pending, False
+        return pending
+
+    def close(self) -> None:
+        if self.active:
+            signal.signal(signal.SIGCHLD, self._prev_handler or signal.SIG_DFL)
+            self.active = False
+
+
+def _inotify_libc():
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        libc.inotify_init1, libc.inotify_add_watch
+    except (OSError, AttributeError):
+        return None
+    return libc
+
+
+class FileWatcher:
+    """ Detects changes of files (by name) in a folder.
+
+        Uses inotify on the folder when available, otherwise polls file stats on every
+        wakeup poll interval. Changes are reported relative to the last mark_seen() call so that
+        the que manager's own writes do not wake it up.
+    """
+    def __init__(self, wakeup: Wakeup, folder: str, file_names: List[str]):
+        self._folder = folder
+        self._file_names = set(file_names)
+        self._inotify_fd = None
+        self._seen = self._signatures()
+
+        libc = _inotify_libc()
+        if libc is not None:
+            fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+            if fd >= 0 and libc.inotify_add_watch(fd, folder.encode(), IN_WATCH_MASK) >= 0:
+                self._inotify_fd = fd
+            elif fd >= 0:
+                os.close(fd)
+
+        if self._inotify_fd is not None:
+            wakeup.register_fd(self._inotify_fd, self._read_inotify)
+        else:
+            logger.info("[FileWatcher] inotify not available, falling back to polling")
+            wakeup.add_poller(self.changed)
+
+    @property
+    def uses_inotify(self) -> bool:
+        return self._inotify_fd is not None
+
+    def _signatures(self) -> dict:
+        signatures = dict()
+        for name in self._file_names:
+            try:
+                st = os.stat(os.path.join(self._folder, name))
+                signatures[name] = (st.st_ino, st.st_size, st.st_mtime_ns)
+            except OSError:
+                signatures[name] = None
+        return signatures
+
+    def _read_inotify(self) -> bool:
+        relevant = False
+        try:
+            while True:
+                buf = os.read(self._inotify_fd, 65536)
+                if not buf:
+                    break
+
+                offset = 0
+                while offset < len(buf):
+                    _, _, _, name_len = _INOTIFY_EVENT.unpack_from(buf, offset)
+                    offset += _INOTIFY_EVENT.size
+                    name = buf[offset:offset + name_len].rstrip(b"\0").decode(errors="ignore")
+                    offset += name_len
+                    relevant = relevant or name in self._file_names
+        except (BlockingIOError, OSError):
+            pass
+        return relevant
+
+    def changed(self) -> bool:
+        return self._signatures() != self._seen
+
+    def mark_seen(self) -> None:
+        self._seen = self._signatures()
+
+    def close(self) -> None:
+        if self._inotify_fd is not None:
+            os.close(self._inotify_fd)
+            self._inotify_fd = None
@@ -0,0 +1,146 @@
+from typing import Dict, Iterable, Optional, Tuple, Any
+
+from remote_que.config import STATE_STARTED, STATE_FINISHED, STATE_CRASHED, STATE_CRASHED_START
+from remote_que.config import DEFAULT_FAIR_SHARE_WEIGHT, DEFAULT_FAIR_SHARE_HALF_LIFE
+from remote_que.storage import JobStorage
+
+
+ENDED_STATES = [STATE_FINISHED, STATE_CRASHED, STATE_CRASHED_START]
+MAX_DECAY_EXPONENT = 256  # half-lives before stored usage is rescaled to a new reference time
+
+
+def parse_user_values(values: str, value_type=float) -> Dict[str, Any]:
+    """ Comma separated <user=value> ("*" - default for other users) e.g. "alice=2,*=1" """
+    result = dict()
+    for item in values.split(","):
+        user, _, value = item.partition("=")
+        assert len(value) > 0, f"Expected <user=value>, got {item}"
+        result[user.strip()] = value_type(value)
+    return result
+
+
+def job_gpus(job: dict) -> int:
+    """ No. of GPUs used by a job from storage (placed GPUs, else requested ones) """
+    gpus = job["info"].get("gpus")
+    if gpus is not None:
+        return len([gpu for gpu in str(gpus).split(",") if len(gpu) > 0])
+    return int((job["data"] or dict()).get("preferred_resource", dict()).get("no_gpus", 1))
+
+
+class FairShare:
+    """ Fair-share que order & per user GPU caps.
+
+        Usage of a user is the GPU hours of its jobs, decayed with half_life (seconds): ended
+        jobs are added once (end / add_job), running jobs are charged their elapsed time. The
+        effective priority of a queued job is que_priority + weight * (1 - 2 ** (-u / f)) (lower
+        runs first) - u is the user's share of the usage, f its fair share (shares, default 1
+        per user, normalized over users with queued or running jobs). Users without usage are
+        not moved back.
+
+        Updates are O(1) - usage is stored scaled to a reference time, so neither the history
+        nor all users are decayed again.
+    """
+    def __init__(self, weight: float = DEFAULT_FAIR_SHARE_WEIGHT,
+                 half_life: float = DEFAULT_FAIR_SHARE_HALF_LIFE,
+                 shares: Dict[str, float] = None, caps: Dict[str, int] = None):
+        self.weight = weight
+        self.half_life = half_life
+        self.shares = dict() if shares is None else shares
+        self.caps = dict() if caps is None else caps
+
+        self._usage = dict()  # type: Dict[str, float]  # user -> GPU hours at reference time
+        self._reference = None  # type: float
+        self._running = dict()  # type: Dict[Any, Tuple[str, int, float]]  # (user, GPUs, start)
+
+    def _scale(self, t: float) -> float:
+        """ Factor of usage added at t, relative to the reference time """
+        if self._reference is None:
+            self._reference = t
+
+        exponent = (t - self._reference) / self.half_life
+        if exponent > MAX_DECAY_EXPONENT:
+            factor = 2. ** -exponent
+            self._usage = {user: usage * factor for user, usage in self._usage.items()}
+            self._reference, exponent = t, 0.
+        return 2. ** exponent
+
+    def add_usage(self, user: str, gpu_hours: float, t: float) -> None:
+        """ GPU hours used by user, ended at t """
+        if gpu_hours > 0:
+            scaled = gpu_hours * self._scale(t)  # may rescale stored usage first
+            self._usage[user] = self._usage.get(user, 0.) + scaled
+
+    def start(self, key: Any, user: str, no_gpus: int, t: float) -> None:
+        """ Job (key) of user started at t on no_gpus GPUs """
+        self._running[key] = (user, no_gpus, t)
+
+    def end(self, key: Any, t: float) -> None:
+        """ Job ended at t - its GPU hours are added to the usage of its user """
+        if key in self._running:
+            user, no_gpus, start = self._running.pop(key)
+            self.add_usage(user, no_gpus * max(t - start, 0.) / 3600, t)
+
+    def add_job(self, job: dict) -> bool:
+        """ Record an ended job from storage """
+        if job is None or job["data"] is None or job["state"] not in ENDED_STATES:
+            return False
+
+        times = job["times"]
+        if STATE_STARTED not in times or job["state"] not in times:
+            return False
+
+        self.add_usage(job["data"]["user"],
+                       job_gpus(job) * (times[job["state"]] - times[STATE_STARTED]) / 3600,
+                       times[job["state"]])
+        return True
+
+    def load(self, storage: JobStorage) -> int:
+        """ Usage of all ended jobs in storage (once - later jobs are added with end).
+            Returns no. of jobs used """
+        return sum([self.add_job(job) for job in storage.jobs_in_state(ENDED_STATES)])
+
+    def usage(self, user: str, now: float) -> float:
+        """ Decayed GPU hours of user at now (running jobs included) """
+        usage = self._usage.get(user, 0.)
+        if usage > 0:
+            usage /= self._scale(now)
+        for running_user, no_gpus, start in self._running.values():
+            if running_user == user:
+                usage += no_gpus * max(now - start, 0.) / 3600
+        return usage
+
+    def share(self, user: str) -> float:
+        return float(self.shares.get(user, self.shares.get("*", 1.)))
+
+    def adjustments(self, users: Iterable[str], now: float) -> Dict[str, float]:
+        """ Priority added to jobs of each user (queued users & users with running jobs) """
+        users = set(users) | set(user for user, _, _ in self._running.values())
+        if self.weight == 0 or len(users) <= 0:
+            return {user: 0. for user in users}
+
+        usage = {user: self.usage(user, now) for user in users}
+        total_usage = sum(usage.values())
+        total_share = sum(self.share(user) for user in users)
+
+        adjustments = dict()
+        for user in users:
+            share = self.share(user) / total_share if total_share > 0 else 0.
+            used = usage[user] / total_usage if total_usage > 0 else 0.
+            if used <= 0:
+                adjustments[user] = 0.
+            elif share <= 0:
+                adjustments[user] = float(self.weight)
+            else:
+                adjustments[user] = self.weight * (1 - 2. ** (-used / share))
+        return adjustments
+
+    def user_gpus(self) -> Dict[str, int]:
+        """ GPUs used by running jobs of each user """
+        gpus = dict()
+        for user, no_gpus, _ in self._running.values():
+            gpus[user] = gpus.get(user, 0) + no_gpus
+        return gpus
+
+    def cap(self, user: str) -> Optional[int]:
+        """ Max GPUs of concurrently running jobs of user (None - no cap) """
+        return self.caps.get(user, self.caps.get("*"))
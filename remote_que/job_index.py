@@ -0,0 +1,146 @@
+import os
+import json
+import sqlite3
+from typing import List, Dict, Optional
+
+from remote_que.config import get_db_file, get_journal_file, get_job_index_file
+
+
+# Same columns as the jobs table of SqliteStorage - both are queried the same way
+INDEX_SCHEMA = [
+    "CREATE TABLE IF NOT EXISTS jobs ("
+    " command_id INTEGER PRIMARY KEY, state TEXT NOT NULL, que_priority INTEGER,"
+    " user TEXT, data TEXT, times TEXT NOT NULL, info TEXT NOT NULL, updated REAL)",
+    "CREATE INDEX IF NOT EXISTS jobs_state_priority ON jobs (state, que_priority)",
+    "CREATE INDEX IF NOT EXISTS jobs_user_state ON jobs (user, state)",
+    "CREATE INDEX IF NOT EXISTS jobs_updated ON jobs (updated)",
+    "CREATE TABLE IF NOT EXISTS journal (inode INTEGER, offset INTEGER)",
+]
+
+
+class JobIndex:
+    """ Indexed read-only view of job state for the CLI (no pandas, no replay of all state).
+
+        SQLite storage is queried directly. A journal is indexed incrementally to a SQLite file
+        (get_job_index_file): only records appended since the last read byte offset are
+        applied (the index is rebuilt when the journal was compacted - new inode).
+    """
+    def __init__(self, results_folder: str):
+        self.results_folder = results_folder
+        db_file = get_db_file(results_folder)
+        journal_file = get_journal_file(results_folder)
+
+        if os.path.isfile(db_file) and not os.path.isfile(journal_file):
+            self._db = sqlite3.connect(f"file:{db_file}?mode=ro", uri=True)
+        else:
+            self._db = sqlite3.connect(get_job_index_file(results_folder))
+            for statement in INDEX_SCHEMA:
+                self._db.execute(statement)
+            self._update_journal(journal_file)
+
+    def _update_journal(self, journal_file: str) -> None:
+        if not os.path.isfile(journal_file):
+            return
+
+        db = self._db
+        st = os.stat(journal_file)
+        row = db.execute("SELECT inode, offset FROM journal").fetchone()
+        inode, offset = (None, 0) if row is None else row
+        if inode != st.st_ino or st.st_size < offset:
+            db.execute("DELETE FROM jobs")
+            offset = 0
+
+        if st.st_size == offset:
+            return
+
+        with open(journal_file, "rb") as f:
+            f.seek(offset)
+            content = f.read()
+
+        # Only complete lines (the que manager may be writing the last one)
+        content = content[:content.rfind(b"\n") + 1]
+        jobs = dict()  # command_id -> job updated in this read
+        for line in content.splitlines():
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+
+            command_id = record["id"]
+            job = jobs.get(command_id)
+            if job is None:
+                job = jobs[command_id] = self._job(command_id) or dict({
+                    "state": None, "data": None, "times": dict(), "info": dict()
+                })
+
+            job["state"] = record["s"]
+            if record.get("d") is not None:
+                job["data"] = record["d"]
+            job["times"].update(record.get("tm", {record["s"]: record["t"]}))
+            job["info"].update(record.get("i", {}))
+
+        rows = []
+        for command_id, job in jobs.items():
+            data = job["data"] or dict()
+            rows.append((command_id, job["state"], data.get("que_priority"), data.get("user"),
+                         None if job["data"] is None else json.dumps(job["data"]),
+                         json.dumps(job["times"]), json.dumps(job["info"]),
+                         max(job["times"].values(), default=None)))
+        db.executemany("INSERT OR REPLACE INTO jobs VALUES (?, ?, ?, ?, ?, ?, ?, ?)", rows)
+        db.execute("DELETE FROM journal")
+        db.execute("INSERT INTO journal VALUES (?, ?)", (st.st_ino, offset + len(content)))
+        db.commit()
+
+    @staticmethod
+    def _row_to_job(row) -> dict:
+        command_id, state, data, times, info = row
+        return dict({"command_id": command_id, "state": state,
+                     "data": None if data is None else json.loads(data),
+                     "times": json.loads(times), "info": json.loads(info)})
+
+    def _job(self, command_id: int) -> Optional[dict]:
+        row = self._db.execute("SELECT command_id, state, data, times, info FROM jobs "
+                               "WHERE command_id = ?", (int(command_id),)).fetchone()
+        return None if row is None else self._row_to_job(row)
+
+    def job(self, command_id: int) -> Optional[dict]:
+        """ Job dict (as JobStorage.job) with its command_id, None if unknown """
+        return self._job(command_id)
+
+    def _where(self, states: List[str] = None, users: List[str] = None, since: float = None,
+               until: float = None) -> tuple:
+        clauses, params = [], []
+        for column, values in [("state", states), ("user", users)]:
+            if values:
+                clauses.append(f"{column} IN ({','.join('?' * len(values))})")
+                params += list(values)
+        if since is not None:
+            clauses.append("updated >= ?")
+            params.append(since)
+        if until is not None:
+            clauses.append("updated <= ?")
+            params.append(until)
+        where = f" WHERE {' AND '.join(clauses)}" if len(clauses) > 0 else ""
+        return where, params
+
+    def counts(self, **filters) -> Dict[str, int]:
+        """ No. of jobs per state (filters - see jobs) """
+        where, params = self._where(**filters)
+        return dict(self._db.execute(f"SELECT state, COUNT(*) FROM jobs{where} GROUP BY state",
+                                     params))
+
+    def jobs(self, states: List[str] = None, users: List[str] = None, since: float = None,
+             until: float = None, limit: int = None) -> List[dict]:
+        """ Jobs filtered by state / user / last update time (queued jobs by priority, others
+            by last update) """
+        where, params = self._where(states, users, since, until)
+        query = f"SELECT command_id, state, data, times, info FROM jobs{where} " \
+                f"ORDER BY state = 'queued', " \
+                f"CASE WHEN state = 'queued' THEN que_priority END, updated, command_id"
+        if limit is not None:
+            query += " LIMIT ?"
+            params.append(limit)
+        return [self._row_to_job(row) for row in self._db.execute(query, params)]
+
+    def close(self) -> None:
+        self._db.close()
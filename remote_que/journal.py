@@ -0,0 +1,147 @@
+import os
+import json
+import time
+from typing import List, Dict
+
+from remote_que.logger import logger
+from remote_que.config import STATE_QUE
+from remote_que.config import get_journal_file
+from remote_que.config import DEFAULT_JOURNAL_COMPACT_MIN
+from remote_que.storage import JobStorage, json_default
+
+
+class QueJournal(JobStorage):
+    """ Append-only journal of job state transitions (write-ahead log of the que manager).
+
+        Each line is a json record {"t": time, "id": command_id, "s": state, "d": que row data,
+        "i": extra info}. Records are buffered and written + fsync-ed in batches on flush().
+        Latest state of every job is kept in memory (replayed at load). When the journal grows
+        over 2 x number of jobs it is compacted to one line per job.
+
+        The old csv state files (.started.csv, .running.csv, ...) are views regenerated on
+        demand, at compaction & at que manager exit (see JobStorage.write_views).
+    """
+    name = "journal"
+
+    def __init__(self, results_folder: str, fsync: bool = True,
+                 compact_min: int = DEFAULT_JOURNAL_COMPACT_MIN):
+        super().__init__(results_folder)
+        self.journal_file = get_journal_file(results_folder)
+        self._fsync = fsync
+        self._compact_min = compact_min
+
+        self.jobs = dict()  # type: Dict[int, dict]
+        self._buffer = []  # type: List[str]
+        self._no_lines = 0
+
+        self._load()
+        self._file = open(self.journal_file, "a")
+
+    def _apply(self, record: dict) -> None:
+        command_id = record["id"]
+        job = self.jobs.get(command_id)
+        if job is None:
+            self.jobs[command_id] = job = dict({"state": None, "data": None,
+                                                "times": dict(), "info": dict()})
+
+        job["state"] = record["s"]
+        self.known_ids.add(command_id)
+        if record["s"] != STATE_QUE:
+            self.processed_ids.add(command_id)
+        else:
+            self.processed_ids.discard(command_id)
+        if record.get("d") is not None:
+            job["data"] = record["d"]
+        job["times"].update(record.get("tm", {record["s"]: record["t"]}))
+        job["info"].update(record.get("i", {}))
+
+    def _load(self) -> None:
+        if not os.path.isfile(self.journal_file):
+            return
+
+        with open(self.journal_file, "r") as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # Partially written last line (e.g. crash while writing)
+                    logger.warning(f"[QueJournal] Skipping corrupt journal line: {line}")
+                    continue
+                self._apply(record)
+                self._no_lines += 1
+
+    def append(self, command_id: int, state: str, data: dict = None, **info) -> None:
+        record = dict({"t": time.time(), "id": int(command_id), "s": state})
+        if data is not None:
+            record["d"] = data
+        if len(info) > 0:
+            record["i"] = info
+
+        # Keep json types in memory as well (same as after load)
+        line = json.dumps(record, default=json_default)
+        prev_job = self.jobs.get(record["id"])
+        self._changed(state, None if prev_job is None else prev_job["state"])
+        self._apply(json.loads(line))
+        self._buffer.append(line + "\n")
+
+    def flush(self) -> None:
+        """ Write buffered records with a single write + fsync """
+        if len(self._buffer) <= 0:
+            return
+
+        self._file.write("".join(self._buffer))
+        self._file.flush()
+        if self._fsync:
+            os.fsync(self._file.fileno())
+
+        self._no_lines += len(self._buffer)
+        self._buffer = []
+
+    def job(self, command_id: int) -> dict:
+        return self.jobs.get(int(command_id))
+
+    def jobs_in_state(self, states: List[str], ever: bool = False) -> List[dict]:
+        if ever:
+            return [job for job in self.jobs.values() if any(s in job["times"] for s in states)]
+        return [job for job in self.jobs.values() if job["state"] in states]
+
+    def count_by_state(self) -> Dict[str, int]:
+        counts = dict()
+        for job in self.jobs.values():
+            counts[job["state"]] = counts.get(job["state"], 0) + 1
+        return counts
+
+    def queued_by_priority(self, limit: int = None) -> List[dict]:
+        queued = [job["data"] for job in self.jobs_in_state([STATE_QUE])]
+        return sorted(queued, key=lambda x: x["que_priority"])[:limit]
+
+    def maybe_compact(self) -> bool:
+        if self._no_lines < max(self._compact_min, 2 * len(self.jobs)):
+            return False
+        self.compact()
+        return True
+
+    def compact(self) -> None:
+        """ Rewrite journal with one line per job (atomic rename) and regenerate views """
+        self.flush()
+
+        tmp_file = self.journal_file + ".tmp"
+        with open(tmp_file, "w") as f:
+            for command_id, job in self.jobs.items():
+                record = dict({"t": job["times"].get(job["state"], time.time()), "id": command_id,
+                               "s": job["state"], "d": job["data"], "tm": job["times"],
+                               "i": job["info"]})
+                f.write(json.dumps(record, default=json_default) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+
+        self._file.close()
+        os.replace(tmp_file, self.journal_file)
+        self._file = open(self.journal_file, "a")
+        self._no_lines = len(self.jobs)
+
+        self.write_views()
+
+    def close(self) -> None:
+        self.flush()
+        self._file.close()
@@ -0,0 +1,158 @@
+import os
+import time
+import fcntl
+
+from remote_que.config import get_lock_file, DEFAULT_LOCK_TIMEOUT, DEFAULT_LOCK_POLL
+
+
+class QueLockTimeout(TimeoutError):
+    def __init__(self, lock_file: str, owner_pid: int):
+        self.lock_file = lock_file
+        self.owner_pid = owner_pid
+
+        owner = "unknown owner"
+        if owner_pid is not None:
+            alive = "alive" if pid_alive(owner_pid) else "dead (lock inherited by a child proc)"
+            owner = f"owner PID {owner_pid} - {alive}"
+        super().__init__(f"Could not acquire lock {lock_file} ({owner})")
+
+
+def pid_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+# Locks held by this process (lock file -> QueLock) - nested acquisitions are reentrant (an
+# exclusive lock covers nested shared ones, the other way around is refused - see acquire)
+_held_locks = dict()
+
+
+class QueLock:
+    """ Advisory fcntl.flock lock on a lock file - shared for readers, exclusive for writers.
+
+        The lock is released by the kernel if the owner dies, so it can never stay locked by a
+        dead process. The PID of the exclusive owner is written in the lock file (for
+        diagnostics - see QueLockTimeout).
+
+        with QueLock(lock_file, exclusive=True, timeout=10):
+            ...
+    """
+    def __init__(self, lock_file: str, exclusive: bool = True,
+                 timeout: float = DEFAULT_LOCK_TIMEOUT, poll: float = DEFAULT_LOCK_POLL):
+        self.lock_file = lock_file
+        self.exclusive = exclusive
+        self.timeout = timeout
+        self.poll = poll
+
+        self._fd = None
+        self._depth = 0
+        self._parent = None  # type: QueLock
+
+    def _flock(self, exclusive: bool) -> None:
+        operation = (fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH) | fcntl.LOCK_NB
+        start_time = time.monotonic()
+        poll = min(self.poll, 0.001)
+
+        while True:
+            try:
+                fcntl.flock(self._fd, operation)
+                return
+            except BlockingIOError:
+                if self.timeout is not None and time.monotonic() - start_time >= self.timeout:
+                    raise QueLockTimeout(self.lock_file, self.owner())
+
+            # Back off up to poll seconds between attempts
+            time.sleep(poll)
+            poll = min(poll * 2, self.poll)
+
+    def acquire(self) -> "QueLock":
+        held = _held_locks.get(self.lock_file)
+        if held is not None and held is not self:
+            # Reentrant. No shared -> exclusive upgrade: flock converts a lock by releasing it
+            # first (not atomic - another writer may get in between & invalidate what was read)
+            if self.exclusive and not held.exclusive:
+                raise RuntimeError(f"Cannot take exclusive lock {self.lock_file} while holding "
+                                   f"it shared - acquire it exclusive first")
+            held._depth += 1
+            self._parent = held
+            return self
+
+        if self._fd is None:
+            self._fd = os.open(self.lock_file, os.O_RDWR | os.O_CREAT | os.O_CLOEXEC, 0o666)
+            try:
+                self._flock(self.exclusive)
+            except BaseException:
+                os.close(self._fd)
+                self._fd = None
+                raise
+
+            if self.exclusive:
+                os.ftruncate(self._fd, 0)
+                os.pwrite(self._fd, str(os.getpid()).encode(), 0)
+
+            _held_locks[self.lock_file] = self
+
+        self._depth += 1
+        return self
+
+    def release(self) -> None:
+        if self._parent is not None:
+            self._parent._depth -= 1
+            self._parent = None
+            return
+
+        if self._fd is None:
+            return
+
+        self._depth -= 1
+        if self._depth > 0:
+            return
+
+        _held_locks.pop(self.lock_file, None)
+        fcntl.flock(self._fd, fcntl.LOCK_UN)
+        os.close(self._fd)
+        self._fd = None
+
+    @property
+    def locked(self) -> bool:
+        return self._fd is not None or self._parent is not None
+
+    def owner(self) -> int:
+        """ PID of last exclusive owner (None if unknown) """
+        try:
+            with open(self.lock_file, "r") as f:
+                return int(f.read().strip())
+        except (OSError, ValueError):
+            return None
+
+    def is_held_by_other(self) -> bool:
+        """ Check (non-blocking) if another process holds the lock exclusively """
+        if self.lock_file in _held_locks:
+            return False
+
+        fd = os.open(self.lock_file, os.O_RDWR | os.O_CREAT | os.O_CLOEXEC, 0o666)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_SH | fcntl.LOCK_NB)
+            fcntl.flock(fd, fcntl.LOCK_UN)
+            return False
+        except BlockingIOError:
+            return True
+        finally:
+            os.close(fd)
+
+    def __enter__(self) -> "QueLock":
+        return self.acquire()
+
+    def __exit__(self, exc_type, exc_val, exc_tb) -> None:
+        self.release()
+
+
+def que_lock(results_folder: str, exclusive: bool = True,
+             timeout: float = DEFAULT_LOCK_TIMEOUT) -> QueLock:
+    """ Lock of the que file. Exclusive for writers, shared for readers """
+    return QueLock(get_lock_file(results_folder), exclusive=exclusive, timeout=timeout)
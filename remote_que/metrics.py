@@ -0,0 +1,164 @@
+import os
+import json
+import time
+import asyncio
+import bisect
+from contextlib import contextmanager
+from typing import List, Dict, Tuple
+
+from remote_que.logger import logger
+from remote_que.config import STAGE_BUCKETS, JOB_TIME_BUCKETS
+
+
+METRICS_PREFIX = "remote_que"
+
+
+class Histogram:
+    """ Cumulative histogram (Prometheus style buckets - upper bounds, +Inf implicit) """
+    def __init__(self, buckets: List[float]):
+        self.buckets = sorted(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.
+        self.max = 0.
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+    def cumulative(self) -> List[Tuple[str, int]]:
+        """ (upper bound, no. of values <= upper bound) """
+        total, result = 0, []
+        for bound, count in zip(self.buckets + ["+Inf"], self.counts):
+            total += count
+            result.append((str(bound), total))
+        return result
+
+    def stats(self) -> dict:
+        return dict({"count": self.count, "sum": self.sum, "max": self.max,
+                     "mean": self.sum / self.count if self.count > 0 else 0.})
+
+
+class Metrics:
+    """ Que manager counters, gauges, stage timings (spans) & job time histograms.
+
+        Exposed as Prometheus text (render - served by serve()) and as a json stats file
+        (write_stats - also with the last output lines of running jobs, see tails).
+    """
+    def __init__(self):
+        self.start_time = time.time()
+        self.counters = dict()  # type: Dict[str, int]
+        self.gauges = dict()  # type: Dict[str, float]
+        self.stages = dict()  # type: Dict[str, Histogram]
+        self.job_times = dict({
+            "queue_wait": Histogram(JOB_TIME_BUCKETS),
+            "run_time": Histogram(JOB_TIME_BUCKETS),
+        })
+        self.tails = dict()  # type: Dict[int, List[str]]  # command_id: last output lines
+        self._server = None  # type: asyncio.AbstractServer
+
+    def inc(self, name: str, value: int = 1) -> None:
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    def set(self, name: str, value: float) -> None:
+        self.gauges[name] = value
+
+    def observe_stage(self, stage: str, duration: float) -> None:
+        histogram = self.stages.get(stage)
+        if histogram is None:
+            histogram = self.stages[stage] = Histogram(STAGE_BUCKETS)
+        histogram.observe(duration)
+
+    def observe_job(self, name: str, duration: float) -> None:
+        self.job_times[name].observe(duration)
+
+    @contextmanager
+    def span(self, stage: str):
+        """ Time a stage of the que loop (wall clock, also valid around awaits) """
+        st = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe_stage(stage, time.perf_counter() - st)
+
+    def stats(self) -> dict:
+        return dict({
+            "time": time.time(),
+            "uptime": time.time() - self.start_time,
+            "counters": dict(self.counters),
+            "gauges": dict(self.gauges),
+            "stages": {k: v.stats() for k, v in self.stages.items()},
+            "job_times": {k: v.stats() for k, v in self.job_times.items()},
+            "tails": {str(k): v for k, v in self.tails.items()},
+        })
+
+    def write_stats(self, stats_file: str) -> None:
+        """ Atomically (re)write the json stats file """
+        tmp_file = stats_file + ".tmp"
+        with open(tmp_file, "w") as f:
+            json.dump(self.stats(), f, indent=2)
+        os.replace(tmp_file, stats_file)
+
+    def render(self) -> str:
+        """ Prometheus text exposition format """
+        p = METRICS_PREFIX
+        lines = [f"# TYPE {p}_uptime_seconds gauge",
+                 f"{p}_uptime_seconds {time.time() - self.start_time:.3f}"]
+
+        for name, value in sorted(self.counters.items()):
+            lines += [f"# TYPE {p}_{name}_total counter", f"{p}_{name}_total {value}"]
+
+        for name, value in sorted(self.gauges.items()):
+            lines += [f"# TYPE {p}_{name} gauge", f"{p}_{name} {value}"]
+
+        def _histogram(name: str, histogram: Histogram, labels: str = "") -> List[str]:
+            sep = "," if len(labels) > 0 else ""
+            result = [f'{name}_bucket{{{labels}{sep}le="{bound}"}} {count}'
+                      for bound, count in histogram.cumulative()]
+            labels = f"{{{labels}}}" if len(labels) > 0 else ""
+            return result + [f"{name}_sum{labels} {histogram.sum:.6f}",
+                             f"{name}_count{labels} {histogram.count}"]
+
+        if len(self.stages) > 0:
+            lines.append(f"# TYPE {p}_stage_seconds histogram")
+        for stage, histogram in sorted(self.stages.items()):
+            lines += _histogram(f"{p}_stage_seconds", histogram, f'stage="{stage}"')
+
+        for name, histogram in self.job_times.items():
+            lines.append(f"# TYPE {p}_job_{name}_seconds histogram")
+            lines += _histogram(f"{p}_job_{name}_seconds", histogram)
+
+        return "\n".join(lines) + "\n"
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        try:
+            request = await asyncio.wait_for(reader.readline(), 5)
+            parts = request.decode(errors="replace").split()
+            if len(parts) >= 2 and parts[1].split("?")[0] in ("/", "/metrics"):
+                status, body, content_type = "200 OK", self.render(), "text/plain; version=0.0.4"
+            elif len(parts) >= 2 and parts[1].split("?")[0] == "/stats":
+                status, body, content_type = "200 OK", json.dumps(self.stats()), \
+                                             "application/json"
+            else:
+                status, body, content_type = "404 Not Found", "", "text/plain"
+
+            body = body.encode()
+            writer.write(f"HTTP/1.0 {status}\r\nContent-Type: {content_type}\r\n"
+                         f"Content-Length: {len(body)}\r\n\r\n".encode() + body)
+            await writer.drain()
+        except (asyncio.TimeoutError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self, port: int, host: str = "127.0.0.1") -> None:
+        """ Serve /metrics (Prometheus text) & /stats (json) on the running loop """
+        self._server = await asyncio.start_server(self._handle, host, port)
+        logger.info(f"Metrics endpoint: http://{host}:{port}/metrics")
+
+    def close(self) -> None:
+        if self._server is not None:
+            self._server.close()
+            self._server = None
@@ -0,0 +1,203 @@
+import os
+import re
+import gzip
+import shutil
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, NamedTuple
+
+from remote_que.logger import logger
+from remote_que.config import DEFAULT_OUTPUT_MAX_BYTES, DEFAULT_OUTPUT_KEEP
+from remote_que.config import DEFAULT_OUTPUT_COMPRESS, OUTPUT_COMPRESSIONS
+from remote_que.config import DEFAULT_OUTPUT_TAIL_LINES
+
+
+COMPRESSED_SUFFIX = dict({"gzip": ".gz", "zstd": ".zst"})
+TAIL_BLOCK = 1 << 16  # bytes per read of the tail reader
+TAIL_MAX_READ = 1 << 20  # max bytes read per poll when no watch pattern is pending
+TAIL_MAX_LINE = 4096  # bytes kept of longer lines (their end)
+
+_compress_executor = None  # type: ThreadPoolExecutor
+
+
+class OutputOptions(NamedTuple):
+    max_bytes: int = DEFAULT_OUTPUT_MAX_BYTES  # segment size (<= 0 - no rotation)
+    keep: int = DEFAULT_OUTPUT_KEEP  # closed segments kept (oldest are deleted)
+    compress: str = DEFAULT_OUTPUT_COMPRESS  # compression of closed segments
+    tail_lines: int = DEFAULT_OUTPUT_TAIL_LINES  # last lines kept in memory
+
+
+def compress_file(path: str, compress: str) -> str:
+    """ Compress path to path + suffix (removes path). Returns the compressed file path """
+    if compress == "zstd":
+        try:
+            import zstandard
+        except ImportError:
+            logger.warning("[OutputFile] zstandard not installed, using gzip")
+            compress = "gzip"
+
+    out_path = path + COMPRESSED_SUFFIX[compress]
+    with open(path, "rb") as src:
+        if compress == "zstd":
+            with open(out_path, "wb") as dst:
+                zstandard.ZstdCompressor().copy_stream(src, dst)
+        else:
+            with gzip.open(out_path, "wb") as dst:
+                shutil.copyfileobj(src, dst)
+    os.remove(path)
+    return out_path
+
+
+def remove_segment(path: str) -> None:
+    """ Remove output segment (compressed or not) """
+    for suffix in [""] + list(COMPRESSED_SUFFIX.values()):
+        if os.path.isfile(path + suffix):
+            os.remove(path + suffix)
+
+
+def _in_background(fn, *args) -> None:
+    """ Run fn in the (single) output thread - segments are compressed / removed in order """
+    global _compress_executor
+    if _compress_executor is None:
+        _compress_executor = ThreadPoolExecutor(max_workers=1,
+                                                thread_name_prefix="remote_que_output")
+    future = _compress_executor.submit(fn, *args)
+    future.add_done_callback(lambda f: f.exception() is not None and logger.warning(
+        f"[OutputFile] {fn.__name__}{args} failed ({f.exception()})"))
+
+
+class OutputTail:
+    """ Last no_lines lines of an output file in memory (bounded ring buffer), fed by poll()
+        which reads only the bytes appended since the previous poll (never waits for output).
+        If more than TAIL_MAX_READ bytes were appended, only the last ones are read - unless
+        the watch pattern (e.g. start confirmation log) was not seen yet, then all are searched.
+    """
+    def __init__(self, path: str, no_lines: int = DEFAULT_OUTPUT_TAIL_LINES, watch: str = None):
+        self.path = path
+        self.lines = deque(maxlen=max(no_lines, 0))
+        self.seen = False  # watch pattern found
+        self._watch = None if watch is None else watch.encode()
+        self._watch_tail = b""  # end of the previous read (pattern split between reads)
+        self._partial = b""  # last line (no newline yet)
+        self._fd = None
+        self._offset = 0
+
+    def poll(self) -> int:
+        """ Read output appended since the last poll. Returns the no. of bytes read """
+        if self._fd is None:
+            try:
+                self._fd = os.open(self.path, os.O_RDONLY)
+            except OSError:
+                return 0
+
+        size = os.fstat(self._fd).st_size
+        if size < self._offset:
+            self.truncated()
+        if self._watch is None and size - self._offset > TAIL_MAX_READ:
+            self._offset, self._partial = size - TAIL_MAX_READ, b""
+
+        start = self._offset
+        while self._offset < size:
+            data = os.pread(self._fd, min(TAIL_BLOCK, size - self._offset), self._offset)
+            if len(data) <= 0:
+                break
+            self._offset += len(data)
+            self._consume(data)
+        return self._offset - start
+
+    def _consume(self, data: bytes) -> None:
+        if self._watch is not None:
+            content = self._watch_tail + data
+            if self._watch in content:
+                self.seen, self._watch = True, None
+            else:
+                keep = len(self._watch) - 1
+                self._watch_tail = content[-keep:] if keep > 0 else b""
+
+        lines = (self._partial + data).split(b"\n")
+        self._partial = lines.pop()[-TAIL_MAX_LINE:]
+        self.lines.extend(line[-TAIL_MAX_LINE:].decode(errors="replace") for line in lines)
+
+    def truncated(self) -> None:
+        """ The file was truncated (rotated) - read again from its start """
+        self._offset = 0
+
+    def tail(self, no_lines: int = None) -> List[str]:
+        """ Last no_lines lines (all kept if None), the last one may be incomplete """
+        no_lines = self.lines.maxlen if no_lines is None else min(no_lines, self.lines.maxlen)
+        lines = list(self.lines)
+        if len(self._partial) > 0:
+            lines.append(self._partial.decode(errors="replace"))
+        return lines[max(len(lines) - no_lines, 0):]
+
+    def close(self) -> None:
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+
+class OutputFile:
+    """ Output stream file of a proc (path), written directly by the proc - it does not
+        depend on the que manager (or node agent) staying alive.
+
+        The file is opened in append mode, so it can be rotated in place (copy-truncate):
+        rotate copies it to path.<n> once it reached max_bytes and truncates it - the proc
+        keeps writing from the start of the file. Output written between the copy and the
+        truncate is lost. Closed segments are optionally compressed (in a background thread)
+        and only the last keep are kept.
+
+        The last lines are kept in memory by tail (OutputTail, polled by rotate - also right
+        before the file is truncated), so nothing that was rotated is missing from it.
+    """
+    def __init__(self, path: str, options: OutputOptions = None, watch: str = None):
+        options = OutputOptions() if options is None else options
+        assert options.compress in OUTPUT_COMPRESSIONS, \
+            f"Unknown output compression {options.compress} ({OUTPUT_COMPRESSIONS})"
+        self.path = path
+        self.options = options
+        self.tail = OutputTail(path, options.tail_lines, watch=watch)
+        self._segment = self._last_segment()
+
+    def _last_segment(self) -> int:
+        """ Last rotated segment (of a proc reattached after a que manager restart) """
+        folder, name = os.path.split(self.path)
+        pattern = re.compile(re.escape(name) + r"\.(\d+)(\.gz|\.zst)?$")
+        segments = [int(m.group(1)) for m in map(pattern.match, os.listdir(folder or "."))
+                    if m is not None]
+        return max(segments, default=0)
+
+    def open(self, append: bool = False) -> int:
+        """ File descriptor for the proc stdout / stderr (truncated unless append) - close it
+            once the proc has its copy """
+        flags = os.O_WRONLY | os.O_CREAT | os.O_APPEND | (0 if append else os.O_TRUNC)
+        return os.open(self.path, flags, 0o644)
+
+    def rotate(self) -> bool:
+        """ Read new output into the tail & rotate the file if it reached max_bytes. Returns
+            True if rotated """
+        self.tail.poll()
+        if self.options.max_bytes <= 0:
+            return False
+        try:
+            if os.path.getsize(self.path) < self.options.max_bytes:
+                return False
+        except FileNotFoundError:
+            return False
+
+        self._segment += 1
+        segment_path = f"{self.path}.{self._segment}"
+        with open(self.path, "rb") as src, open(segment_path, "wb") as dst:
+            shutil.copyfileobj(src, dst)
+            self.tail.poll()
+            os.truncate(self.path, 0)
+        self.tail.truncated()
+
+        # Oldest segment out of keep is removed
+        old = self._segment - self.options.keep
+        if self.options.compress != "none":
+            _in_background(compress_file, segment_path, self.options.compress)
+            if old > 0:
+                _in_background(remove_segment, f"{self.path}.{old}")
+        elif old > 0:
+            remove_segment(f"{self.path}.{old}")
+        return True
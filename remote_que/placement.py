@@ -0,0 +1,718 @@
+import time
+from typing import List, Iterable, Tuple, NamedTuple, Any, Dict, Callable, Optional
+import numpy as np
+import pandas as pd
+
+from remote_que.config import DEFAULT_RESOURCE, DEFAULT_PACKING, PACKING_STRATEGIES
+from remote_que.config import DEFAULT_BACKFILL
+from remote_que.logger import logger
+from remote_que.telemetry import GpuSnapshot
+
+
+class Placement(NamedTuple):
+    que_idx: Any
+    machine: str
+    gpus: List[str]  # GPU indexes (str - nvgpu format)
+    rows: np.ndarray  # GpuState rows
+    cpus: Optional[List[int]] = None  # CPU cores the proc is pinned to (None - not pinned)
+
+
+class CpuState:
+    """ Free CPU cores (per NUMA node) & host memory of machines with a known CPU topology
+        (see TelemetryBackend.cpu_topology). Only que procs are accounted (use) - other load on
+        the machines is not sampled. Machines with unknown topology do not limit placement.
+    """
+    def __init__(self, topology: Dict[str, dict]):
+        self.free = {machine: {node: set(cpus) for node, cpus in t["numa"].items()}
+                     for machine, t in topology.items()}  # machine -> NUMA node -> free cores
+        self.no_free = {machine: sum(len(cpus) for cpus in nodes.values())
+                        for machine, nodes in self.free.items()}
+        self.mem_free = {machine: float(t["mem_total"]) if t["mem_total"] > 0 else np.inf
+                         for machine, t in topology.items()}
+        self.gpu_numa = {machine: t.get("gpu_numa", dict()) for machine, t in topology.items()}
+
+    def fits(self, machine: str, no_cpus: int, mem: float) -> bool:
+        if machine not in self.free:
+            return True
+        return no_cpus <= self.no_free[machine] and mem <= self.mem_free[machine]
+
+    def use(self, machine: str, cpus: Optional[List[int]], mem: float) -> None:
+        """ Cores & host memory (MiB, <= 0 - none) taken by a running que proc """
+        if machine not in self.free:
+            return
+
+        for node_cpus in self.free[machine].values():
+            taken = node_cpus.intersection(cpus or [])
+            node_cpus.difference_update(taken)
+            self.no_free[machine] -= len(taken)
+        self.mem_free[machine] -= max(mem, 0)
+
+    def allocate(self, machine: str, no_cpus: int, mem: float,
+                 gpus: List[str]) -> Optional[List[int]]:
+        """ Take no_cpus cores (NUMA nodes of the proc GPUs first, then nodes with most free
+            cores) & host memory. Returns the cores (None if not pinned - unknown topology or
+            no cores requested) """
+        if machine not in self.free:
+            return None
+
+        self.mem_free[machine] -= max(mem, 0)
+        if no_cpus <= 0:
+            return None
+
+        nodes = self.free[machine]
+        gpu_nodes = [self.gpu_numa[machine].get(str(gpu)) for gpu in gpus]
+        cpus = []
+        for node in sorted(nodes, key=lambda n: (-gpu_nodes.count(n), -len(nodes[n]), n)):
+            taken = sorted(nodes[node])[:no_cpus - len(cpus)]
+            nodes[node].difference_update(taken)
+            cpus += taken
+            if len(cpus) >= no_cpus:
+                break
+
+        self.no_free[machine] -= len(cpus)
+        return sorted(cpus)
+
+    def machine_mask(self, machine_names: List[str], no_cpus: int, mem: float) -> np.ndarray:
+        """ Machines (by code) with no_cpus free cores & mem free host memory """
+        return np.array([self.fits(machine, no_cpus, mem) for machine in machine_names],
+                        dtype=bool)
+
+
+class GpuState:
+    """ Compact array view of a GpuSnapshot, used to place a whole que in one pass """
+    def __init__(self, machine_names: List[str], machine: np.ndarray, index: np.ndarray,
+                 mem_free: np.ndarray, proc_count: np.ndarray,
+                 topology: Dict[int, Tuple[np.ndarray, np.ndarray]] = None,
+                 cpu: CpuState = None):
+        self.machine_names = machine_names
+        self.machine = machine  # machine code of each GPU (position in machine_names)
+        self.index = index
+        self.mem_free = mem_free
+        self.proc_count = proc_count
+        self.blocked = np.zeros(len(index), dtype=bool)
+        self._no_blocked = 0
+
+        # Procs & expected memory placed on each GPU in this pass (untouched - nothing placed)
+        self.placed = np.zeros(len(index), dtype=np.int64)
+        self.used_mem = np.zeros(len(index), dtype=np.float64)
+        self.untouched = np.ones(len(index), dtype=bool)
+
+        # machine code -> (GPU rows, link cost matrix between them)
+        self.topology = dict() if topology is None else topology
+
+        # CPU cores & host memory (None - CPU topology of all machines unknown)
+        self.cpu = cpu
+
+        # Rolling SM & memory bandwidth utilization (%) of each GPU (NaN - unknown)
+        self.sm_util = np.full(len(index), np.nan)
+        self.mem_util = np.full(len(index), np.nan)
+
+        # Backfill - predicted end times of que procs on each GPU & reservations for blocked
+        # jobs (time until which reserved GPUs may only be used by procs that end before it)
+        self.releases = [[] for _ in range(len(index))]  # type: List[List[float]]
+        self.reserved_until = np.full(len(index), np.inf)
+        self.no_reserved = 0
+
+        self._masks = dict()
+
+    @classmethod
+    def from_snapshot(cls, snapshot: GpuSnapshot) -> "GpuState":
+        gpus = snapshot.gpus
+        machine, machine_names = pd.factorize(gpus["machine"])
+        proc_count = gpus["unique_gpu"].map(snapshot.proc_counts).fillna(0)
+        index = gpus["index"].to_numpy(dtype=object)
+
+        topology = dict()
+        for code, name in enumerate(machine_names):
+            link_costs = snapshot.topology.get(name)
+            if link_costs is None:
+                continue
+
+            rows = np.flatnonzero(machine == code)
+            cost = np.full((len(rows), len(rows)), float(max(link_costs.values(), default=0)))
+            for i, ri in enumerate(rows):
+                for j, rj in enumerate(rows):
+                    cost[i, j] = 0 if i == j else link_costs.get((index[ri], index[rj]),
+                                                                 cost[i, j])
+            topology[code] = (rows, cost)
+
+        # Machines without GPUs can run CPU only procs (no GPU rows)
+        machine_names = list(machine_names)
+        machine_names += [m for m in snapshot.cpu_topology if m not in machine_names]
+        cpu = CpuState(snapshot.cpu_topology) if len(snapshot.cpu_topology) > 0 else None
+
+        return cls(machine_names, machine.astype(np.int64), index,
+                   gpus["mem_free"].to_numpy(dtype=np.int64, copy=True),
+                   proc_count.to_numpy(dtype=np.int64, copy=True), topology, cpu)
+
+    @property
+    def no_free(self) -> int:
+        return len(self.blocked) - self._no_blocked
+
+    def resource_mask(self, resource: dict) -> np.ndarray:
+        """ GPUs matching resource filters (same filters as ResourceAvailability). These do not
+            change during a pass so they are computed once per distinct resource request.
+        """
+        key = (resource["preferred_gpu"], resource["max_procs_on_gpu"], resource["min_free_mem"],
+               resource["max_gpu_util"], resource["max_mem_bw_util"], resource["no_gpus"])
+        mask = self._masks.get(key)
+        if mask is not None:
+            return mask
+
+        mask = self.gpu_mask(resource).copy()
+
+        # Select machines with a minimum of resource["no_gpus"] available
+        machine_cnt = np.bincount(self.machine[mask], minlength=len(self.machine_names))
+        mask &= (machine_cnt >= resource["no_gpus"])[self.machine]
+
+        self._masks[key] = mask
+        return mask
+
+    def gpu_mask(self, resource: dict) -> np.ndarray:
+        """ GPUs matching per GPU resource filters (no. of GPUs per machine not checked) """
+        key = (resource["preferred_gpu"], resource["max_procs_on_gpu"], resource["min_free_mem"],
+               resource["max_gpu_util"], resource["max_mem_bw_util"])
+        mask = self._masks.get(key)
+        if mask is not None:
+            return mask
+
+        mask = np.ones(len(self.index), dtype=bool)
+
+        if resource["preferred_gpu"] != -1:
+            mask &= self.index == str(resource["preferred_gpu"])
+
+        if resource["max_procs_on_gpu"] > 0:
+            mask &= self.proc_count <= resource["max_procs_on_gpu"]
+
+        if resource["min_free_mem"] > 0:
+            mask &= self.mem_free > resource["min_free_mem"]
+
+        # GPUs with unknown utilization are used only if no procs run on them
+        for util, max_util in [(self.sm_util, resource["max_gpu_util"]),
+                               (self.mem_util, resource["max_mem_bw_util"])]:
+            if max_util >= 0:
+                mask &= (util <= max_util) | (np.isnan(util) & (self.proc_count <= 0))
+
+        self._masks[key] = mask
+        return mask
+
+    def _rows(self) -> Dict[Tuple[str, str], int]:
+        """ (machine, GPU index) -> row """
+        return {(self.machine_names[m], i): r for r, (m, i) in
+                enumerate(zip(self.machine, self.index))}
+
+    def track_procs(self, procs: Dict[Tuple[str, str], int]) -> None:
+        """ No. of que procs running on each (machine, GPU index). GPUs count at least these
+            procs, also before they show up in telemetry (e.g. still loading, or reattached
+            after a que manager restart). Call before placing """
+        rows = self._rows()
+        for unique_gpu, count in procs.items():
+            if unique_gpu in rows:
+                row = rows[unique_gpu]
+                self.proc_count[row] = max(self.proc_count[row], count)
+
+    def release(self, machine: str, gpus: List[str], mem: float = 0.) -> None:
+        """ A running que proc on (machine, GPU indexes) is preempted - not counted on its GPUs
+            in the rest of the pass, mem (MiB per GPU) is freed (0 - suspended proc, its memory
+            is still held) """
+        rows = self._rows()
+        select = [rows[(machine, str(gpu))] for gpu in gpus if (machine, str(gpu)) in rows]
+        self.proc_count[select] -= 1
+        self.mem_free[select] += int(mem)
+        self._masks.clear()
+
+    def can_resume(self, machine: str, gpus: List[str], resource: dict) -> bool:
+        """ A suspended proc (still counted on its GPUs - see track_procs) matches its
+            max_procs_on_gpu again & nothing was placed on its GPUs in this pass (its memory is
+            still held - min_free_mem is not checked) """
+        rows = self._rows()
+        if any((machine, str(gpu)) not in rows for gpu in gpus):
+            return False
+
+        select = np.array([rows[(machine, str(gpu))] for gpu in gpus], dtype=np.int64)
+        max_procs = resource.get("max_procs_on_gpu", DEFAULT_RESOURCE["max_procs_on_gpu"])
+        if not self.untouched[select].all():
+            return False
+        return max_procs <= 0 or bool((self.proc_count[select] - 1 <= max_procs).all())
+
+    def track_utilization(self, utilization: Dict[Tuple[str, str], Tuple[float, float]]) -> None:
+        """ Rolling (SM %, memory bandwidth %) per (machine, GPU index) - see
+            UtilizationSampler.utilization. Call before placing """
+        rows = self._rows()
+        for unique_gpu, (sm_util, mem_util) in utilization.items():
+            if unique_gpu in rows:
+                self.sm_util[rows[unique_gpu]] = sm_util
+                self.mem_util[rows[unique_gpu]] = mem_util
+        self._masks.clear()
+
+    def track_cpus(self, procs: Iterable[Tuple[str, Optional[List[int]], float]]) -> None:
+        """ (machine, pinned cores, host memory) of running que procs. Call before placing """
+        if self.cpu is not None:
+            for machine, cpus, mem in procs:
+                self.cpu.use(machine, cpus, mem)
+
+    def set_releases(self, releases: Dict[Tuple[str, str], List[float]]) -> None:
+        """ Predicted end times of que procs running on each (machine, GPU index) """
+        rows = self._rows()
+        for unique_gpu, end_times in releases.items():
+            if unique_gpu in rows:
+                self.releases[rows[unique_gpu]] = sorted(end_times)
+
+    def eligible_at(self, resource: dict, now: float) -> np.ndarray:
+        """ Predicted time each GPU will match resource (inf if never / unknown) - when enough
+            que procs running on it end """
+        mask = self.gpu_mask(resource)
+        eligible = np.full(len(self.index), np.inf)
+        eligible[mask] = now
+
+        for row in np.flatnonzero(~mask):
+            preferred_gpu = resource["preferred_gpu"]
+            if preferred_gpu != -1 and self.index[row] != str(preferred_gpu):
+                continue
+
+            end_times = self.releases[row]
+            needed = 0
+            if resource["max_procs_on_gpu"] > 0:
+                needed = self.proc_count[row] - resource["max_procs_on_gpu"]
+
+            # Memory freed by procs is not known - wait for all que procs on the GPU
+            if resource["min_free_mem"] > 0 and self.mem_free[row] <= resource["min_free_mem"]:
+                needed = len(end_times) if len(end_times) > 0 else np.inf
+
+            if 0 < needed <= len(end_times):
+                eligible[row] = max(now, end_times[int(needed) - 1])
+
+        return eligible
+
+    def reserve(self, resource: dict, now: float) -> float:
+        """ Reserve GPUs for a blocked request on the machine where it can start the earliest.
+            Returns the reservation (shadow) time - inf if it cannot be predicted.
+        """
+        no_gpus = resource["no_gpus"]
+        eligible = self.eligible_at(resource, now)
+
+        # GPUs are reserved for one job only
+        eligible[np.isfinite(self.reserved_until)] = np.inf
+
+        best_time, best_rows = np.inf, None
+        for machine in np.unique(self.machine):
+            rows = np.flatnonzero(self.machine == machine)
+            if len(rows) < no_gpus:
+                continue
+
+            rows = rows[np.argsort(eligible[rows], kind="stable")[:no_gpus]]
+            shadow_time = eligible[rows[-1]]
+            if shadow_time < best_time:
+                best_time, best_rows = shadow_time, rows
+
+        if best_rows is not None and np.isfinite(best_time):
+            self.reserved_until[best_rows] = best_time
+            self.no_reserved += len(best_rows)
+        return best_time
+
+    def place(self, resource: dict, rng=np.random, runtime: float = None, now: float = 0.,
+              mem: float = None, strategy: str = DEFAULT_PACKING,
+              machine: int = None) -> Tuple[int, np.ndarray]:
+        """ Select GPUs for one request (see select) and block them. Jobs with a known memory
+            footprint (mem) can share a GPU with procs placed in the same pass while the memory
+            fits. Reserved GPUs are used only if the request is predicted to end (runtime None -
+            unknown) before the reservation. Only machines with the requested CPU cores & host
+            memory free are used (CPUs are allocated by place_que), only GPUs of machine (code)
+            if given. Returns machine code &
+            selected rows (empty if nothing is available or for CPU only requests - machine
+            -1 if nothing is available).
+        """
+        no_gpus = resource["no_gpus"]
+        empty = np.zeros(0, dtype=np.int64)
+
+        if no_gpus <= 0:
+            return self.place_cpu(resource, strategy, rng), empty
+
+        if mem is None:
+            # Unknown footprint -> GPU not shared with procs placed in this pass
+            available = self.resource_mask(resource) & self.untouched
+        else:
+            available = self.resource_mask(resource) & ~self.blocked
+            available &= self.mem_free - self.used_mem > max(mem, resource["min_free_mem"])
+            if resource["max_procs_on_gpu"] > 0:
+                available &= self.proc_count + self.placed <= resource["max_procs_on_gpu"]
+            if resource["max_gpu_util"] >= 0 or resource["max_mem_bw_util"] >= 0:
+                # Utilization of procs placed in this pass is not known yet
+                available &= self.untouched
+
+        if machine is not None:
+            available &= self.machine == machine
+
+        if self.no_reserved > 0:
+            end_time = np.inf if runtime is None else now + runtime
+            available &= end_time <= self.reserved_until
+
+        if self.cpu is not None and (resource["cpus"] > 0 or resource["host_mem"] > 0):
+            available &= self.cpu.machine_mask(self.machine_names, resource["cpus"],
+                                               resource["host_mem"])[self.machine]
+
+        rows = np.flatnonzero(available)
+        if len(rows) <= 0:
+            return -1, empty
+
+        machine, select = self.select(rows, no_gpus, mem, strategy, rng)
+        if machine < 0:
+            return -1, empty
+        if len(select) != no_gpus:
+            logger.warning(f"[ERROR] Selecting available gpus did not work "
+                           f"{self.index[rows]} - {no_gpus}")
+            return -1, empty
+
+        self.placed[select] += 1
+        self.untouched[select] = False
+        if mem is None:
+            block = select
+        else:
+            self.used_mem[select] += mem
+            block = select[self.mem_free[select] - self.used_mem[select] <= 0]
+        self._no_blocked += int((~self.blocked[block]).sum())
+        self.blocked[block] = True
+
+        return machine, select
+
+    def place_cpu(self, resource: dict, strategy: str = DEFAULT_PACKING, rng=np.random) -> int:
+        """ Machine code for a CPU only request (-1 if none has the CPU cores & host memory).
+            Machines by free cores: fewest (best-fit / pack), most (spread) or random """
+        if self.cpu is None:
+            codes = np.arange(len(self.machine_names))
+        else:
+            codes = np.flatnonzero(self.cpu.machine_mask(self.machine_names, resource["cpus"],
+                                                         resource["host_mem"]))
+        if len(codes) <= 0:
+            return -1
+        if strategy == "random":
+            return int(rng.choice(codes))
+
+        no_free = np.array([np.inf if self.cpu is None else
+                            self.cpu.no_free.get(self.machine_names[c], np.inf) for c in codes])
+        return int(codes[np.argmax(no_free) if strategy == "spread" else np.argmin(no_free)])
+
+    def select(self, rows: np.ndarray, no_gpus: int, mem: float = None,
+               strategy: str = DEFAULT_PACKING, rng=np.random) -> Tuple[int, np.ndarray]:
+        """ Pick no_gpus of the available rows (all on one machine) by packing strategy:
+                random      random machine, first GPUs on it
+                best-fit    GPUs left with the least free memory after placing mem (spread if
+                            the footprint is unknown)
+                pack        most loaded GPUs first (keeps whole GPUs / machines free)
+                spread      least loaded GPUs, most free memory first
+            Multi GPU requests on machines with topology data prefer closely linked GPUs.
+        """
+        assert strategy in PACKING_STRATEGIES, f"Unknown packing strategy {strategy}"
+        empty = np.zeros(0, dtype=np.int64)
+        row_machines = self.machine[rows]
+
+        if strategy == "random":
+            # Machines (in order of appearance) with enough GPUs left
+            _, first, counts = np.unique(row_machines, return_index=True, return_counts=True)
+            first = first[counts >= no_gpus]
+            if len(first) <= 0:
+                return -1, empty
+            machine = rng.choice(row_machines[np.sort(first)])
+            return machine, rows[row_machines == machine][:no_gpus]
+
+        free_after = self.mem_free[rows] - self.used_mem[rows] - (0 if mem is None else mem)
+        load = self.proc_count[rows] + self.placed[rows]
+        if strategy == "best-fit" and mem is not None:
+            order = np.lexsort((load, free_after))
+        elif strategy == "pack":
+            order = np.lexsort((free_after, -load))
+        else:
+            order = np.lexsort((load, -free_after))
+        rank = np.empty(len(rows), dtype=np.int64)
+        rank[order] = np.arange(len(rows))
+
+        # Group by machine (best ranked rows first)
+        by_machine = np.lexsort((rank, row_machines))
+        sorted_machines = row_machines[by_machine]
+        starts = np.flatnonzero(np.r_[True, sorted_machines[1:] != sorted_machines[:-1]])
+        ends = np.r_[starts[1:], len(rows)]
+        enough = ends - starts >= no_gpus
+        starts, ends = starts[enough], ends[enough]
+        if len(starts) <= 0:
+            return -1, empty
+
+        # Machine score - (link cost, sum of ranks of selected GPUs)
+        cum_rank = np.r_[0, np.cumsum(rank[by_machine])]
+        scores = (cum_rank[starts + no_gpus] - cum_rank[starts]).astype(np.float64)
+        selections = [by_machine[start:start + no_gpus] for start in starts]
+        link_costs = np.zeros(len(starts))
+
+        if no_gpus > 1 and len(self.topology) > 0:
+            for i, (start, end) in enumerate(zip(starts, ends)):
+                machine = sorted_machines[start]
+                if machine not in self.topology:
+                    continue
+                selections[i], link_costs[i] = self._topology_select(
+                    machine, rows, by_machine[start:end], rank, no_gpus
+                )
+                scores[i] = rank[selections[i]].sum()
+
+        best = np.lexsort((scores, link_costs))[0]
+        select = rows[np.sort(selections[best])]
+        return sorted_machines[starts[best]], select
+
+    def _topology_select(self, machine: int, rows: np.ndarray, positions: np.ndarray,
+                         rank: np.ndarray, no_gpus: int) -> Tuple[np.ndarray, float]:
+        """ Closest linked no_gpus of rows[positions] (seeded by each GPU, nearest neighbours
+            first). Returns selected positions & total link cost """
+        topo_rows, cost = self.topology[machine]
+        topo_pos = np.searchsorted(topo_rows, rows[positions])
+        sub_cost = cost[np.ix_(topo_pos, topo_pos)]
+
+        best, best_key = None, None
+        for seed in range(len(positions)):
+            chosen = np.lexsort((rank[positions], sub_cost[seed]))[:no_gpus]
+            key = (sub_cost[np.ix_(chosen, chosen)].sum(), rank[positions[chosen]].sum())
+            if best_key is None or key < best_key:
+                best, best_key = chosen, key
+
+        return positions[best], best_key[0]
+
+
+def place_que(gpu_state: GpuState, que_resources: Iterable[Tuple[Any, dict]],
+              rng=np.random, runtimes: Callable[[Any], Optional[float]] = None,
+              max_reservations: int = 1, now: float = None,
+              memories: Callable[[Any], Optional[float]] = None,
+              strategy: str = DEFAULT_PACKING, users: Callable[[Any], str] = None,
+              gpu_caps: Callable[[str], Optional[int]] = None,
+              user_gpus: Dict[str, int] = None) -> List[Placement]:
+    """ Resolve (priority sorted) que requests <(que_idx, preferred_resource)> in one pass.
+
+        With runtimes (que_idx -> predicted runtime, None if unknown) blocked requests reserve
+        GPUs (up to max_reservations, None - no limit) and later requests are backfilled on
+        reserved GPUs only if predicted to end before the reservation (see GpuState.reserve).
+        With memories (que_idx -> predicted peak GPU memory, None if unknown) jobs are packed
+        on GPUs by strategy (see GpuState.select). With gpu_caps (user -> max GPUs, None - no
+        cap) requests of users (que_idx -> user) that would use more GPUs than their cap
+        (user_gpus - GPUs of running procs per user) are skipped.
+    """
+    placements = []
+    now = time.time() if now is None else now
+    no_reservations = 0
+    user_gpus = dict() if user_gpus is None else dict(user_gpus)
+
+    # Requests that did not fit since gpu_state last changed (large ques repeat the same ones)
+    failed = set()
+
+    for que_idx, preferred_resource in que_resources:
+        # No GPUs left to place on (only CPU only requests are placed)
+        if gpu_state.no_free <= 0 and \
+                preferred_resource.get("no_gpus", DEFAULT_RESOURCE["no_gpus"]) > 0:
+            continue
+
+        resource = DEFAULT_RESOURCE.copy()
+        resource.update(preferred_resource)
+
+        user = None
+        if gpu_caps is not None and resource["no_gpus"] > 0:
+            user = users(que_idx)
+            cap = gpu_caps(user)
+            if cap is not None and user_gpus.get(user, 0) + resource["no_gpus"] > cap:
+                continue
+
+        runtime = None if runtimes is None else runtimes(que_idx)
+        mem = None if memories is None else memories(que_idx)
+        key = (resource["preferred_gpu"], resource["max_procs_on_gpu"], resource["min_free_mem"],
+               resource["max_gpu_util"], resource["max_mem_bw_util"], resource["no_gpus"],
+               resource["cpus"], resource["host_mem"], mem,
+               runtime if gpu_state.no_reserved > 0 else None)
+        can_reserve = runtimes is not None and resource["no_gpus"] > 0 and \
+            (max_reservations is None or no_reservations < max_reservations)
+        if key in failed and not can_reserve:
+            continue
+
+        machine, rows = gpu_state.place(resource, rng=rng, runtime=runtime, now=now, mem=mem,
+                                        strategy=strategy)
+        if machine < 0:
+            if can_reserve and np.isfinite(gpu_state.reserve(resource, now)):
+                no_reservations += 1
+                failed.clear()
+            else:
+                failed.add(key)
+            continue
+        failed.clear()
+
+        machine_name, gpus = gpu_state.machine_names[machine], list(gpu_state.index[rows])
+        cpus = None
+        if gpu_state.cpu is not None:
+            cpus = gpu_state.cpu.allocate(machine_name, resource["cpus"], resource["host_mem"],
+                                          gpus)
+        placements.append(Placement(que_idx, machine_name, gpus, rows, cpus))
+        if user is not None:
+            user_gpus[user] = user_gpus.get(user, 0) + len(gpus)
+
+    return placements
+
+
+def plan_pass(gpu_state: GpuState, que_resources: Iterable[Tuple[Any, dict]],
+              estimate: Callable[[Any, str], Optional[float]] = None,
+              backfill: str = DEFAULT_BACKFILL, packing: str = DEFAULT_PACKING,
+              releases: Dict[Tuple[str, str], List[float]] = None, now: float = None,
+              rng=np.random, users: Callable[[Any], str] = None,
+              gpu_caps: Callable[[str], Optional[int]] = None,
+              user_gpus: Dict[str, int] = None) -> List[Placement]:
+    """ Placement of one que manager pass (also driven by the simulator).
+
+        estimate(que_idx, metric) predicts runtime (backfill) & gpu_mem (packing) of que
+        requests, releases are the predicted end times of running procs per (machine, GPU).
+        Per user GPU caps - see place_que.
+    """
+    runtimes, memories, max_reservations = None, None, None
+    if estimate is not None:
+        memories = lambda qi: estimate(qi, "gpu_mem")
+        if backfill != "none":
+            gpu_state.set_releases(dict() if releases is None else releases)
+            runtimes = lambda qi: estimate(qi, "runtime")
+            max_reservations = 1 if backfill == "easy" else None
+
+    return place_que(gpu_state, que_resources, rng=rng, runtimes=runtimes,
+                     max_reservations=max_reservations, now=now, memories=memories,
+                     strategy=packing, users=users, gpu_caps=gpu_caps, user_gpus=user_gpus)
+
+
+def plan_preemption(gpu_state: GpuState, que_idx: Any, resource: dict,
+                    victims: Iterable[Tuple[Any, str, List[str], float]], mem: float = None,
+                    place: bool = False, strategy: str = DEFAULT_PACKING,
+                    rng=np.random) -> Tuple[List[Any], Optional[Placement]]:
+    """ Fewest victims - running procs <(key, machine, GPU indexes, GPU memory freed per GPU)>,
+        in preemption order - on one machine whose preemption lets request que_idx (not placed
+        in this pass) be placed. Suspended victims free no memory (0 - still held on the GPU),
+        so min_free_mem / mem (predicted peak GPU memory) are only met by memory freed by
+        stopped victims.
+
+        With place, victims are released in gpu_state & the request is placed on the freed
+        GPUs (victims are suspended now). Returns victim keys (empty if preemption does not
+        help) & the placement (None if not placed).
+    """
+    resource = dict(DEFAULT_RESOURCE, **resource)
+    no_gpus = resource["no_gpus"]
+    if no_gpus <= 0:
+        return [], None
+
+    rows = gpu_state._rows()
+    by_machine = dict()  # machine -> victims
+    for key, machine, gpus, freed_mem in victims:
+        victim_rows = [rows[(machine, str(gpu))] for gpu in gpus if (machine, str(gpu)) in rows]
+        by_machine.setdefault(machine, []).append((key, gpus, victim_rows, freed_mem))
+
+    preferred = np.ones(len(gpu_state.index), dtype=bool)
+    if resource["preferred_gpu"] != -1:
+        preferred &= gpu_state.index == str(resource["preferred_gpu"])
+    min_mem = max(resource["min_free_mem"], -1 if mem is None else mem)
+
+    best, best_machine = [], None
+    for machine, machine_victims in by_machine.items():
+        if machine not in gpu_state.machine_names:
+            continue
+        code = gpu_state.machine_names.index(machine)
+        if gpu_state.cpu is not None and \
+                not gpu_state.cpu.fits(machine, resource["cpus"], resource["host_mem"]):
+            continue
+
+        machine_rows = np.flatnonzero((gpu_state.machine == code) & preferred)
+        proc_count = (gpu_state.proc_count + gpu_state.placed)[machine_rows].astype(np.float64)
+        mem_free = (gpu_state.mem_free - gpu_state.used_mem)[machine_rows].astype(np.float64)
+        position = {row: i for i, row in enumerate(machine_rows)}
+
+        chosen = []
+        for victim in machine_victims:
+            _, _, victim_rows, freed_mem = victim
+            if 0 < len(best) <= len(chosen) + 1:
+                break
+            if not any(row in position for row in victim_rows):
+                continue
+            chosen.append(victim)
+            for row in victim_rows:
+                if row in position:
+                    proc_count[position[row]] -= 1
+                    mem_free[position[row]] += freed_mem
+
+            fits = np.ones(len(machine_rows), dtype=bool)
+            if resource["max_procs_on_gpu"] > 0:
+                fits &= proc_count <= resource["max_procs_on_gpu"]
+            if min_mem > 0:
+                fits &= mem_free > min_mem
+            if fits.sum() >= no_gpus:
+                best, best_machine = list(chosen), machine
+                break
+
+    if len(best) <= 0 or not place:
+        return [key for key, _, _, _ in best], None
+
+    # Place on the freed GPUs (state is restored if the request still does not fit)
+    saved = gpu_state.proc_count.copy(), gpu_state.mem_free.copy()
+    for _, gpus, _, freed_mem in best:
+        gpu_state.release(best_machine, gpus, freed_mem)
+    machine, select = gpu_state.place(resource, rng=rng, mem=mem, strategy=strategy,
+                                      machine=gpu_state.machine_names.index(best_machine))
+    if machine < 0:
+        gpu_state.proc_count, gpu_state.mem_free = saved
+        gpu_state._masks.clear()
+        return [], None
+
+    gpus = list(gpu_state.index[select])
+    cpus = None
+    if gpu_state.cpu is not None:
+        cpus = gpu_state.cpu.allocate(best_machine, resource["cpus"], resource["host_mem"], gpus)
+    return [key for key, _, _, _ in best], Placement(que_idx, best_machine, gpus, select, cpus)
+
+
+if __name__ == "__main__":
+    # Benchmark placement of large ques on fake GPUs (most jobs wait for free memory)
+    from remote_que.telemetry import FakeBackend, GpuTelemetry
+
+    machines = [f"node{i}" for i in range(4)]
+    backend = FakeBackend(no_gpus=8)
+    telemetry = GpuTelemetry(backend, machines)
+    snapshot = telemetry.snapshot()
+
+    for no_jobs in [10, 1000, 10000]:
+        que = [(i, {"no_gpus": 1 + (i % 2), "min_free_mem": 20000 if i > 8 else -1})
+               for i in range(no_jobs)]
+
+        start = time.perf_counter()
+        state = GpuState.from_snapshot(snapshot)
+        state_time = time.perf_counter() - start
+        placed = place_que(state, que)
+        duration = time.perf_counter() - start - state_time
+        print(f"{no_jobs} jobs: {len(placed)} placed - state {state_time * 1e3:.2f} ms, "
+              f"placement {duration * 1e3:.2f} ms ({duration / no_jobs * 1e6:.2f} us / job)")
+
+    # Packing strategies - partly used GPUs (NVLinked pairs), jobs with known peak memory
+    rng = np.random.RandomState(0)
+    backend = FakeBackend(no_gpus=8, mem_total=24000, nvlink_pairs=True)
+    for m in machines:
+        for g in range(8):
+            if rng.rand() < 0.5:
+                backend.add_proc(m, g, pid=len(machines) * g + machines.index(m),
+                                 used_memory=rng.randint(1, 16) * 1000)
+    snapshot = GpuTelemetry(backend, machines).snapshot()
+
+    no_jobs = 200
+    job_mem = rng.choice([2000, 4000, 8000, 16000], size=no_jobs)
+    job_gpus = rng.choice([1, 1, 1, 2, 4], size=no_jobs)
+    que = [(i, {"no_gpus": int(job_gpus[i])}) for i in range(no_jobs)]
+
+    for strategy in PACKING_STRATEGIES:
+        state = GpuState.from_snapshot(snapshot)
+        start = time.perf_counter()
+        placed = place_que(state, que, rng=np.random.RandomState(0),
+                           memories=lambda qi: float(job_mem[qi]), strategy=strategy)
+        duration = time.perf_counter() - start
+
+        # Fragmentation - largest memory block left for a later (big) job
+        max_free = (state.mem_free - state.used_mem).max()
+        multi = [p for p in placed if len(p.rows) > 1]
+        link_cost = np.mean([
+            state.topology[state.machine[p.rows[0]]][1][np.ix_(p.rows % 8, p.rows % 8)].max()
+            for p in multi
+        ])
+        print(f"{strategy:>8}: {len(placed)} / {no_jobs} placed "
+              f"({sum(len(p.rows) for p in placed)} GPU slots) - max free GPU memory left "
+              f"{max_free:.0f} MiB - multi GPU max link cost {link_cost:.2f} - "
+              f"{duration * 1e3:.2f} ms")
@@ -0,0 +1,111 @@
+import os
+import ast
+import csv
+import hashlib
+from typing import List, Optional, Tuple, TYPE_CHECKING
+
+from remote_que.config import QUE_FILE_HEADER, QUE_FILE_HEADER_TYPE
+
+if TYPE_CHECKING:
+    import pandas as pd
+
+
+def parse_value(value: str, value_type: type):
+    """ Typed parsing of a que file cell. Only python literals are accepted (no code is
+        evaluated). Returns None if value is not of value_type.
+    """
+    if value_type == str:
+        return value
+
+    try:
+        r = ast.literal_eval(value.strip())
+    except (ValueError, TypeError, SyntaxError, MemoryError, RecursionError):
+        return None
+
+    return r if isinstance(r, value_type) else None
+
+
+def parse_que_line(line: str) -> Optional[list]:
+    """ Parse a que file line to values (QUE_FILE_HEADER_TYPE order) or None if not valid """
+    csv_interpret = next(csv.reader([line]), [])
+    if len(csv_interpret) < len(QUE_FILE_HEADER_TYPE):
+        return None
+
+    line_data = []
+    for i, v in enumerate(QUE_FILE_HEADER_TYPE.values()):
+        r = parse_value(csv_interpret[i], v)
+        if r is None:
+            return None
+        line_data.append(r)
+
+    return line_data
+
+
+class QueFileReader:
+    """ Incremental que file reader.
+
+        - file not read at all if stat (inode, size, mtime) did not change
+        - file not parsed if content hash did not change
+        - only lines not seen in the previous version of the file are parsed
+    """
+    def __init__(self, que_file: str):
+        self.que_file = que_file
+
+        self._signature = None
+        self._digest = None
+        self._que_data = None  # type: pd.DataFrame
+        self._line_cache = dict()  # line -> parsed values (None if invalid)
+
+    def read(self) -> Tuple["pd.DataFrame", List[str]]:
+        """ Returns que data & invalid lines not reported before. Raises ValueError if the
+            header is corrupt.
+        """
+        st = os.stat(self.que_file)
+        signature = (st.st_ino, st.st_size, st.st_mtime_ns)
+        if signature == self._signature:
+            return self._que_data.copy(), []
+
+        with open(self.que_file, "rb") as f:
+            content = f.read()
+
+        digest = hashlib.blake2b(content, digest_size=16).digest()
+        if digest == self._digest:
+            self._signature = signature
+            return self._que_data.copy(), []
+
+        que_lines = content.decode().splitlines(keepends=True)
+        if len(que_lines) <= 0:
+            raise ValueError("Empty que file (no header)")
+
+        header = next(csv.reader([que_lines[0]]), [])
+        if len(header) != len(QUE_FILE_HEADER.split(",")):
+            raise ValueError(f"Corrupt que file header: {que_lines[0]}")
+
+        line_cache = dict()
+        correct_lines_data = []
+        invalid_lines = []
+
+        for line in que_lines[1:]:
+            if len(line.strip()) <= 0:
+                continue
+
+            if line in line_cache:
+                line_data = line_cache[line]
+            elif line in self._line_cache:
+                line_data = line_cache[line] = self._line_cache[line]
+            else:
+                line_data = line_cache[line] = parse_que_line(line)
+                if line_data is None:
+                    invalid_lines.append(line)
+
+            if line_data is not None:
+                correct_lines_data.append(line_data)
+
+        import pandas as pd
+
+        self._que_data = pd.DataFrame(correct_lines_data, columns=header)
+        self._line_cache = line_cache
+        self._signature = signature
+        self._digest = digest
+
+        return self._que_data.copy(), invalid_lines
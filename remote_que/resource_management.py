@@ -1,21 +1,34 @@
 from typing import List
 import pandas as pd
-import nvgpu
-import numpy as np
 
-from remote_que.config import DEFAULT_RESOURCE
-from remote_que.utils import get_gpu_pids
+from remote_que.config import DEFAULT_RESOURCE, DEFAULT_TELEMETRY_BACKEND
+from remote_que.telemetry import GpuTelemetry, GpuSnapshot, get_telemetry_backend
 
 
 class ResourceAvailability:
-    def __init__(self, machines: List[str]):
-        # TODO should implement for multiple machines
+    def __init__(self, machines: List[str], telemetry: GpuTelemetry = None):
         self.machines = machines
 
+        if telemetry is None:
+            telemetry = GpuTelemetry(get_telemetry_backend(DEFAULT_TELEMETRY_BACKEND), machines)
+        self.telemetry = telemetry
+        self._snapshot = None  # type: GpuSnapshot
+
+    def new_pass(self) -> GpuSnapshot:
+        """ Fix telemetry snapshot used for all availability queries of a scheduling pass """
+        self._snapshot = self.telemetry.snapshot()
+        return self._snapshot
+
+    @property
+    def snapshot(self) -> GpuSnapshot:
+        if self._snapshot is None:
+            return self.new_pass()
+        return self._snapshot
+
     def get_availability(self, resource_search: dict) -> pd.DataFrame:
         """
             Dataframe header:
-            index type uuid  mem_used  mem_total mem_used_percent  machine  mem_free
+            index type uuid  mem_used  mem_total mem_used_percent  machine  mem_free unique_gpu
         """
         assert isinstance(resource_search, dict), "Check resource availability no  dict"
 
@@ -26,7 +39,8 @@ class ResourceAvailability:
         if resource["no_gpus"] <= 0:
             return []
 
-        gpus = self.gpu_stats
+        snapshot = self.snapshot
+        gpus = snapshot.gpus
 
         if len(gpus) <= 0:
             return gpus
@@ -41,31 +55,11 @@ class ResourceAvailability:
         # Select gpu that have less <max_procs_on_gpu> processes running on the GPU already
         if resource["max_procs_on_gpu"] > 0:
             max_pr = resource["max_procs_on_gpu"]
-            for machine in gpus.machine.unique():
-                machine_select = gpus.machine == machine
-                gpu_pids = get_gpu_pids(machine)
-
-                if len(gpu_pids) <= 0:
-                    continue
-
-                gpu_pid_cnt = gpu_pids.groupby("index").size()
-                rem_gpu_idx = gpu_pid_cnt[gpu_pid_cnt > max_pr].index
-                print("start - ")
-                print(machine_select)
-                print(gpus.index)
-                print("===")
-                for gpu_idx in rem_gpu_idx:
-                    print(1, gpu_idx)
-                    print("_----------")
-                    print(np.array(gpus.index))
-                    print(f"-{gpu_idx}-")
-                    print(2, np.array(gpus.index.values) == gpu_idx)
-                    print("_----------")
-                    print(3, machine_select & (gpus.index == gpu_idx))
-                    print(4, ~(machine_select & (gpus.index == gpu_idx)))
-                    gpus = gpus[~(machine_select & (gpus.index == gpu_idx))]
-                    if len(gpus) <= 0:
-                        return gpus
+            gpu_pid_cnt = gpus["unique_gpu"].map(snapshot.proc_counts).fillna(0)
+            gpus = gpus[gpu_pid_cnt < max_pr]
+
+        if len(gpus) <= 0:
+            return gpus
 
         # Select GPUS with minimum memory available
         if resource["min_free_mem"] > 0:
@@ -77,22 +71,27 @@ class ResourceAvailability:
         # Select machines with a minimum of resource["no_gpus"] available
         no_gpus_machine = gpus.groupby("machine").size()
         sel_machines = no_gpus_machine[no_gpus_machine >= resource["no_gpus"]].index
-        gpus = gpus[gpus.index.isin(sel_machines)]
+        gpus = gpus[gpus.machine.isin(sel_machines)]
 
         return gpus
 
     @property
     def gpu_stats(self) -> pd.DataFrame:
-        x = pd.DataFrame.from_dict(nvgpu.gpu_info())
-        x["machine"] = 0
-        x["mem_free"] = x["mem_total"] - x["mem_used"]
-        x["unique_gpu"] = x.apply(lambda y: (y["machine"], y["index"]), axis=1)
-        return x
+        return self.snapshot.gpus
 
 
 if __name__ == "__main__":
     # test
-    resource = ResourceAvailability("test")
+    import sys
+    from remote_que.telemetry import FakeBackend
+
+    if "--fake" in sys.argv:
+        fake = FakeBackend(no_gpus=4)
+        fake.add_proc("test", 0, 1, 11000)
+        fake.add_proc("test", 1, 2, 100)
+        resource = ResourceAvailability(["test"], GpuTelemetry(fake, ["test"]))
+    else:
+        resource = ResourceAvailability(["test"])
 
     def _test(x):
         print("-" * 150)
@@ -1,18 +1,54 @@
-from typing import List
+from typing import List, TYPE_CHECKING
 import os
 import time
-from subprocess import Popen
-import pandas as pd
+import asyncio
+import shlex
+import tempfile
 
 from remote_que.logger import logger
-from remote_que.config import DEFAULT_CONFIRM_START_TIMEOUT
+from remote_que.config import DEFAULT_CONFIRM_START_TIMEOUT, DEFAULT_CONFIRM_START_POLL
+from remote_que.transport import Transport, LocalTransport, PidProc
+from remote_que.output import OutputFile, OutputOptions
+from remote_que.utils import process_start_time
+from remote_que.cgroups import cgroup_command, cgroup_path
+
+if TYPE_CHECKING:
+    import pandas as pd
+
+
+START_PENDING = 0
+START_CONFIRMED = 1
+START_CRASHED = 2
 
 
 class SingleMachineSlot:
+    """ Que proc on GPUs of one machine. Remote machines are reached through transport (e.g.
+        ssh) - stdout / stderr are still written to stdout_folder on the que manager machine.
+
+        Output is written by the proc directly to files (see OutputFile - rotated by
+        rotate_output), so procs outlive the que manager. Their last lines are kept in memory
+        (see tail) - start confirmation & status views never re-open the files. The proc shell
+        writes the command exit code to a status file next to its pid file - the exit code of
+        a proc reattached by a restarted que manager (not its child) is read from there.
+
+        The proc tree is pinned to cpus (taskset) and, with limits (cgroup_command kwargs),
+        runs in its own cgroup v2 (removed once the proc is reaped - see kill).
+    """
     def __init__(self, gpus: List[str], stdout_folder: str, log_start_confirm: str = None,
-                 wait_time_start: int = 1, max_wait_start: int = 600):
+                 wait_time_start: int = 1, max_wait_start: int = 600,
+                 machine: str = "0.0.0.0", transport: Transport = None,
+                 output: OutputOptions = None, cpus: List[int] = None, limits: dict = None):
         self.gpus = ",".join([str(x) for x in gpus])
+        self.cpus = cpus
+        self.limits = limits
         self.stdout_folder = stdout_folder
+        self.machine = machine
+        self._transport = LocalTransport(machine) if transport is None else transport
+        self._pid_file = None
+        self._status_file = None
+        self._cgroup = None
+        self._output = output
+        self._outputs = []  # type: List[OutputFile]  # stdout, stderr
 
         self._wait_time_start = wait_time_start
         self._max_wait_start = max_wait_start
@@ -23,79 +59,190 @@ class SingleMachineSlot:
         self._crt_stdout_file = None
         self._crt_stderr_file = None
         self._proc = None
-        self._confirmed_start = False
-        self._found_start_log = True
+        self._start_state = START_PENDING
+        self._start_time = None
+        self._found_start_log = False
         self._log_start_confirm = log_start_confirm
         self._command_id = None
         self._que_data = None
 
-    def start_command(self, command_id: int, command: str, que_data: pd.Series) -> bool:
-        if self.is_running:
-            return False
+    def _output_files(self, command_id: int) -> List[OutputFile]:
+        """ stdout (tail watched for the start confirmation log) & stderr of command_id """
+        fld = self.stdout_folder
+        return [OutputFile(os.path.join(fld, f"proc_{command_id}_out"), self._output,
+                           watch=self._log_start_confirm),
+                OutputFile(os.path.join(fld, f"proc_{command_id}_err"), self._output)]
 
+    def _prepare_start(self, command_id: int, command: str, que_data: "pd.Series") -> str:
+        """ Open output files & build command (shared by start_command / start_command_async) """
         self._command_id = command_id
         self._que_data = que_data
 
-        fld = self.stdout_folder
+        self._outputs = self._output_files(command_id)
+        self._crt_stdout_file, self._crt_stderr_file = [output.open() for output in self._outputs]
+        self._pid_file = os.path.join(tempfile.gettempdir(), f"remote_que_proc_{command_id}.pid")
+        self._status_file = os.path.join(tempfile.gettempdir(),
+                                         f"remote_que_proc_{command_id}.status")
+
+        self._start_state = START_PENDING
+
+        # Limits & CPU affinity of the proc shell are inherited by the whole proc tree
+        prefix = ""
+        if self.limits is not None:
+            self._cgroup = cgroup_path(command_id)
+            prefix = cgroup_command(self._cgroup, **self.limits)
+        if self.cpus is not None:
+            prefix += f"taskset -pc {','.join(str(x) for x in self.cpus)} $$ >/dev/null 2>&1; "
+
+        # Unbuffered python output - lines reach the output files as they are printed. The
+        # command runs in a subshell (newline ends a trailing comment of the command)
+        status = shlex.quote(self._status_file)
+        return f"rm -f {status}; {prefix}(PYTHONUNBUFFERED=1 CUDA_VISIBLE_DEVICES={self.gpus} " \
+               f"{command}\n); s=$?; echo $s > {status}; exit $s"
+
+    def _spawned(self) -> None:
+        """ The proc has its copies of the output files """
+        for fd in [self._crt_stdout_file, self._crt_stderr_file]:
+            os.close(fd)
+        self._crt_stdout_file = None
+        self._crt_stderr_file = None
 
-        self._crt_stdout_file = sof = open(os.path.join(fld, f"proc_{command_id}_out"), "w")
-        self._crt_stderr_file = sef = open(os.path.join(fld, f"proc_{command_id}_err"), "w")
+    def rotate_output(self) -> None:
+        """ Read new output into the tails & rotate output files that reached their max size
+            (called by the que manager) """
+        for output in self._outputs:
+            try:
+                output.rotate()
+            except OSError as e:
+                logger.warning(f"[SingleMachineSlot] Cannot rotate {output.path} ({e})")
 
-        # TODO Realtime flush to file ... not always ???
-        command = f"PYTHONUNBUFFERED=1 CUDA_VISIBLE_DEVICES={self.gpus} {command}"
-        self._proc = Popen(command, shell=True, stdout=sof, stderr=sef)
+    def start_command(self, command_id: int, command: str, que_data: "pd.Series") -> bool:
+        if self.is_running:
+            return False
+
+        command = self._prepare_start(command_id, command, que_data)
+        try:
+            self._proc = self._transport.popen(command, self._crt_stdout_file,
+                                               self._crt_stderr_file, pid_file=self._pid_file)
+        finally:
+            self._spawned()
+        self._start_time = time.time()
 
         time.sleep(self._wait_time_start)
         return self.is_running
 
+    async def start_command_async(self, command_id: int, command: str,
+                                  que_data: "pd.Series") -> bool:
+        """ start_command without blocking - many procs can be started concurrently """
+        if self.is_running:
+            return False
+
+        command = self._prepare_start(command_id, command, que_data)
+        try:
+            self._proc = await self._transport.popen_async(
+                command, self._crt_stdout_file, self._crt_stderr_file, pid_file=self._pid_file
+            )
+        finally:
+            self._spawned()
+        self._start_time = time.time()
+
+        await asyncio.sleep(self._wait_time_start)
+        return self.is_running
+
+    async def wait_exit(self) -> int:
+        """ Wait for proc exit (procs started with start_command_async) """
+        return await self._proc.wait()
+
+    def reattach(self, command_id: int, que_data: "pd.Series", proc: PidProc,
+                 pid_file: str = None, status_file: str = None, cgroup: str = None) -> None:
+        """ Track a proc started by a previous que manager (it still writes its output files,
+            which are rotated from now on) """
+        self._command_id = command_id
+        self._outputs = self._output_files(command_id)
+        self._que_data = que_data
+        self._proc = proc
+        self._pid_file = pid_file
+        self._status_file = status_file
+        self._cgroup = cgroup
+        self._start_state = START_CONFIRMED
+        self._start_time = time.time()
+
+    def proc_info(self) -> dict:
+        """ Durable proc record (journaled at start) - lets a restarted que manager reattach """
+        pid = None if self._proc is None else self._proc.pid
+        return dict({"machine": self.machine, "gpus": self.gpus, "cpus": self.cpus, "pid": pid,
+                     "pid_start": None if pid is None else process_start_time(pid),
+                     "pid_file": self._pid_file, "status_file": self._status_file,
+                     "cgroup": self._cgroup})
+
     @property
-    def que_data(self) -> pd.Series:
+    def que_data(self) -> "pd.Series":
         return self._que_data
 
     @property
     def confirmed_start(self) -> bool:
-        return self._confirmed_start
+        return self._start_state != START_PENDING
 
-    def wait_start(self) -> None:
-        """ It sets confirmation_set to True, depends how much it waits """
-        if self._confirmed_start:
-            return
+    @property
+    def start_state(self) -> int:
+        return self._start_state
+
+    def check_start(self) -> int:
+        """ Non-blocking start confirmation. Moves start state from START_PENDING to
+            START_CONFIRMED / START_CRASHED, depending on the confirmation heuristic.
+        """
+        if self._start_state != START_PENDING:
+            return self._start_state
+
+        # Process has stopped or not running any more -> start resolved by its return code
+        if self._proc is None or not self.is_running:
+            self._start_state = START_CRASHED if self.crashed else START_CONFIRMED
+            return self._start_state
+
+        elapsed = time.time() - self._start_time
 
         if self._log_start_confirm is None:
-            time.sleep(DEFAULT_CONFIRM_START_TIMEOUT)
-            self._confirmed_start = True
-            return
-        else:
-            max_timeot = self._max_wait_start
-            start_check = time.time()
-            log_start_confirm = self._log_start_confirm
+            if elapsed >= DEFAULT_CONFIRM_START_TIMEOUT:
+                self._start_state = START_CONFIRMED
+        elif self._read_start_log() or elapsed >= self._max_wait_start:
+            self._start_state = START_CONFIRMED
 
-            while time.time() - start_check < max_timeot:
-                file_content = []
+        return self._start_state
 
-                try:
-                    self._crt_stdout_file.flush()
-                    with open(self._crt_stdout_file, "r") as f:
-                        file_content = f.readlines()
-                except Exception as e:
-                    pass
+    def next_start_check(self) -> float:
+        """ Seconds until check_start could change state (other than by process exit) """
+        if self._start_state != START_PENDING:
+            return float("inf")
 
-                for line in file_content:
-                    if log_start_confirm in line:
-                        self._confirmed_start = True
-                        self._found_start_log = True
-                        break
+        if self._log_start_confirm is None:
+            return max(0., self._start_time + DEFAULT_CONFIRM_START_TIMEOUT - time.time())
+
+        return DEFAULT_CONFIRM_START_POLL
+
+    def _read_start_log(self) -> bool:
+        """ Poll the stdout tail (new output only) for the start confirmation log """
+        if len(self._outputs) == 0:
+            return False
 
-                # Process has stopped or not running any more -> we consider it has started :)
-                if not self.is_running:
-                    self._confirmed_start = True
+        tail = self._outputs[0].tail
+        try:
+            tail.poll()
+        except OSError:
+            return False
 
-                if self._confirmed_start:
-                    break
+        self._found_start_log = tail.seen
+        return tail.seen
 
-                time.sleep(1)
+    def tail(self, no_lines: int = None, stderr: bool = False) -> List[str]:
+        """ Last no_lines output lines kept in memory (as of the last rotate_output) """
+        if len(self._outputs) == 0:
+            return []
+        return self._outputs[int(stderr)].tail.tail(no_lines)
 
-            self._confirmed_start = True
+    def wait_start(self) -> None:
+        """ Blocking version of check_start """
+        while self.check_start() == START_PENDING:
+            time.sleep(min(self.next_start_check(), DEFAULT_CONFIRM_START_POLL))
 
     @property
     def id(self):
@@ -123,29 +270,54 @@ class SingleMachineSlot:
 
         return self._proc.poll() is not None
 
+    def pids(self) -> List[int]:
+        """ PIDs of the proc tree (local procs only - remote PIDs are not visible here) """
+        if self._proc is None or not isinstance(self._transport, LocalTransport):
+            return []
+
+        import psutil
+
+        try:
+            children = psutil.Process(self._proc.pid).children(recursive=True)
+        except psutil.NoSuchProcess:
+            return []
+        return [self._proc.pid] + [child.pid for child in children]
+
     def clean(self):
         # called before del proc
         pass
 
+    def stop(self) -> None:
+        """ Stop a running proc tree - SIGTERM, SIGKILL after a grace period (its exit is then
+            handled as for any other proc - see kill) """
+        if self.is_running:
+            self._transport.kill(self._proc, self._pid_file, cgroup=self._cgroup)
+
+    def signal(self, sig: int) -> bool:
+        """ Send sig to the running proc tree (suspend / resume / checkpoint request) """
+        if not self.is_running:
+            return False
+        return self._transport.signal(self._proc, sig, self._pid_file)
+
     def kill(self) -> int:
         if self._proc is None:
             return 0
 
-        self._proc.kill()
-
-        try:
-            self._crt_stdout_file.flush()
-            self._crt_stderr_file.flush()
-        except Exception as e:
-            logger.warning(f"[SingleMachineSlot] Exception was handled while flushing files ({e})")
-
-        self._crt_stdout_file.close()
-        self._crt_stderr_file.close()
-
+        self._transport.kill(self._proc, self._pid_file, cgroup=self._cgroup)
         return_code = self._proc.poll()
-
         self._proc = None
-        self._crt_stdout_file = None
-        self._crt_stderr_file = None
+        for output in self._outputs:
+            output.tail.close()
+
+        if self._status_file is not None:
+            if return_code == PidProc.EXIT_UNKNOWN:
+                # Reattached proc - exit code written by its shell (if it was not killed)
+                status = self._transport.exit_status(self._status_file)
+                return_code = return_code if status is None else status
+            elif isinstance(self._transport, LocalTransport):
+                try:
+                    os.remove(self._status_file)
+                except OSError:
+                    pass
 
         return return_code
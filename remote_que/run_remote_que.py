@@ -1,62 +1,94 @@
 import os
+import json
+import signal
+import asyncio
 import subprocess
-import pandas as pd
 import time
-import numpy as np
-from typing import List, Union, Tuple
-import re
-import itertools
+from typing import List, Tuple, Dict, TYPE_CHECKING
 from shutil import copyfile
-import csv
 
 from remote_que.logger import logger
-from remote_que.config import QUE_FILE_HEADER, QUE_FILE_HEADER_TYPE
+from remote_que.config import QUE_FILE_HEADER
 from remote_que.config import DEFAULT_EDITOR, QUE_FILE_HELP
-from remote_que.config import get_que_file
-from remote_que.config import get_started_file, get_running_file, get_crash_file, get_lock_file
+from remote_que.config import get_que_file, QUE_FILE_NAME, get_manager_lock_file
+from remote_que.config import get_started_file, get_running_file, get_crash_file
+from remote_que.config import DEFAULT_LOCK_TIMEOUT, DEFAULT_QUE_LOCK_WAIT
 from remote_que.config import get_finished_file, get_crash_start_file
-from remote_que.config import DEFAULT_RESOURCE
-
-from remote_que.utils import check_if_process_is_running
-from remote_que.resource_management import ResourceAvailability
-from remote_que.run_process import SingleMachineSlot
-
-
-STATE_QUE = 0
-STATE_CRASHED_START = 1
-STATE_CRASHED = 1
-STATE_STARTED = 1
-STATE_RUNNING = 1
-STATE_FINISHED = 1
-
-
-def write_que_data(results_folder: str, que_data: pd.DataFrame) -> bool:
+from remote_que.config import DEFAULT_EVENT_POLL_INTERVAL
+from remote_que.config import get_invalid_lines_file, DEFAULT_STORAGE, STORAGE_BACKENDS
+from remote_que.config import STATE_QUE, STATE_STARTED, STATE_RUNNING, STATE_FINISHED
+from remote_que.config import STATE_CRASHED, STATE_CRASHED_START, STATE_SUSPENDED
+from remote_que.config import DEFAULT_TELEMETRY_BACKEND, DEFAULT_TELEMETRY_TTL
+from remote_que.config import DEFAULT_MACHINES, DEFAULT_TRANSPORT, TRANSPORTS
+from remote_que.config import DEFAULT_BACKFILL, BACKFILL_MODES, DEFAULT_RUNTIME_ESTIMATE
+from remote_que.config import DEFAULT_PACKING, PACKING_STRATEGIES
+from remote_que.config import DEFAULT_FAIR_SHARE_WEIGHT, DEFAULT_FAIR_SHARE_HALF_LIFE
+from remote_que.config import DEFAULT_PREEMPT_PRIORITY_GAP, DEFAULT_PREEMPT_MIN_RUNTIME
+from remote_que.config import DEFAULT_PREEMPT_CHECKPOINT_GRACE, DEFAULT_PREEMPT_MAX_JOBS
+from remote_que.config import DEFAULT_UTIL_SAMPLE_INTERVAL
+from remote_que.config import DEFAULT_METRICS_PORT, DEFAULT_STATS_INTERVAL, get_stats_file
+from remote_que.config import DEFAULT_STATS_TAIL_LINES
+from remote_que.config import DEFAULT_OUTPUT_MAX_BYTES, DEFAULT_OUTPUT_KEEP
+from remote_que.config import DEFAULT_OUTPUT_COMPRESS, OUTPUT_COMPRESSIONS
+from remote_que.config import CONTROL_FILE_NAME, get_control_file, get_manager_log_file
+from remote_que.config import DEFAULT_AGENT_CONNECT_TIMEOUT, DEFAULT_RESOURCE
+from remote_que.config import AGENT_TOKEN_ENV
+
+from remote_que.telemetry import GpuTelemetry, get_telemetry_backend, TELEMETRY_BACKENDS
+from remote_que.run_process import SingleMachineSlot, START_PENDING, START_CRASHED
+from remote_que.utils import process_start_time
+from remote_que.events import Wakeup, ChildWatcher, FileWatcher
+from remote_que.storage import JobStorage, get_storage
+from remote_que.que_parser import QueFileReader
+from remote_que.locking import QueLock, QueLockTimeout, que_lock
+from remote_que.submit import allocate_command_ids
+from remote_que.template import expand_que_data, TemplateError
+from remote_que.dependencies import DependencyGraph, DependencyError, job_parents
+from remote_que.dependencies import resolve_dependencies
+from remote_que.transport import TransportPool, PidProc
+from remote_que.fairshare import FairShare, parse_user_values
+from remote_que.metrics import Metrics
+from remote_que.output import OutputOptions
+from remote_que.agent import AgentClient, AgentSlot, AgentTelemetryBackend, parse_agents
+from remote_que.agent import read_token
+
+# pandas / numpy (& the modules placing jobs with them) are imported by the que manager & the
+# que file helpers that need them - importing this module stays cheap
+if TYPE_CHECKING:
+    import pandas as pd
+    from remote_que.placement import GpuState
+    from remote_que.utilization import UtilizationSampler
+
+
+def write_que_data(results_folder: str, que_data: "pd.DataFrame",
+                   timeout: float = DEFAULT_LOCK_TIMEOUT) -> bool:
     que_file = get_que_file(results_folder)
-    lock_file = get_lock_file(results_folder)
 
     # Must have lock to write
-    if not os.path.isfile(lock_file):
+    try:
+        with que_lock(results_folder, timeout=timeout):
+            que_data.to_csv(que_file, index=False)
+    except QueLockTimeout as e:
+        logger.warning(f"[ERROR] {e}")
         return False
-    os.remove(lock_file)
 
-    que_data.to_csv(que_file, index=False)
+    return True
 
-    # Generate new lock file
-    with open(lock_file, "w") as f:
-        f.write(str(time.time()))
 
-    return True
+def edit_que_data(results_folder: str, timeout: float = DEFAULT_LOCK_TIMEOUT) -> bool:
+    # Hold exclusive que lock while editing (to block QueManager from reading new procs)
+    try:
+        with que_lock(results_folder, timeout=timeout):
+            return _edit_que_file(results_folder)
+    except QueLockTimeout as e:
+        logger.warning(f"[ERROR] {e}")
+        return False
 
 
-def edit_que_data(results_folder: str):
-    # First remove lock file if it exists (to block QueManager from reading new procs)
-    que_file = get_que_file(results_folder)
+def _edit_que_file(results_folder: str) -> bool:
+    import pandas as pd
 
-    lock_file = get_lock_file(results_folder)
-    if os.path.isfile(lock_file):
-        os.remove(lock_file)
-    else:
-        return 1234
+    que_file = get_que_file(results_folder)
 
     # -- Can open que file for edit now.
 
@@ -77,6 +109,28 @@ def edit_que_data(results_folder: str):
         except Exception:
             return_code = 666
 
+    if return_code == 0:
+        # Run match special pattern and interpret (safe parsing, bulk insert)
+        try:
+            que_data = expand_que_data(que_data)
+        except TemplateError as e:
+            logger.warning(f"[ERROR] {e}")
+            return_code = 667
+
+    if return_code == 0:
+        # Allocate new ids to newly added commands (que lock is held) & resolve job names in
+        # depends_on to command ids
+        new_ids = que_data["command_id"] == 0
+        if new_ids.any():
+            que_data.loc[new_ids, "command_id"] = allocate_command_ids(results_folder,
+                                                                       new_ids.sum())
+        try:
+            que_data = pd.DataFrame(resolve_dependencies(que_data.to_dict("records")),
+                                    columns=que_data.columns)
+        except DependencyError as e:
+            logger.warning(f"[ERROR] {e}")
+            return_code = 668
+
     if return_code != 0:
         logger.warning(f"[ERROR] An exception occurred when writing or reading QUE FILE "
                        f"(@ {que_file}). - Current edited file was writen (@ {que_file}_failed)\n"
@@ -90,152 +144,54 @@ def edit_que_data(results_folder: str):
         # Write back old csv file
         original_que.to_csv(que_file, index=False)
     else:
-        # Validate que data. It was  just written
-        # TODO validate data
-
-        # Run match special pattern and interpret
-        multiply = []
-        for que_idx, data in que_data.iterrows():
-            cmd = data["shell_command"]
-
-            repl_data = []
-            splits = []
-            split = cmd
-            while True:
-                match = re.search(r"\[{([^}]*)}\]", split)
-
-                if match is None:
-                    break
-                interp = eval(match[1])
-
-                if not isinstance(interp, list):
-                    interp = [interp]
-
-                repl_data.append(interp)
-                span = match.span()
-                splits.append(split[:span[0]])
-                split = split[span[1]:]
-
-            if len(repl_data) <= 0:
-                continue
-
-            cmds = []
-            for combination in itertools.product(*repl_data):
-                new_cmd = ""
-                for i, sp in enumerate(combination):
-                    new_cmd += splits[i] + str(sp)
-                if len(combination) < len(splits):
-                    new_cmd += splits[-1]
-                cmds.append(new_cmd)
-            multiply.append((que_idx, cmds))
-
-        # Append new commands
-        for que_idx, cmds in multiply:
-            for new_cmd in cmds:
-                new_idx = len(que_data)
-                que_data.loc[new_idx] = que_data.loc[que_idx]
-                que_data.loc[new_idx, "shell_command"] = new_cmd
-
-        # Remove multiplied indexes
-        for que_idx, _ in multiply:
-            que_data = que_data.drop(que_idx)
-
-        for que_idx, data in que_data.iterrows():
-            # Allocate new id to newly added command
-            if data["command_id"] == 0:
-                que_data.loc[que_idx, "command_id"] = int(time.time() * 1000)
-                time.sleep(0.1)
-
         # Write preprocessed new data
         que_data.to_csv(que_file, index=False)
 
         logger.info(f"[DONE] New que saved! Here is the que sorted by priority:\n"
                     f"{que_data.sort_values('que_priority')}\n\n")
 
-    # Generate new lock file
-    with open(lock_file, "w") as f:
-        f.write(str(time.time()))
-
     return return_code == 0
 
 
-def read_remote_que(results_folder: str) -> pd.DataFrame:
+_que_readers = dict()  # que file -> QueFileReader
+
+
+def read_remote_que(results_folder: str, storage: JobStorage = None) -> "pd.DataFrame":
+    """ Read & validate que file. If storage is given, jobs that already left the que are
+        filtered out. """
     que_file = get_que_file(results_folder)
+    header_columns = set(QUE_FILE_HEADER.split(","))
 
     return_code = 0
+    que_data = None
 
     if not os.path.isfile(que_file):
         return_code = 9
     else:
-        header_columns = set(QUE_FILE_HEADER.split(","))
-
-        # read and validate line by line csv que
-        no_columns = len(header_columns)
+        # Incremental read - cached per que file (unchanged lines are not parsed again)
+        que_reader = _que_readers.get(que_file)
+        if que_reader is None:
+            que_reader = _que_readers[que_file] = QueFileReader(que_file)
 
         try:
-            # Read text lines
-            with open(que_file, "r") as f:
-                que_lines = f.readlines()
-
-            correct_lines = []
-            correct_lines_data = []
-            blacklisted_lines = []
-
-            columns = None
-            for line in que_lines:
-                csv_interpret = list(csv.reader([line]))[0]
-
-                if columns is None:
-                    if len(csv_interpret) == no_columns:
-                        columns = csv_interpret
-                    else:
-                        # File is corrupt from header -> must delete all
-                        blacklisted_lines = que_file
-                        break
-                    continue
-
-                # Validate types
-                valid = True
-                line_data = []
-                for i, (k, v) in enumerate(QUE_FILE_HEADER_TYPE.items()):
-                    if v != str:
-                        r = None
-                        try:
-                            r = eval(csv_interpret[i])
-                        except Exception as e:
-                            pass
-
-                        if not isinstance(r, v):
-                            valid = False
-                            break
-
-                        line_data.append(r)
-                    else:
-                        line_data.append(csv_interpret[i])
-
-                if valid:
-                    correct_lines.append(line)
-                    correct_lines_data.append(line_data)
-                else:
-                    blacklisted_lines.append(line)
+            with que_lock(results_folder, exclusive=False):
+                que_data, blacklisted_lines = que_reader.read()
 
-            # Write blacklisted lines to crash_starts
+            # Write blacklisted lines to invalid lines file
             if len(blacklisted_lines) > 0:
                 write_lines = "\n".join(blacklisted_lines) + "\n"
                 logger.warning(f"Cannot read lines: \n{write_lines}")
-                with open(get_crash_start_file(results_folder), "a") as f:
+                with open(get_invalid_lines_file(results_folder), "a") as f:
                     f.writelines(blacklisted_lines)
-
-            que_data = pd.DataFrame(correct_lines_data, columns=columns)
         except Exception as e:
             return_code = 2
 
     # check columns
-    if set(que_data.columns.values) != header_columns:
+    if return_code == 0 and set(que_data.columns.values) != header_columns:
         return_code = 3
 
     # Check first column is int
-    if len(que_data) > 0 and que_data["que_priority"].dtype != int:
+    if return_code == 0 and len(que_data) > 0 and que_data["que_priority"].dtype != int:
         return_code = 4
 
     if return_code > 0:
@@ -245,55 +201,42 @@ def read_remote_que(results_folder: str) -> pd.DataFrame:
 
         exit(2)
 
-    return que_data
-
-
-def append_to_csv_file(data: pd.DataFrame, file_path: str):
-    # TODO problem when header does not match -> when things change
-    if isinstance(data, pd.Series):
-        data = pd.DataFrame([data])
-
-    header = False
-    if not os.path.isfile(file_path):
-        header = True
-
-    with open(file_path, 'a') as f:
-        data.to_csv(f, header=header, index=False)
-
-
-def sample_gpus(gpus: pd.DataFrame, no_gpus: int) -> Tuple[pd.DataFrame, str, List[str]]:
-    machines = gpus.machine.unique()
-    machine = np.random.choice(machines)
-    gpus = gpus[gpus.machine == machine]
-    select = gpus.head(no_gpus)
-    return select, machine, list(select["index"].values)
-
-
-def filter_out_gpus(gpus: pd.DataFrame, filter_gpus: List[pd.DataFrame]):
-    if len(gpus) <= 0 or len(filter_gpus) <= 0:
-        return gpus
-    filter_out = pd.concat(filter_gpus)["unique_gpu"].values
-    gpus = gpus[~gpus["unique_gpu"].isin(filter_out)]
-    return gpus
-
-
-def read_running_que_stats():
-    pass
-
+    if storage is not None and len(que_data) > 0:
+        que_data = que_data[~(que_data["command_id"].isin(storage.processed_ids))]
 
-def running_que_stats():
-    pass
+    return que_data
 
 
 class QueManager:
-    def __init__(self, results_folder: str, loop_sleep: int = 10):
+    def __init__(self, results_folder: str, loop_sleep: int = 10,
+                 telemetry_backend: str = DEFAULT_TELEMETRY_BACKEND,
+                 telemetry_ttl: float = DEFAULT_TELEMETRY_TTL, storage: str = DEFAULT_STORAGE,
+                 machines: List[str] = None, transport: str = DEFAULT_TRANSPORT,
+                 agents: Dict[str, str] = None, agent_token_file: str = None,
+                 backfill: str = DEFAULT_BACKFILL,
+                 packing: str = DEFAULT_PACKING, metrics_port: int = DEFAULT_METRICS_PORT,
+                 output_max_bytes: int = DEFAULT_OUTPUT_MAX_BYTES,
+                 output_keep: int = DEFAULT_OUTPUT_KEEP,
+                 output_compress: str = DEFAULT_OUTPUT_COMPRESS, edit: bool = True,
+                 cgroups: bool = False, fair_share_weight: float = DEFAULT_FAIR_SHARE_WEIGHT,
+                 fair_share_half_life: float = DEFAULT_FAIR_SHARE_HALF_LIFE,
+                 user_shares: Dict[str, float] = None, user_gpu_caps: Dict[str, int] = None,
+                 preempt: bool = False,
+                 preempt_priority_gap: int = DEFAULT_PREEMPT_PRIORITY_GAP,
+                 util_interval: float = DEFAULT_UTIL_SAMPLE_INTERVAL):
+        from remote_que.estimates import JobEstimator
+        from remote_que.resource_management import ResourceAvailability
+        from remote_que.utilization import UtilizationSampler
+
         # Generate remote que folder
-        self._que_lock_file = get_lock_file(results_folder)
+        self._que_lock = que_lock(results_folder)
+        self._manager_lock = QueLock(get_manager_lock_file(results_folder), timeout=0)
         self._started_file = get_started_file(results_folder)
         self._crashed_file = get_crash_file(results_folder)
         self._crashed_start_file = get_crash_start_file(results_folder)
         self._running_file = get_running_file(results_folder)
         self._finished_file = get_finished_file(results_folder)
+        self._storage = None  # type: JobStorage
 
         if os.path.isdir(results_folder):
             logger.info("Result folder exists")
@@ -304,239 +247,939 @@ class QueManager:
         assert os.path.isdir(results_folder), f"Cannot create results folder {results_folder}"
 
         self.results_folder = results_folder
+        logger.add_filehandler(get_manager_log_file(results_folder))
 
         self._command_id_crashes = dict({})
         self._command_id_max_crash = 20
         self._loop_wait_time = loop_sleep
 
-        # Check remote_que is not running and remote que is available
-        if not self.remote_que_available or check_if_process_is_running("remote_que"):
-            print("[WARNING] Remote que is locked. Other remote_que might be running. \n\t....")
+        # Check no other que manager holds the results folder (PID of the manager lock owner)
+        if not self.remote_que_available:
+            print(f"[WARNING] Remote que is locked by PID {self._manager_lock.owner()}. Other "
+                  f"remote_que might be running. \n\t....")
             cmd = input("Are you sure you want to continue? If yes, write <yes> and press Enter "
                        "...")
 
             if cmd.lower() != "yes":
                 exit(1)
 
+        # Hold manager lock while running (released by the kernel if this process dies)
+        try:
+            self._manager_lock.acquire()
+        except QueLockTimeout as e:
+            logger.warning(f"[WARNING] Running without manager lock: {e}")
+
+        # Job state storage (csv state files are views of it)
+        self._storage = get_storage(storage, results_folder)
+        self._que_file_dirty = False
+
+        # Runtime (for backfill) & GPU memory (for packing) predictions learned from finished jobs
+        assert backfill in BACKFILL_MODES, f"Unknown backfill {backfill} ({BACKFILL_MODES})"
+        assert packing in PACKING_STRATEGIES, f"Unknown packing {packing} ({PACKING_STRATEGIES})"
+        self._backfill = backfill
+        self._packing = packing
+        self._estimator = JobEstimator()
+        self._estimator.load(self._storage)
+
+        # Fair-share que order & per user GPU caps (usage of ended jobs is read once, then
+        # updated as procs end)
+        self._fair_share = FairShare(weight=fair_share_weight, half_life=fair_share_half_life,
+                                     shares=user_shares, caps=user_gpu_caps)
+        self._fair_share.load(self._storage)
+        self._proc_ends = dict()  # command_id -> (machine, gpus, predicted end time)
+        self._gpu_mem = dict()  # command_id -> peak GPU memory (MiB) per GPU seen in samples
+        self._proc_cpus = dict()  # command_id -> (machine, pinned CPU cores, host memory MiB)
+        self._cgroups = cgroups  # procs run in cgroups limited to their cpus / host_mem
+
+        # Queued jobs waiting for their parents (preferred_resource depends_on)
+        self._dependencies = DependencyGraph()
+        self._run_again = False  # jobs became ready / GPUs were preempted -> next pass now
+
+        # Preemption - blocked jobs suspend (or checkpoint & requeue) lower priority procs
+        self._preempt = preempt
+        self._preempt_gap = preempt_priority_gap
+        self._run_since = dict()  # command_id -> start / resume time of running procs
+        self._suspended = dict()  # command_id -> dict(proc, preemptors, end - _proc_ends value)
+        self._requeue = dict()  # command_id -> (proc, time to stop) of checkpoint procs
+        self._preempting = dict()  # preemptor command_id -> checkpoint procs being stopped
+        self._preempt_first = set()  # preemptors whose checkpoint procs exited (placed first)
+        self._requeue_rows = []  # que rows of requeued jobs (appended to que file on next read)
+
+        # Persistent connections to all machines (opened in parallel, reused by telemetry & procs)
+        machines = DEFAULT_MACHINES if machines is None else machines
+        self._transports = TransportPool(transport)
+        for machine, connected in zip(machines, self._transports.connect(machines)):
+            if not connected:
+                logger.warning(f"[WARNING] Cannot connect to machine {machine}")
+
+        # Node agents (machine -> address) own procs & push their state and GPU telemetry
+        self._agents = dict()  # type: Dict[str, AgentClient]
+        token = read_token(agent_token_file) if agents else None
+        for machine, address in (agents or dict()).items():
+            self._agents[machine] = AgentClient(machine, address, token=token)
+        if len(self._agents) > 0:
+            machines = list(self._agents.keys())
+            backend = AgentTelemetryBackend(self._agents)
+        else:
+            backend = get_telemetry_backend(telemetry_backend, transports=self._transports)
+
         # Initialize resource manager
-        self._resource_manager = ResourceAvailability(machines=["0.0.0.0"])
+        telemetry = GpuTelemetry(backend, machines, ttl=telemetry_ttl,
+                                 transports=self._transports)
+        self._resource_manager = ResourceAvailability(machines=machines, telemetry=telemetry)
 
-        # First time write lock file so
-        lock_file = get_lock_file(results_folder)
-        # Generate new lock file
-        with open(lock_file, "w") as f:
-            f.write(str(time.time()))
+        # Rolling GPU utilization (sampled in a background thread, None - disabled)
+        self._utilization = None  # type: UtilizationSampler
+        if util_interval > 0:
+            self._utilization = UtilizationSampler(backend, machines, interval=util_interval,
+                                                   transports=self._transports)
 
         # Wonderful -> Can open que for edit and start running
-        rreturn_code = edit_que_data(self.results_folder)
+        if edit:
+            rreturn_code = edit_que_data(self.results_folder)
+
+            assert rreturn_code, "Did not edit correctly que file"
+
+        # Stage timings, job counters & histograms (stats file / metrics endpoint)
+        self._metrics = Metrics()
+        self._metrics_port = metrics_port
+        self._stats_file = get_stats_file(results_folder)
+        self._stats_time = 0.
 
-        assert rreturn_code, "Did not edit correctly que file"
+        # Proc output files rotated by the que manager (optionally compressed)
+        self._output = OutputOptions(max_bytes=output_max_bytes, keep=output_keep,
+                                     compress=output_compress)
+
+        # Control requests (remote-que stop / stop-que) - only those appended after start
+        self._control_file = get_control_file(results_folder)
+        self._control_offset = os.path.getsize(self._control_file) \
+            if os.path.isfile(self._control_file) else 0
+        self._stop_ids = set()  # command_ids of procs stopped by request
+        self._draining = False  # no new procs are started, exit when running procs end
 
         # Session variables
         self._running_que = []  # type: List[SingleMachineSlot]
+        self._starting_que = []  # type: List[SingleMachineSlot]
+        self._event = None  # type: asyncio.Event
+
+        # Event sources - wake up on child exit / que file edit instead of sleeping loop_sleep
+        self._wakeup = Wakeup(poll_interval=DEFAULT_EVENT_POLL_INTERVAL)
+        self._child_watcher = ChildWatcher(self._wakeup)
+        self._que_watcher = FileWatcher(self._wakeup, results_folder,
+                                       [QUE_FILE_NAME, CONTROL_FILE_NAME])
+        for client in self._agents.values():
+            client.register(self._wakeup)
+
+        # Procs left running by a previous que manager
+        self._reattached_ids = set()
+        self._recover()
+
+    def _recover(self) -> None:
+        """ Reattach to procs of jobs still started / running in storage (previous que manager
+            exited or crashed) using their proc records (see proc_info), or record as crashed
+            (lost) the ones that are gone. Jobs are never started again """
+        import pandas as pd
+
+        storage = self._storage
+        jobs = storage.jobs_in_state([STATE_STARTED, STATE_RUNNING, STATE_SUSPENDED])
+        if len(jobs) <= 0:
+            return
+
+        for client in self._agents.values():
+            if not client.wait_hello(DEFAULT_AGENT_CONNECT_TIMEOUT):
+                logger.warning(f"[WARNING] No state from agent {client.machine}")
+
+        now = time.time()
+        for job in jobs:
+            que_data = pd.Series(job["data"])
+            command_id = que_data["command_id"]
+            info = job["info"]
+            machine, cpus = info.get("machine"), info.get("cpus")
+            gpus = info["gpus"].split(",") if info.get("gpus") else []
+
+            proc = None
+            if machine in self._agents and command_id in self._agents[machine].jobs:
+                proc = AgentSlot(self._agents[machine], gpus, cpus=cpus)
+                proc.reattach(command_id, que_data)
+            elif not info.get("agent") and info.get("pid") is not None and \
+                    process_start_time(info["pid"]) == info["pid_start"]:
+                proc = SingleMachineSlot(gpus, self.results_folder, machine=machine,
+                                         transport=self._transports.get(machine), cpus=cpus,
+                                         output=self._output)
+                proc.reattach(command_id, que_data, PidProc(info["pid"], info["pid_start"]),
+                              pid_file=info.get("pid_file"), status_file=info.get("status_file"),
+                              cgroup=info.get("cgroup"))
+                self._reattached_ids.add(command_id)
+
+            if proc is None:
+                # Exited while no que manager was running - exit code from its status file
+                return_code = None
+                if not info.get("agent") and info.get("status_file"):
+                    return_code = self._transports.get(machine).exit_status(info["status_file"])
+                if return_code == 0:
+                    logger.info(f"FINISHED proc: {command_id} - before que manager restart")
+                    storage.append(command_id, STATE_FINISHED, return_code=return_code)
+                elif return_code is not None:
+                    logger.info(f"FINISHED proc: {command_id} - before que manager restart "
+                                f"with return code: {return_code}")
+                    storage.append(command_id, STATE_CRASHED, return_code=return_code)
+                else:
+                    logger.warning(f"LOST proc: {command_id} - not running after que manager "
+                                   f"restart ({info})")
+                    storage.append(command_id, STATE_CRASHED, return_code=None, lost=True)
+                continue
+
+            logger.info(f"REATTACHED proc: {command_id} - on {machine} GPUs {gpus}")
+            if job["state"] == STATE_SUSPENDED:
+                # Preemptor is not tracked any more -> resumed
+                proc.signal(signal.SIGCONT)
+            if job["state"] in [STATE_STARTED, STATE_SUSPENDED]:
+                storage.append(command_id, STATE_RUNNING)
+            self._running_que.append(proc)
+
+            runtime = self._estimator.estimate(que_data)
+            runtime = DEFAULT_RUNTIME_ESTIMATE if runtime is None else runtime
+            started = job["times"].get(STATE_STARTED, now)
+            self._proc_ends[command_id] = (machine, gpus, max(now, started + runtime))
+            self._fair_share.start(command_id, que_data["user"], len(gpus), started)
+            self._run_since[command_id] = started
+            self._proc_cpus[command_id] = (machine, cpus, self._resource(que_data)["host_mem"])
+
+        storage.flush()
 
     def clean(self):
-        if os.path.isfile(self._que_lock_file):
-            os.remove(self._que_lock_file)
+        """ Exit - regenerate the csv state files (views) & release the results folder """
+        if self._storage is not None:
+            self._storage.write_views()
+            self._storage.close()
+            self._storage = None
+
+        if self._utilization is not None:
+            self._utilization.stop()
+        self._que_watcher.close()
+        self._child_watcher.close()
+        self._wakeup.close()
+        self._transports.close()
+        for client in self._agents.values():
+            client.close()
+
+        self._manager_lock.release()
 
     @property
     def remote_que_available(self):
-        return not os.path.isfile(self._que_lock_file)
+        """ No other que manager is running on results folder """
+        return not self._manager_lock.is_held_by_other()
 
     @property
     def remote_que_locked(self):
-        return os.path.isfile(self._que_lock_file)
+        """ Que file is being edited by another process """
+        return self._que_lock.is_held_by_other()
+
+    @staticmethod
+    def _resource(que_data: "pd.Series") -> dict:
+        resource = DEFAULT_RESOURCE.copy()
+        resource.update(que_data["preferred_resource"])
+        return resource
 
-    def start_command(self, que_data: pd.Series, machine: str, gpus: List[str]) -> \
-            Tuple[bool, SingleMachineSlot]:
+    async def start_command(self, que_data: "pd.Series", machine: str, gpus: List[str],
+                            cpus: List[int] = None) -> Tuple[bool, SingleMachineSlot]:
         logger.info(f"Starting: {que_data.to_dict()}")
-        proc = SingleMachineSlot(gpus, self.results_folder)
+        limits = None
+        if self._cgroups:
+            resource = self._resource(que_data)
+            limits = dict({"cpus": resource["cpus"], "host_mem": resource["host_mem"]})
+
+        if machine in self._agents:
+            proc = AgentSlot(self._agents[machine], gpus, cpus=cpus, limits=limits)
+        else:
+            proc = SingleMachineSlot(gpus, self.results_folder, machine=machine,
+                                     transport=self._transports.get(machine),
+                                     output=self._output, cpus=cpus,
+                                     limits=limits)
         self._running_que.append(proc)
 
         command = que_data["shell_command"]
         command_id = que_data["command_id"]
 
-        is_running = proc.start_command(command_id, command, que_data)
+        is_running = await proc.start_command_async(command_id, command, que_data)
+
+        # Wake up the que as soon as the proc exits (agent procs are pushed by the agent)
+        if isinstance(proc, SingleMachineSlot):
+            asyncio.ensure_future(self._watch_exit(proc))
 
         return is_running, proc
 
-    def processed_que(self, que_data: pd.Series, from_state: int, to_state: int):
+    async def _watch_exit(self, proc: SingleMachineSlot) -> None:
+        await proc.wait_exit()
+        self._event.set()
+
+    def processed_que(self, que_data: "pd.Series", from_state: str, to_state: str, **info):
         command_id = que_data["command_id"]
 
         self._command_id_crashes.pop(command_id, None)
+        self._dependencies.remove(command_id)
+        self._storage.append(command_id, to_state, data=que_data.to_dict(), **info)
+        self._que_file_dirty = True
+
+    def _parent_state(self, parent: int) -> str:
+        """ Dependency state of a parent job from storage ("finished", "failed" or None -
+            queued / running). Unknown parents are failed """
+        state = self._storage.state(parent)
+        if state == STATE_FINISHED:
+            return "finished"
+        if state in [STATE_CRASHED, STATE_CRASHED_START] or state is None:
+            return "failed"
+        return None
+
+    def _sync_dependencies(self, que_data: "pd.DataFrame") -> "pd.DataFrame":
+        """ Add queued jobs not seen yet to the dependency graph. Jobs of failed parents are
+            cancelled (returns que without them) """
+        dependencies = self._dependencies
+        cancelled = False
+        for command_id, resource in zip(que_data["command_id"], que_data["preferred_resource"]):
+            if command_id in dependencies:
+                continue
+
+            failed = dependencies.add(command_id, [(parent, self._parent_state(parent))
+                                                   for parent in job_parents(resource)])
+            if len(failed) > 0:
+                self._cancel(command_id, failed[0])
+                self._job_ended(command_id, success=False)
+                cancelled = True
+
+        if cancelled:
+            que_data = que_data[~que_data["command_id"].isin(self._storage.processed_ids)]
+        return que_data
+
+    def _cancel(self, command_id: int, parent: int) -> None:
+        logger.info(f"CANCELLED proc: {command_id} - dependency {parent} did not finish")
+        self._storage.append(command_id, STATE_CRASHED, cancelled=True,
+                             failed_dependency=int(parent))
+        self._que_file_dirty = True
+        self._metrics.inc("jobs_cancelled")
+
+    def _job_ended(self, command_id: int, success: bool) -> None:
+        """ Release jobs waiting for command_id (success) or cancel them """
+        if success:
+            if len(self._dependencies.finished(command_id)) > 0:
+                self._run_again = True
+        else:
+            for child in self._dependencies.failed(command_id):
+                self._cancel(child, command_id)
+
+    def _ready_que(self, que_data: "pd.DataFrame") -> "pd.DataFrame":
+        """ Que rows with all parents finished """
+        if len(self._dependencies) <= 0 or len(que_data) <= 0:
+            return que_data
+        return que_data[que_data["command_id"].map(self._dependencies.ready).astype(bool)]
+
+    def _read_control(self) -> None:
+        """ Apply control requests appended (one json per line) since the last read """
+        if not os.path.isfile(self._control_file):
+            return
+
+        with open(self._control_file, "rb") as f:
+            f.seek(self._control_offset)
+            content = f.read()
+        content = content[:content.rfind(b"\n") + 1]
+        self._control_offset += len(content)
+
+        for line in content.splitlines():
+            try:
+                request = json.loads(line)
+            except ValueError:
+                logger.warning(f"[QueManager] Skipping invalid control request: {line}")
+                continue
+
+            if request.get("type") == "stop":
+                command_ids = set(int(x) for x in request.get("command_ids", []))
+                for proc in self._running_que:
+                    if proc.id in command_ids and proc.is_running:
+                        logger.info(f"STOP proc: {proc.id} (requested by "
+                                    f"{request.get('user')})")
+                        self._stop_ids.add(proc.id)
+                        proc.stop()
+                        if proc.id in self._suspended:
+                            proc.signal(signal.SIGCONT)  # stopped procs do not handle SIGTERM
+                        command_ids.discard(proc.id)
+                if len(command_ids) > 0:
+                    logger.warning(f"[QueManager] Cannot stop {sorted(command_ids)} - not "
+                                   f"running")
+            elif request.get("type") == "stop_que":
+                logger.info(f"STOP que: no new procs are started, exit after "
+                            f"{len(self._running_que)} running procs end")
+                self._draining = True
+            else:
+                logger.warning(f"[QueManager] Unknown control request: {request}")
+
+    def _read_que(self) -> "pd.DataFrame":
+        """ Read que file (and rewrite it without processed commands). File I/O only - runs in
+            an executor """
+        import pandas as pd
 
-    def run_que(self):
-        resource_m = self._resource_manager
-        remove_ids = []
-        lock_file = get_lock_file(self.results_folder)
         que_file = get_que_file(self.results_folder)
 
-        while True:
-            if not self.remote_que_locked:
-                time.sleep(1)
+        try:
+            with que_lock(self.results_folder, timeout=DEFAULT_QUE_LOCK_WAIT):
+                que_data = read_remote_que(self.results_folder, storage=self._storage)
+
+                # Preempted checkpoint procs are queued again (same command ids)
+                if len(self._requeue_rows) > 0:
+                    requeued = pd.DataFrame(self._requeue_rows, columns=que_data.columns)
+                    que_data = pd.concat([que_data, requeued], ignore_index=True)
+                    self._requeue_rows = []
+                    self._que_file_dirty = True
+
+                # Remove previously started commands ids and update file (if any was started)
+                if self._que_file_dirty:
+                    que_data.to_csv(que_file, index=False)
+                    self._que_file_dirty = False
+        except QueLockTimeout as e:
+            # Que is being edited -> keep monitoring procs, editor write wakes up the que
+            logger.info(f"Que file locked, not starting new procs this pass ({e})")
+            que_data = pd.DataFrame(columns=QUE_FILE_HEADER.split(","))
+
+        return que_data
 
-            # Wait for lock file to exist
-            while not os.path.isfile(lock_file):
-                time.sleep(1)
-            os.remove(lock_file)
+    def run_que(self):
+        """ Run que manager (blocking) """
+        try:
+            asyncio.run(self.run_que_async())
+        finally:
+            self.clean()
 
-            que_data = read_remote_que(self.results_folder)
+    async def run_que_async(self):
+        storage = self._storage
+        loop = asyncio.get_running_loop()
 
-            # Remove previously started commands ids and update file:
-            que_data = que_data[~(que_data["command_id"].isin(remove_ids))]
-            remove_ids = []
-            que_data.to_csv(que_file, index=False)
+        # Event sources (que file edits, agents, SIGCHLD) are watched by the loop
+        self._event = asyncio.Event()
+        self._wakeup.attach(loop, self._event.set)
 
-            # Generate new lock file
-            with open(lock_file, "w") as f:
-                f.write(str(time.time()))
+        metrics = self._metrics
+        if self._metrics_port is not None:
+            await metrics.serve(self._metrics_port)
 
-            que_data = que_data.sort_values("que_priority")
+        if self._utilization is not None:
+            self._utilization.start()
 
-            # -- Check all procs in que (ordered by priority) and see if any can be started
-            crashed_start_procs = []
-            started_procs = []
-            blocked_gpus = []
-            started_true_procs = []
+        # Wake up when reattached procs exit
+        for proc in self._running_que:
+            if proc.id in self._reattached_ids:
+                asyncio.ensure_future(self._watch_exit(proc))
 
-            for qi, qdata in que_data.iterrows():
-                necessary_resource = DEFAULT_RESOURCE.copy()
-                necessary_resource.update(qdata["preferred_resource"])
+        try:
+            while not (self._draining and len(self._running_que) == 0):
+                # File I/O & telemetry sampling do not block the loop (procs are monitored)
+                with metrics.span("read_que"):
+                    que_data = await loop.run_in_executor(None, self._read_que)
+                with metrics.span("sync_queued"):
+                    storage.sync_queued(que_data)
+                self._que_watcher.mark_seen()
+                self._read_control()
+                que_data = self._sync_dependencies(que_data)
+
+                que_data = self._que_order(que_data)
+
+                with metrics.span("pass"):
+                    await self._run_pass(self._ready_que(que_data))
+                metrics.inc("passes")
+
+                self._update_metrics(len(que_data))
+
+                with metrics.span("wait"):
+                    await self.wait_for_event(self._loop_wait_time)
+        finally:
+            self._wakeup.detach()
+            metrics.close()
+            metrics.write_stats(self._stats_file)
+
+    def _que_order(self, que_data: "pd.DataFrame") -> "pd.DataFrame":
+        """ Que sorted by effective priority - que_priority + fair-share adjustment of the user
+            (file order between equal priorities) """
+        if len(que_data) <= 0:
+            return que_data
+
+        adjustments = self._fair_share.adjustments(que_data["user"].unique(), time.time())
+        priority = que_data["que_priority"] + que_data["user"].map(adjustments)
+        order = priority.reset_index(drop=True).sort_values(kind="stable").index
+        return que_data.iloc[order]
+
+    def _update_metrics(self, no_queued: int) -> None:
+        """ Refresh gauges & write the stats file (at most every DEFAULT_STATS_INTERVAL) - with
+            the last output lines of running procs (in memory tails, no output file is read) """
+        metrics = self._metrics
+        metrics.set("queued_jobs", no_queued)
+        metrics.set("running_jobs", len(self._running_que))
+        metrics.set("starting_jobs", len(self._starting_que))
+        metrics.set("suspended_jobs", len(self._suspended))
+
+        if time.time() - self._stats_time >= DEFAULT_STATS_INTERVAL:
+            metrics.tails = {proc.id: proc.tail(DEFAULT_STATS_TAIL_LINES)
+                             for proc in self._starting_que + self._running_que}
+            metrics.write_stats(self._stats_file)
+            self._stats_time = time.time()
+
+    async def _run_pass(self, que_data: "pd.DataFrame"):
+        from remote_que.placement import GpuState, plan_pass
 
-                no_gpus = necessary_resource["no_gpus"]
+        resource_m = self._resource_manager
+        storage = self._storage
+        loop = asyncio.get_running_loop()
+
+        # -- Check all procs in que (ordered by priority) and see if any can be started
+        crashed_start_procs = []
+        started_procs = []
+        started_true_procs = []
+
+        metrics = self._metrics
+
+        # -- Reap procs that exited (woken up by their exit) before placing on their GPUs
+        if self._reap_procs() > 0:
+            resource_m.telemetry.invalidate()
+
+        try:
+            # One telemetry sample for the whole pass (cached for telemetry_ttl)
+            with metrics.span("telemetry"):
+                snapshot = await loop.run_in_executor(None, resource_m.new_pass)
+            gpu_state = GpuState.from_snapshot(snapshot)
+            self._update_gpu_mem(snapshot)
+        except RuntimeError as e:
+            logger.warning(f"[ERROR] Crashed availability {e}")
+            gpu_state = None
+
+            for qi, qdata in que_data.iterrows():
                 command_id = qdata["command_id"]
 
-                try:
-                    available_gpus = resource_m.get_availability(necessary_resource)
-                except RuntimeError as e:
-                    logger.warning(f"[ERROR] Crashed availability {e}:: {qdata}")
-                    # After max attempt to start process move it to crashed
-                    if command_id in self._command_id_crashes:
-                        self._command_id_crashes[command_id] += 1
-                        if self._command_id_crashes[command_id] > self._command_id_max_crash:
-                            crashed_start_procs.append(qi)
-                            self._command_id_crashes.pop(command_id)
-                    else:
-                        self._command_id_crashes[command_id] = 1
-
-                    continue
-
-                if len(available_gpus) <= 0:
-                    continue
-
-                # Filter already blocked resources
-                available_gpus = filter_out_gpus(available_gpus, blocked_gpus)
-
-                if len(available_gpus) <= 0:
-                    continue
-
-                # Sample no_gpus
-                gpu_sample, machine, gpus = sample_gpus(available_gpus, no_gpus)
-
-                if len(gpus) != no_gpus:
-                    logger.warning(f"[ERROR] Selecting available gpus did not work "
-                                   f"{available_gpus} - {no_gpus}")
-                    continue
-
-                start_result, last_proc = self.start_command(qdata, machine, gpus)
-                logger.info(f'STARTED proc: {qdata["command_id"]} - success '
-                            f'{start_result} - ({qdata.to_dict()})')
-                print(4)
-
-                started_procs.append(qi)
-                started_true_procs.append(last_proc)
-                blocked_gpus.append(gpu_sample)
-
-            # -- Wait until currently started procs confirm start
-            for proc in started_true_procs:
-                # Wait for proc to start - depends which heuristic
-                proc.wait_start()
-                if proc.crashed:
-                    proc_id = proc.id
-                    # get que id
-                    for qi, row in que_data.loc[started_procs].iterrows():
-                        if row["command_id"] == proc_id:
-                            crashed_start_procs.append(proc_id)
-
-                    crashed_start_procs.append(proc)
-
-            # -- Clean que_data and write what has been processed
-            append_to_csv_file(que_data.loc[started_procs], self._started_file)
-            append_to_csv_file(que_data.loc[crashed_start_procs], self._crashed_start_file)
-
-            # -- Clean que_data
-            for sqi in started_procs:
-                if sqi in que_data.index:
-                    self.processed_que(que_data.loc[sqi], STATE_QUE, STATE_STARTED)
-                    remove_ids.append(que_data.loc[sqi, "command_id"])
-                    que_data = que_data.drop(sqi)
-
-            for cqi in crashed_start_procs:
-                if cqi in que_data.index:
-                    self.processed_que(que_data.loc[cqi], STATE_QUE, STATE_CRASHED)
-                    remove_ids.append(que_data.loc[cqi, "command_id"])
-                    que_data = que_data.drop(cqi)
-            # Update local que file
-
-            # -- Add new running procs to running file
-            for proc in started_true_procs:
-                if proc.is_running:
-                    append_to_csv_file(pd.DataFrame([proc.que_data]), self._running_file)
-
-            # -- Clean finished / crashed procs (from running que, and running file)
-            remove_proc_idx = []
-            for ip, proc in enumerate(self._running_que):
-                if not proc.is_running:
-                    return_code = proc.kill()
-
-                    # Add to finished docs
-                    if return_code == 0:
-                        append_to_csv_file(pd.DataFrame([proc.que_data]), self._finished_file)
-                    else:
-                        append_to_csv_file(pd.DataFrame([proc.que_data]), self._crashed_file)
-                    logger.info(f'FINISHED proc: {proc.id} - with return code: {return_code} '
-                                f' - ({proc.que_data.to_dict()})')
-
-                    # Remove from running file
-                    self.remove_running_id_from_file(proc.id)
-
-                    proc.clean()
-                    remove_proc_idx.append(ip)
-
-            for ip in remove_proc_idx[::-1]:
-                del self._running_que[ip]
-
-            time.sleep(self._loop_wait_time)
-
-            self.consistency_check()
-
-    def remove_running_id_from_file(self, command_id: int):
-        if not os.path.isfile(self._running_file):
+                # After max attempt to start process move it to crashed
+                if command_id in self._command_id_crashes:
+                    self._command_id_crashes[command_id] += 1
+                    if self._command_id_crashes[command_id] > self._command_id_max_crash:
+                        crashed_start_procs.append(qi)
+                        self._command_id_crashes.pop(command_id)
+                else:
+                    self._command_id_crashes[command_id] = 1
+
+        placements = []
+        if gpu_state is not None:
+            with metrics.span("placement"):
+                gpu_state.track_procs(self._tracked_procs())
+                gpu_state.track_cpus(self._proc_cpus.values())
+                if self._utilization is not None:
+                    gpu_state.track_utilization(
+                        self._utilization.utilization(since=self._gpu_starts()))
+                self._resume_suspended(que_data, gpu_state)
+
+        if gpu_state is not None and not self._draining:
+            # Jobs that waited for preempted checkpoint procs take the freed GPUs first
+            if self._preempt and len(self._preempt_first) > 0:
+                first = que_data[que_data["command_id"].isin(self._preempt_first)]
+                self._preempt_first.clear()
+                with metrics.span("preempt"):
+                    placements = plan_pass(
+                        gpu_state, zip(first.index, first["preferred_resource"]),
+                        estimate=lambda qi, metric: self._estimator.estimate(que_data.loc[qi],
+                                                                             metric),
+                        backfill="none", packing=self._packing)
+                    self._preempt_blocked(first, placements, gpu_state)
+
+            placed = set(placement.que_idx for placement in placements)
+            rest = que_data[~que_data.index.isin(placed)]
+            with metrics.span("placement"):
+                placements += plan_pass(
+                    gpu_state, zip(rest.index, rest["preferred_resource"]),
+                    estimate=lambda qi, metric: self._estimator.estimate(que_data.loc[qi],
+                                                                         metric),
+                    backfill=self._backfill, packing=self._packing,
+                    releases=self._predicted_releases(), users=que_data["user"].get,
+                    gpu_caps=self._fair_share.cap if len(self._fair_share.caps) > 0 else None,
+                    user_gpus=self._fair_share.user_gpus()
+                )
+
+            if self._preempt:
+                with metrics.span("preempt"):
+                    self._preempt_blocked(que_data, placements, gpu_state)
+
+        # Launch all placed procs concurrently (wait_time_start is awaited once per burst)
+        with metrics.span("start"):
+            results = await asyncio.gather(*[
+                self.start_command(que_data.loc[placement.que_idx], placement.machine,
+                                   placement.gpus, placement.cpus)
+                for placement in placements
+            ])
+
+        for placement, (start_result, last_proc) in zip(placements, results):
+            qi = placement.que_idx
+            qdata = que_data.loc[qi]
+            logger.info(f'STARTED proc: {qdata["command_id"]} - success '
+                        f'{start_result} - ({qdata.to_dict()})')
+
+            started_procs.append(qi)
+            started_true_procs.append(last_proc)
+
+            runtime = self._estimator.estimate(qdata)
+            runtime = DEFAULT_RUNTIME_ESTIMATE if runtime is None else runtime
+            self._proc_ends[qdata["command_id"]] = (placement.machine, placement.gpus,
+                                                    time.time() + runtime)
+            self._proc_cpus[qdata["command_id"]] = (placement.machine, placement.cpus,
+                                                    self._resource(qdata)["host_mem"])
+            self._fair_share.start(qdata["command_id"], qdata["user"], len(placement.gpus),
+                                   time.time())
+            self._run_since[qdata["command_id"]] = time.time()
+
+        # All procs started on an agent in this pass are sent in one batch
+        for client in self._agents.values():
+            client.flush()
+
+        # -- Journal what has been processed (removed from que file in next pass)
+        now = time.time()
+        for sqi, proc in zip(started_procs, started_true_procs):
+            job = storage.job(que_data.loc[sqi]["command_id"])
+            if job is not None and STATE_QUE in job["times"]:
+                metrics.observe_job("queue_wait", now - job["times"][STATE_QUE])
+            self.processed_que(que_data.loc[sqi], STATE_QUE, STATE_STARTED, **proc.proc_info())
+        metrics.inc("jobs_started", len(started_procs))
+
+        for cqi in crashed_start_procs:
+            self.processed_que(que_data.loc[cqi], STATE_QUE, STATE_CRASHED_START)
+            self._job_ended(que_data.loc[cqi]["command_id"], success=False)
+        metrics.inc("jobs_crashed_start", len(crashed_start_procs))
+
+        # -- Check (non-blocking) start confirmation of procs started in this or previous passes
+        self._starting_que.extend(started_true_procs)
+        self.check_started_procs()
+
+        # -- Stop preempted checkpoint procs at the end of their grace period
+        for proc, deadline in list(self._requeue.values()):
+            if time.time() >= deadline:
+                logger.info(f"STOP preempted proc: {proc.id} - checkpoint grace period ended")
+                proc.stop()
+                self._requeue[proc.id] = (proc, float("inf"))
+
+        # -- Rotate output files of running procs
+        for proc in self._running_que:
+            if isinstance(proc, SingleMachineSlot):
+                proc.rotate_output()
+
+        # -- Procs that ended during this pass free their GPUs in the next one (now)
+        reaped = self._reap_procs()
+        if reaped > 0:
+            self._run_again = True
+
+        # GPU usage changed -> next pass needs a new telemetry sample
+        if len(started_true_procs) > 0 or reaped > 0:
+            resource_m.telemetry.invalidate()
+
+        # One (fsync-ed) storage write per pass
+        with metrics.span("storage"):
+            storage.flush()
+            storage.maybe_compact()
+
+    def _reap_procs(self) -> int:
+        """ Journal finished / crashed procs & remove them from the running que (their GPUs
+            are free for placement). Returns the no. of removed procs """
+        storage, metrics = self._storage, self._metrics
+        remove_proc_idx = []
+        for ip, proc in enumerate(self._running_que):
+            if not proc.is_running:
+                start_crashed = proc.start_state == START_CRASHED
+                requeued = not start_crashed and proc.id in self._requeue
+                return_code = proc.kill()
+
+                # Add to finished docs (crashed at start procs are already logged)
+                if start_crashed:
+                    pass
+                elif requeued:
+                    # Preempted checkpoint proc - queued again (resumes from its checkpoint)
+                    storage.append(proc.id, STATE_QUE, return_code=return_code, requeued=True)
+                    self._requeue_rows.append(proc.que_data.to_dict())
+                    metrics.inc("jobs_requeued")
+                elif return_code == PidProc.EXIT_UNKNOWN:
+                    # Reattached proc killed before its shell wrote the exit code
+                    storage.append(proc.id, STATE_CRASHED, return_code=None, exit_unknown=True)
+                    metrics.inc("jobs_crashed")
+                elif return_code == 0:
+                    storage.append(proc.id, STATE_FINISHED, return_code=return_code,
+                                   gpu_mem=self._gpu_mem.get(proc.id))
+                    self._estimator.add_job(storage.job(proc.id))
+                    metrics.inc("jobs_finished")
+                elif proc.id in self._stop_ids:
+                    storage.append(proc.id, STATE_CRASHED, return_code=return_code, stopped=True)
+                    metrics.inc("jobs_stopped")
+                else:
+                    storage.append(proc.id, STATE_CRASHED, return_code=return_code)
+                    metrics.inc("jobs_crashed")
+
+                job = storage.job(proc.id)
+                if not start_crashed and job is not None and STATE_STARTED in job["times"]:
+                    metrics.observe_job("run_time", time.time() - job["times"][STATE_STARTED])
+                logger.info(f'FINISHED proc: {proc.id} - with return code: {return_code} '
+                            f' - ({proc.que_data.to_dict()})')
+
+                proc.clean()
+                if not requeued:
+                    self._job_ended(proc.id, success=not start_crashed and return_code == 0)
+                self._preempted_end(proc.id)
+                self._proc_ends.pop(proc.id, None)
+                self._proc_cpus.pop(proc.id, None)
+                self._fair_share.end(proc.id, time.time())
+                self._gpu_mem.pop(proc.id, None)
+                self._stop_ids.discard(proc.id)
+                self._reattached_ids.discard(proc.id)
+                remove_proc_idx.append(ip)
+
+        for ip in remove_proc_idx[::-1]:
+            del self._running_que[ip]
+        return len(remove_proc_idx)
+
+    def _update_gpu_mem(self, snapshot) -> None:
+        """ Track peak GPU memory (per GPU) of running procs - matched by PID in the telemetry
+            sample (procs whose PIDs are not visible are not tracked) """
+        if len(snapshot.procs) <= 0:
             return
-        # Remove from running que
-        # TODO should be cleanner & more save
-        running = pd.read_csv(self._running_file)
-        running_id = running[running["command_id"] == command_id].index
-        for i in running_id:
-            running = running.drop(i)
-        running.to_csv(self._running_file, index=False)
 
-    def consistency_check(self):
-        # TODO Should check running file if procs are still in class (e.g. may have been killed)
-        pass
+        used_memory = snapshot.procs.groupby(["machine", "pid"])["used_memory"].max()
+        for proc in self._running_que:
+            keys = [(proc.machine, str(pid)) for pid in proc.pids()]
+            used = [used_memory[key] for key in keys if key in used_memory.index]
+            if len(used) > 0:
+                self._gpu_mem[proc.id] = max(self._gpu_mem.get(proc.id, 0), float(max(used)))
+
+    def _resume_suspended(self, que_data: "pd.DataFrame", gpu_state: "GpuState") -> None:
+        """ Resume (SIGCONT) suspended procs whose preemptors left the que & ended, if their
+            GPUs match their max_procs_on_gpu again (memory is still held on the GPUs) """
+        if len(self._suspended) <= 0:
+            return
 
+        active = set(que_data["command_id"]) | set(proc.id for proc in self._running_que)
+        now = time.time()
+        for command_id, suspended in sorted(self._suspended.items(), key=lambda x: (
+                x[1]["proc"].que_data["que_priority"], x[1]["time"])):
+            if any(preemptor in active for preemptor in suspended["preemptors"]):
+                continue
 
-def start_remote_que(remote_que_file: str, results_folder: str,
-                     gpu_ids: List[int], procs_per_gpu: Union[int, List[int]]):
-    import os
-    os.spawnl(os.P_DETACH, 'python test_gpu.py')
+            proc, (machine, gpus, end_time) = suspended["proc"], suspended["end"]
+            if not gpu_state.can_resume(machine, gpus, self._resource(proc.que_data)):
+                continue
 
-    que_manager = QueManager(remote_que_file, results_folder, gpu_ids, procs_per_gpu)
+            logger.info(f"RESUMED proc: {command_id} - on {machine} GPUs {gpus}")
+            proc.signal(signal.SIGCONT)
+            del self._suspended[command_id]
+            self._proc_ends[command_id] = (machine, gpus, end_time + now - suspended["time"])
+            self._fair_share.start(command_id, proc.que_data["user"], len(gpus), now)
+            self._run_since[command_id] = now
+            self._storage.append(command_id, STATE_RUNNING, resumed=True)
+            self._metrics.inc("jobs_resumed")
+
+    def _preempt_blocked(self, que_data: "pd.DataFrame", placements: list,
+                         gpu_state: "GpuState") -> None:
+        """ Preempt running procs for queued jobs not placed in this pass (que order, up to
+            DEFAULT_PREEMPT_MAX_JOBS). Victims have a que_priority worse by at least the
+            priority gap & ran at least DEFAULT_PREEMPT_MIN_RUNTIME - worst priority first,
+            then the most recently started. Suspended victims keep their GPU memory (only
+            checkpoint victims, stopped & requeued, free it). Jobs freed by suspending victims
+            are added to placements (started in this pass), jobs waiting for checkpoint victims
+            are not preempted for again until those exit """
+        from remote_que.placement import plan_preemption
+
+        now = time.time()
+        victims = []
+        for proc in self._running_que:
+            command_id = proc.id
+            if command_id not in self._proc_ends or command_id in self._requeue or \
+                    command_id in self._stop_ids or proc.start_state == START_PENDING or \
+                    not proc.is_running:
+                continue
+            machine, gpus, _ = self._proc_ends[command_id]
+            since = self._run_since.get(command_id, now)
+            if len(gpus) > 0 and now - since >= DEFAULT_PREEMPT_MIN_RUNTIME:
+                victims.append((proc.que_data["que_priority"], since, proc, machine, gpus))
+        if len(victims) <= 0:
+            return
+        victims.sort(key=lambda v: (-v[0], -v[1]))
+
+        placed = set(placement.que_idx for placement in placements)
+        blocked = que_data[(que_data["que_priority"] + self._preempt_gap <= victims[0][0]) &
+                           ~que_data.index.isin(placed)]
+
+        taken, no_jobs = set(), 0
+        user_gpus = self._fair_share.user_gpus()
+        for qi, qdata in blocked.iterrows():
+            if no_jobs >= DEFAULT_PREEMPT_MAX_JOBS:
+                break
+            command_id = qdata["command_id"]
+            resource = self._resource(qdata)
+            if resource["no_gpus"] <= 0 or command_id in self._preempting:
+                continue
 
-    log_file = "test"
+            cap = self._fair_share.cap(qdata["user"])
+            if cap is not None and user_gpus.get(qdata["user"], 0) + resource["no_gpus"] > cap:
+                continue
+
+            # Suspended victims let the job start now. Otherwise only the checkpoint victims
+            # are preempted - once they exit, suspending the rest (next passes) is enough
+            mem = self._estimator.estimate(qdata, "gpu_mem")
+            eligible = []
+            for priority, _, proc, machine, gpus in victims:
+                if priority >= qdata["que_priority"] + self._preempt_gap and proc not in taken:
+                    checkpoint = self._resource(proc.que_data)["checkpoint"]
+                    eligible.append((proc, machine, gpus,
+                                     self._gpu_mem.get(proc.id, 0.) if checkpoint else 0.))
+            checkpointed = set(proc for proc, _, _, _ in eligible
+                               if self._resource(proc.que_data)["checkpoint"])
+
+            chosen, placement = plan_preemption(
+                gpu_state, qi, resource, [v for v in eligible if v[0] not in checkpointed],
+                mem=mem, place=True, strategy=self._packing)
+            if placement is None:
+                chosen, _ = plan_preemption(gpu_state, qi, resource, eligible, mem=mem)
+                chosen = [proc for proc in chosen if proc in checkpointed]
+            if len(chosen) <= 0:
+                continue
 
-    # Get object index
-    logger.add_filehandler(log_file)
+            no_jobs += 1
+            for proc in chosen:
+                self._preempt_proc(proc, command_id)
+            taken.update(chosen)
+            if placement is not None:
+                placements.append(placement)
+                user_gpus[qdata["user"]] = user_gpus.get(qdata["user"], 0) + len(placement.gpus)
+
+    def _preempt_proc(self, proc: SingleMachineSlot, preemptor: int) -> None:
+        """ Suspend (SIGSTOP) a proc, or ask a checkpoint proc to save a checkpoint (SIGUSR1 -
+            stopped after the grace period & requeued) """
+        command_id, now = proc.id, time.time()
+
+        if self._resource(proc.que_data)["checkpoint"]:
+            logger.info(f"PREEMPT proc: {command_id} - checkpoint & requeue (for {preemptor})")
+            proc.signal(signal.SIGUSR1)
+            self._requeue[command_id] = (proc, now + DEFAULT_PREEMPT_CHECKPOINT_GRACE)
+            self._preempting.setdefault(preemptor, set()).add(command_id)
+            self._metrics.inc("jobs_preempted")
+            return
+
+        if not proc.signal(signal.SIGSTOP):
+            return
+
+        logger.info(f"SUSPENDED proc: {command_id} - preempted by {preemptor}")
+        self._suspended[command_id] = dict({"proc": proc, "preemptors": {preemptor},
+                                            "end": self._proc_ends.pop(command_id),
+                                            "time": now})
+        self._fair_share.end(command_id, now)
+        self._storage.append(command_id, STATE_SUSPENDED, preempted_by=int(preemptor))
+        self._metrics.inc("jobs_preempted")
+
+    def _preempted_end(self, command_id: int) -> None:
+        """ Forget preemption state of an ended proc """
+        self._run_since.pop(command_id, None)
+        self._suspended.pop(command_id, None)
+        if self._requeue.pop(command_id, None) is not None:
+            for preemptor, victims in list(self._preempting.items()):
+                victims.discard(command_id)
+                if len(victims) <= 0:
+                    del self._preempting[preemptor]
+                    self._preempt_first.add(preemptor)
+                    self._run_again = True
+
+    def _tracked_procs(self) -> Dict[Tuple[str, str], int]:
+        """ No. of running que procs per (machine, GPU index) - suspended procs included (they
+            still hold their GPUs) """
+        procs = dict()
+        ends = list(self._proc_ends.values()) + [s["end"] for s in self._suspended.values()]
+        for machine, gpus, _ in ends:
+            for gpu in gpus:
+                procs[(machine, str(gpu))] = procs.get((machine, str(gpu)), 0) + 1
+        return procs
+
+    def _gpu_starts(self) -> Dict[Tuple[str, str], float]:
+        """ Last start / resume of a running que proc per (machine, GPU index) - utilization
+            sampled before does not include the proc """
+        starts = dict()
+        for command_id, (machine, gpus, _) in self._proc_ends.items():
+            since = self._run_since.get(command_id, 0.)
+            for gpu in gpus:
+                starts[(machine, str(gpu))] = max(starts.get((machine, str(gpu)), 0.), since)
+        return starts
+
+    def _predicted_releases(self) -> Dict[Tuple[str, str], List[float]]:
+        """ Predicted end times of running que procs per (machine, GPU index) """
+        releases = dict()
+        for machine, gpus, end_time in self._proc_ends.values():
+            for gpu in gpus:
+                releases.setdefault((machine, str(gpu)), []).append(end_time)
+        return releases
+
+    def check_started_procs(self):
+        """ Resolve start confirmation of started procs without blocking the que """
+        still_starting = []
+        for proc in self._starting_que:
+            start_state = proc.check_start()
+
+            if start_state == START_PENDING:
+                still_starting.append(proc)
+            elif start_state == START_CRASHED:
+                logger.warning(f'CRASHED at start proc: {proc.id} - ({proc.que_data.to_dict()})')
+                if proc.id in self._stop_ids:
+                    self._storage.append(proc.id, STATE_CRASHED_START, stopped=True)
+                else:
+                    self._storage.append(proc.id, STATE_CRASHED_START)
+                self._metrics.inc("jobs_crashed_start")
+            elif proc.is_running:
+                self._storage.append(proc.id, STATE_RUNNING)
+
+        self._starting_que = still_starting
+
+    async def wait_for_event(self, timeout: float) -> bool:
+        """ Wait until a que proc exits, the que file is edited, a start confirmation is due
+            or timeout expires """
+        end_time = time.monotonic() + timeout
+
+        # Jobs released by parents that ended (or GPUs preempted for) in this pass are started
+        # in the next one
+        if self._run_again:
+            self._run_again = False
+            return True
+
+        # Checkpoint procs are stopped after their grace period
+        if len(self._requeue) > 0:
+            next_stop = min(deadline for _, deadline in self._requeue.values()) - time.time()
+            end_time = min(end_time, time.monotonic() + max(next_stop, 0.))
+
+        # Procs waiting for start confirmation must be checked again
+        if len(self._starting_que) > 0:
+            next_check = min(proc.next_start_check() for proc in self._starting_que)
+            end_time = min(end_time, time.monotonic() + next_check)
+
+        while True:
+            remaining = end_time - time.monotonic()
+            if remaining <= 0:
+                return False
+
+            try:
+                await asyncio.wait_for(self._event.wait(),
+                                       min(remaining, self._wakeup.poll_interval))
+            except asyncio.TimeoutError:
+                pass
+
+            # Que file edit detected by polling (no inotify)
+            if self._wakeup.poll():
+                return True
+
+            if not self._event.is_set():
+                continue
+            self._event.clear()
+
+            # SIGCHLD is also received for other children (e.g. nvidia-smi) -> check que procs
+            self._child_watcher.pending()
+            if any(not proc.is_running for proc in self._running_que):
+                return True
+
+            if self._que_watcher.changed():
+                return True
+
+            # Agent procs started / exited (state is pushed, no probing)
+            if any([client.changed() for client in self._agents.values()]):
+                return True
 
 
 def argparse_menu():
@@ -550,7 +1193,85 @@ def argparse_menu():
     parser.add_argument('results_folder', type=str,
                         help='Que manager results folder.')
     parser.add_argument('--loop-sleep', default=10, type=int,
-                        help='How many seconds to pause between que checks.')
+                        help='Max seconds to wait between que checks (proc exits and que '
+                             'file edits wake up the que earlier).')
+    parser.add_argument('--telemetry-backend', default=DEFAULT_TELEMETRY_BACKEND, type=str,
+                        choices=list(TELEMETRY_BACKENDS.keys()),
+                        help='GPU telemetry source (nvml avoids forking nvidia-smi).')
+    parser.add_argument('--telemetry-ttl', default=DEFAULT_TELEMETRY_TTL, type=float,
+                        help='Seconds a GPU telemetry sample is reused between que checks.')
+    parser.add_argument('--storage', default=DEFAULT_STORAGE, type=str, choices=STORAGE_BACKENDS,
+                        help='Job state storage (journal file or sqlite database).')
+    parser.add_argument('--machines', default=None, type=lambda x: x.split(","),
+                        help='Comma separated machines to run procs on (ssh host names). '
+                             f'Default: {",".join(DEFAULT_MACHINES)} (local).')
+    parser.add_argument('--transport', default=DEFAULT_TRANSPORT, type=str, choices=TRANSPORTS,
+                        help='How remote machines are reached (ssh with multiplexed '
+                             'connections, or local - run all machines on this host).')
+    parser.add_argument('--backfill', default=DEFAULT_BACKFILL, type=str, choices=BACKFILL_MODES,
+                        help='Reserve GPUs for the first (easy) or all (conservative) blocked '
+                             'jobs; other jobs use reserved GPUs only if predicted to finish '
+                             'before the reservation (runtimes learned from finished jobs). '
+                             'Default: none - jobs are started in que order while they fit.')
+    parser.add_argument('--packing', default=DEFAULT_PACKING, type=str,
+                        choices=PACKING_STRATEGIES,
+                        help='How jobs are packed on GPUs (default: random free GPUs). Jobs '
+                             'with a known peak GPU memory (preferred_resource mem, or learned '
+                             'from finished jobs) share GPUs while memory fits.')
+    parser.add_argument('--metrics-port', default=DEFAULT_METRICS_PORT, type=int,
+                        help='Serve Prometheus metrics (/metrics) & json stats (/stats) on this '
+                             'local port. Stats are also written to <results_folder>/'
+                             '.stats.json.')
+    parser.add_argument('--output-max-bytes', default=DEFAULT_OUTPUT_MAX_BYTES, type=int,
+                        help='Proc output files are rotated to proc_<id>_out.<n> once they '
+                             'reach this size (checked every que pass, <= 0 - no rotation).')
+    parser.add_argument('--output-keep', default=DEFAULT_OUTPUT_KEEP, type=int,
+                        help='Rotated output segments kept per proc (oldest are deleted).')
+    parser.add_argument('--output-compress', default=DEFAULT_OUTPUT_COMPRESS, type=str,
+                        choices=OUTPUT_COMPRESSIONS,
+                        help='Compression of rotated output segments (zstd needs zstandard).')
+    parser.add_argument('--no-edit', dest='edit', action='store_false',
+                        help='Start without opening the que file in the editor (e.g. restart - '
+                             'procs of the previous que manager are reattached).')
+    parser.add_argument('--cgroups', action='store_true',
+                        help='Run each proc in its own cgroup v2 (needs a writable cgroup v2 - '
+                             'root / delegation) limited to its preferred_resource cpus & '
+                             'host_mem. Procs are always pinned to their cpus.')
+    parser.add_argument('--fair-share-weight', default=DEFAULT_FAIR_SHARE_WEIGHT, type=float,
+                        help='Max que_priority levels added to jobs of users over their fair '
+                             'share of (decayed) GPU hours. Default: 0 - que order only by '
+                             'que_priority.')
+    parser.add_argument('--fair-share-half-life', default=DEFAULT_FAIR_SHARE_HALF_LIFE,
+                        type=lambda x: float(x) * 3600,
+                        help='Half-life (hours) of the GPU hours used by each user '
+                             f'(default: {DEFAULT_FAIR_SHARE_HALF_LIFE / 3600:.0f}).')
+    parser.add_argument('--user-shares', default=None, type=parse_user_values,
+                        help='Fair shares of users: comma separated <user=share>, * for other '
+                             'users (default: 1 each) e.g. alice=2,*=1.')
+    parser.add_argument('--user-gpu-caps', default=None,
+                        type=lambda x: parse_user_values(x, int),
+                        help='Max GPUs used by running procs of a user: comma separated '
+                             '<user=gpus>, * for other users e.g. alice=16,*=8.')
+    parser.add_argument('--preempt', action='store_true',
+                        help='Jobs that cannot be placed suspend (SIGSTOP) running procs with a '
+                             'worse que_priority, resumed once the preempting job ended. Procs '
+                             'with preferred_resource checkpoint True get SIGUSR1 instead, are '
+                             f'stopped {DEFAULT_PREEMPT_CHECKPOINT_GRACE}s later & requeued.')
+    parser.add_argument('--preempt-priority-gap', default=DEFAULT_PREEMPT_PRIORITY_GAP, type=int,
+                        help='Min que_priority difference between a job and the procs it may '
+                             'preempt.')
+    parser.add_argument('--util-interval', default=DEFAULT_UTIL_SAMPLE_INTERVAL, type=float,
+                        help='Seconds between GPU utilization samples (background thread, '
+                             'default: 0 - off). Jobs with preferred_resource max_gpu_util / '
+                             'max_mem_bw_util are then placed only on GPUs with a rolling '
+                             'utilization up to these.')
+    parser.add_argument('--agents', default=None, type=parse_agents,
+                        help='Run procs through node agents (python -m remote_que.agent): '
+                             'comma separated <machine=address>, address is <host:port> or a '
+                             'Unix socket path. Replaces --machines.')
+    parser.add_argument('--agent-token-file', default=None, type=str,
+                        help=f'File with the token agents require (default: {AGENT_TOKEN_ENV} '
+                             f'environment variable).')
 
     args = parser.parse_args()
 
@@ -558,12 +1279,7 @@ def argparse_menu():
 
 
 if __name__ == "__main__":
-    from subprocess import Popen
-
     args = argparse_menu()
 
     que = QueManager(**args.__dict__)
     que.run_que()
-
-
-
@@ -0,0 +1,373 @@
+import bisect
+import heapq
+import itertools
+import json
+import time
+from typing import List, Dict, Tuple, Iterator
+import numpy as np
+
+from remote_que.config import DEFAULT_QUE_PRIORITY, DEFAULT_BACKFILL, DEFAULT_PACKING
+from remote_que.config import DEFAULT_RUNTIME_ESTIMATE, BACKFILL_MODES, PACKING_STRATEGIES
+from remote_que.config import STATE_QUE, STATE_STARTED, STATE_FINISHED, STATE_CRASHED
+from remote_que.config import DEFAULT_FAIR_SHARE_WEIGHT
+from remote_que.estimates import JobEstimator
+from remote_que.fairshare import FairShare, parse_user_values
+from remote_que.placement import GpuState, plan_pass
+from remote_que.storage import JobStorage, get_storage
+from remote_que.telemetry import FakeBackend, GpuTelemetry
+
+
+# Trace jobs are que rows (QUE_FILE_HEADER_TYPE) with these extra fields
+TRACE_FIELDS = dict({
+    "arrival": 0.,  # seconds from trace start
+    "duration": 60.,  # seconds
+    "mem": 1000,  # peak GPU memory (MiB) used per GPU
+    "exit_code": 0,
+})
+
+BENCHMARK_SIZES = [10, 1000, 100000]
+
+# Result keys compared between benchmark runs (scheduler CPU time - lower is better)
+BENCHMARK_CPU_KEYS = ["cpu_per_pass_mean", "cpu_per_pass_p99"]
+BENCHMARK_ROUNDS_JOBS = 10000  # que size x rounds simulated per benchmark (at least 1 round)
+
+
+def trace_job(job: dict, command_id: int) -> dict:
+    """ Trace job with missing fields set to defaults """
+    job = dict(TRACE_FIELDS, **job)
+    job.setdefault("que_priority", DEFAULT_QUE_PRIORITY)
+    job.setdefault("shell_command", f"job_{command_id}")
+    job.setdefault("preferred_resource", dict())
+    job.setdefault("user", "sim")
+    job["command_id"] = command_id
+    return job
+
+
+def read_trace(file_path: str) -> List[dict]:
+    """ Jobs from a jsonl trace file (one job dict per line, see TRACE_FIELDS) """
+    jobs = []
+    with open(file_path, "r") as f:
+        for line in f:
+            if len(line.strip()) > 0:
+                jobs.append(trace_job(json.loads(line), len(jobs) + 1))
+    return jobs
+
+
+def write_trace(file_path: str, jobs: List[dict]) -> None:
+    with open(file_path, "w") as f:
+        for job in jobs:
+            f.write(json.dumps(job) + "\n")
+
+
+def trace_from_storage(storage: JobStorage) -> List[dict]:
+    """ Recorded trace of jobs that ran under a que manager (see JobStorage) """
+    jobs = []
+    for job in storage.jobs_in_state([STATE_FINISHED, STATE_CRASHED]):
+        times = job["times"]
+        if job["data"] is None or STATE_STARTED not in times:
+            continue
+
+        end_time = times.get(STATE_FINISHED, times.get(STATE_CRASHED))
+        arrival = times.get(STATE_QUE, times[STATE_STARTED])
+        data = {k: v for k, v in job["data"].items() if k != "command_id"}
+        jobs.append(dict(data, arrival=arrival, duration=end_time - times[STATE_STARTED],
+                         mem=job["info"].get("gpu_mem") or TRACE_FIELDS["mem"],
+                         exit_code=job["info"].get("return_code", 0)))
+
+    jobs.sort(key=lambda x: x["arrival"])
+    start = jobs[0]["arrival"] if len(jobs) > 0 else 0
+    return [trace_job(dict(job, arrival=job["arrival"] - start), i + 1)
+            for i, job in enumerate(jobs)]
+
+
+def synthetic_trace(no_jobs: int, no_gpus: int = 32, load: float = 1.2, no_templates: int = 50,
+                    no_users: int = 5, crash_rate: float = 0.05, seed: int = 0) -> List[dict]:
+    """ Hyper-parameter sweeps (command templates with their own duration & memory profile)
+        arriving as a Poisson process. load - offered GPU time / cluster GPU time.
+    """
+    rng = np.random.RandomState(seed)
+
+    template_duration = rng.lognormal(np.log(600), 1., size=no_templates)
+    template_mem = rng.choice([2000, 4000, 6000, 8000, 11000], size=no_templates)
+    template_gpus = rng.choice([1, 1, 1, 1, 2, 2, 4], size=no_templates)
+    template_user = rng.randint(no_users, size=no_templates)
+
+    templates = rng.randint(no_templates, size=no_jobs)
+    durations = template_duration[templates] * rng.lognormal(0, 0.2, size=no_jobs)
+    crashed = rng.rand(no_jobs) < crash_rate
+    durations[crashed] *= 0.1
+
+    # Poisson arrivals at a rate matching the offered load
+    gpu_time = (durations * template_gpus[templates]).mean()
+    rate = load * no_gpus / gpu_time
+    arrivals = np.cumsum(rng.exponential(1. / rate, size=no_jobs))
+    arrivals -= arrivals[0]
+
+    jobs = []
+    for i, t in enumerate(templates):
+        jobs.append(trace_job({
+            "arrival": float(arrivals[i]), "duration": float(durations[i]),
+            "mem": int(template_mem[t] * rng.uniform(0.8, 1.)),
+            "exit_code": int(crashed[i]),
+            "que_priority": int(rng.choice([0, 1, 1, 1, 2])),
+            "shell_command": f"python train_{t}.py --lr {rng.choice([0.1, 0.01, 0.001])} "
+                             f"--seed {i}",
+            "preferred_resource": {"no_gpus": int(template_gpus[t])},
+            "user": f"user{template_user[t]}",
+        }, i + 1))
+    return jobs
+
+
+class Simulator:
+    """ Discrete event simulation of the que manager on fake GPUs with a virtual clock.
+
+        A placement pass (same as QueManager - fair-share order, plan_pass, JobEstimator) runs
+        after each batch of simultaneous events (job arrivals & exits). Started jobs use their
+        trace memory on the fake GPUs until they exit; finished jobs are learned by the
+        estimator.
+    """
+    def __init__(self, machines: List[str], no_gpus: int = 8, mem_total: int = 12000,
+                 backfill: str = DEFAULT_BACKFILL, packing: str = DEFAULT_PACKING,
+                 nvlink_pairs: bool = False, seed: int = 0,
+                 fair_share_weight: float = DEFAULT_FAIR_SHARE_WEIGHT,
+                 user_gpu_caps: Dict[str, int] = None):
+        assert backfill in BACKFILL_MODES, f"Unknown backfill {backfill} ({BACKFILL_MODES})"
+        assert packing in PACKING_STRATEGIES, f"Unknown packing {packing} ({PACKING_STRATEGIES})"
+        self.backfill = backfill
+        self.packing = packing
+        self.seed = seed
+        self.fair_share_weight = fair_share_weight
+        self.user_gpu_caps = user_gpu_caps
+
+        # Static layout (& topology) of the fake GPUs
+        backend = FakeBackend(no_gpus=no_gpus, mem_total=mem_total, nvlink_pairs=nvlink_pairs)
+        self._layout = GpuState.from_snapshot(GpuTelemetry(backend, machines).snapshot())
+        self.mem_total = self._layout.mem_free.astype(np.float64)
+
+    @property
+    def no_gpus(self) -> int:
+        return len(self._layout.index)
+
+    def run(self, jobs: List[dict]) -> dict:
+        """ Simulate trace jobs (see trace_job). Returns scheduling metrics (see metrics) """
+        layout = self._layout
+        rng = np.random.RandomState(self.seed)
+        estimator = JobEstimator()
+        fair_share = FairShare(weight=self.fair_share_weight, caps=self.user_gpu_caps)
+
+        mem_used = np.zeros(self.no_gpus)
+        proc_count = np.zeros(self.no_gpus, dtype=np.int64)
+
+        # Event heap - (time, kind - exits before arrivals, job position)
+        events = [(job["arrival"], 1, i) for i, job in enumerate(jobs)]
+        heapq.heapify(events)
+
+        # (que_priority, user) -> positions (que order within a user & priority - the fair-share
+        # adjustment is the same for all jobs of a user)
+        queue = dict()  # type: Dict[Tuple[int, str], List[int]]
+        running = dict()  # position -> (rows, predicted end time)
+        starts = np.full(len(jobs), np.nan)
+        ends = np.full(len(jobs), np.nan)
+        pass_cpu = []
+        busy_time, last_time = 0., None  # GPU seconds with at least one proc
+
+        while len(events) > 0:
+            now = events[0][0]
+            if last_time is not None:
+                busy_time += (now - last_time) * int((proc_count > 0).sum())
+            last_time = now
+
+            while len(events) > 0 and events[0][0] <= now:
+                _, kind, i = heapq.heappop(events)
+                job = jobs[i]
+                if kind == 1:
+                    bisect.insort(queue.setdefault((job["que_priority"], job["user"]), []), i)
+                    continue
+
+                rows, _ = running.pop(i)
+                fair_share.end(i, now)
+                mem_used[rows] -= job["mem"]
+                proc_count[rows] -= 1
+                ends[i] = now
+                if job["exit_code"] == 0:
+                    estimator.add(job, runtime=job["duration"], gpu_mem=job["mem"])
+
+            if len(queue) <= 0:
+                continue
+
+            # -- Scheduler pass (as QueManager._run_pass, without I/O)
+            st = time.process_time()
+            adjustments = fair_share.adjustments(set(user for _, user in queue), now)
+            order = heapq.merge(*[zip(itertools.repeat(priority + adjustments[user]), positions)
+                                  for (priority, user), positions in queue.items()])
+
+            state = GpuState(layout.machine_names, layout.machine, layout.index,
+                             self.mem_total - mem_used, proc_count.copy(), layout.topology)
+            releases = dict()
+            for rows, end_time in running.values():
+                for row in rows:
+                    gpu = (layout.machine_names[layout.machine[row]], layout.index[row])
+                    releases.setdefault(gpu, []).append(end_time)
+
+            placements = plan_pass(
+                state, ((i, jobs[i]["preferred_resource"]) for _, i in order),
+                estimate=lambda i, metric: estimator.estimate(jobs[i], metric),
+                backfill=self.backfill, packing=self.packing, releases=releases, now=now,
+                rng=rng, users=lambda i: jobs[i]["user"],
+                gpu_caps=fair_share.cap if self.user_gpu_caps else None,
+                user_gpus=fair_share.user_gpus()
+            )
+            pass_cpu.append(time.process_time() - st)
+
+            # -- Start placed jobs
+            for placement in placements:
+                i = placement.que_idx
+                job = jobs[i]
+                runtime = estimator.estimate(job)
+                runtime = DEFAULT_RUNTIME_ESTIMATE if runtime is None else runtime
+                running[i] = (placement.rows, now + runtime)
+                mem_used[placement.rows] += job["mem"]
+                proc_count[placement.rows] += 1
+                starts[i] = now
+                fair_share.start(i, job["user"], len(placement.rows), now)
+                heapq.heappush(events, (now + job["duration"], 0, i))
+
+            if len(placements) > 0:
+                placed = set(p.que_idx for p in placements)
+                for key in set((jobs[i]["que_priority"], jobs[i]["user"]) for i in placed):
+                    queue[key] = [i for i in queue[key] if i not in placed]
+                    if len(queue[key]) <= 0:
+                        del queue[key]
+
+        return self.metrics(jobs, starts, ends, busy_time, pass_cpu)
+
+    def metrics(self, jobs: List[dict], starts: np.ndarray, ends: np.ndarray, busy_time: float,
+                pass_cpu: List[float]) -> dict:
+        arrivals = np.array([job["arrival"] for job in jobs])
+        done = ~np.isnan(ends)
+        waits = (starts - arrivals)[done]
+
+        makespan = float(ends[done].max() - arrivals.min()) if done.any() else 0.
+        pass_cpu = np.array(pass_cpu) if len(pass_cpu) > 0 else np.zeros(1)
+
+        return dict({
+            "jobs": len(jobs),
+            "unscheduled": int((~done).sum()),
+            "makespan": makespan,
+            "wait_p50": float(np.percentile(waits, 50)) if done.any() else 0.,
+            "wait_p90": float(np.percentile(waits, 90)) if done.any() else 0.,
+            "wait_p99": float(np.percentile(waits, 99)) if done.any() else 0.,
+            "gpu_utilization": busy_time / (makespan * self.no_gpus) if makespan > 0 else 0.,
+            "passes": len(pass_cpu),
+            "cpu_per_pass_mean": float(pass_cpu.mean()),
+            "cpu_per_pass_p99": float(np.percentile(pass_cpu, 99)),
+            "cpu_total": float(pass_cpu.sum()),
+        })
+
+
+def run_benchmarks(sizes: List[int] = None, machines: int = 4, no_gpus: int = 8,
+                   **kwargs) -> Iterator[Tuple[int, dict]]:
+    """ Simulate synthetic traces of each que size (same seed - comparable between runs).
+        Small ques are simulated several rounds (min CPU time is kept - less noise).
+    """
+    names = [f"node{i}" for i in range(machines)]
+    for size in BENCHMARK_SIZES if sizes is None else sizes:
+        jobs = synthetic_trace(size, no_gpus=machines * no_gpus)
+        simulator = Simulator(names, no_gpus=no_gpus, **kwargs)
+
+        result = simulator.run(jobs)
+        for _ in range(BENCHMARK_ROUNDS_JOBS // size - 1):
+            round_result = simulator.run(jobs)
+            for key in BENCHMARK_CPU_KEYS:
+                result[key] = min(result[key], round_result[key])
+        yield size, result
+
+
+def compare_benchmarks(results: Dict[str, dict], baseline: Dict[str, dict],
+                       tolerance: float) -> List[str]:
+    """ Regressions of results vs. baseline (scheduler CPU time over tolerance, or changed
+        scheduling metrics) """
+    regressions = []
+    for size, result in results.items():
+        if size not in baseline:
+            continue
+
+        for key in BENCHMARK_CPU_KEYS:
+            base = baseline[size][key]
+            if result[key] > base * (1 + tolerance):
+                regressions.append(f"{size} jobs: {key} {result[key] * 1e3:.3f} ms "
+                                   f"(baseline {base * 1e3:.3f} ms)")
+
+        for key in ["unscheduled", "makespan", "wait_p90", "gpu_utilization"]:
+            if not np.isclose(result[key], baseline[size][key]):
+                print(f"[INFO] {size} jobs: {key} changed {baseline[size][key]:.4g} -> "
+                      f"{result[key]:.4g}")
+    return regressions
+
+
+if __name__ == "__main__":
+    # Benchmark suite (python -m remote_que.simulator --save bench.json, later compare runs
+    # with --compare bench.json) or simulate a trace file (--trace)
+    import sys
+    import argparse
+    from remote_que.config import DEFAULT_STORAGE, STORAGE_BACKENDS
+
+    parser = argparse.ArgumentParser(description="Simulate the que manager on fake GPUs.")
+    parser.add_argument("--trace", default=None, type=str,
+                        help="jsonl trace (one job per line, que row & arrival / duration / "
+                             "mem / exit_code). Default: synthetic benchmark suite.")
+    parser.add_argument("--recorded", default=None, type=str,
+                        help="Simulate jobs recorded in a que manager results folder.")
+    parser.add_argument("--storage", default=DEFAULT_STORAGE, choices=STORAGE_BACKENDS,
+                        help="Storage of the recorded results folder.")
+    parser.add_argument("--sizes", default=BENCHMARK_SIZES, type=int, nargs="+",
+                        help="Synthetic que sizes of the benchmark suite.")
+    parser.add_argument("--machines", default=4, type=int)
+    parser.add_argument("--no-gpus", default=8, type=int, help="GPUs per machine.")
+    parser.add_argument("--backfill", default=DEFAULT_BACKFILL, choices=BACKFILL_MODES)
+    parser.add_argument("--packing", default=DEFAULT_PACKING, choices=PACKING_STRATEGIES)
+    parser.add_argument("--fair-share-weight", default=DEFAULT_FAIR_SHARE_WEIGHT, type=float)
+    parser.add_argument("--user-gpu-caps", default=None,
+                        type=lambda x: parse_user_values(x, int),
+                        help="Max GPUs of running jobs per user e.g. user0=8,*=16.")
+    parser.add_argument("--save", default=None, type=str, help="Write results (json).")
+    parser.add_argument("--compare", default=None, type=str,
+                        help="Baseline results (json) - exit code 1 on CPU time regressions.")
+    parser.add_argument("--tolerance", default=0.25, type=float,
+                        help="Allowed relative CPU time increase vs. baseline.")
+    args = parser.parse_args()
+
+    options = dict(backfill=args.backfill, packing=args.packing,
+                   fair_share_weight=args.fair_share_weight, user_gpu_caps=args.user_gpu_caps)
+    names = [f"node{i}" for i in range(args.machines)]
+    if args.trace is not None:
+        runs = [(args.trace, Simulator(names, no_gpus=args.no_gpus, **options)
+                 .run(read_trace(args.trace)))]
+    elif args.recorded is not None:
+        storage = get_storage(args.storage, args.recorded)
+        runs = [(args.recorded, Simulator(names, no_gpus=args.no_gpus, **options)
+                 .run(trace_from_storage(storage)))]
+        storage.close()
+    else:
+        runs = run_benchmarks(args.sizes, args.machines, args.no_gpus, **options)
+
+    results = dict()
+    for name, result in runs:
+        results[str(name)] = result
+        print(f"{name}: makespan {result['makespan'] / 3600:.2f} h | wait p50 / p90 / p99 "
+              f"{result['wait_p50']:.0f} / {result['wait_p90']:.0f} / {result['wait_p99']:.0f} s"
+              f" | GPU utilization {result['gpu_utilization'] * 100:.1f}% | "
+              f"{result['passes']} passes - CPU / pass {result['cpu_per_pass_mean'] * 1e3:.3f} ms"
+              f" (p99 {result['cpu_per_pass_p99'] * 1e3:.3f} ms) | "
+              f"unscheduled {result['unscheduled']}")
+
+    if args.save is not None:
+        with open(args.save, "w") as f:
+            json.dump(results, f, indent=2)
+
+    if args.compare is not None:
+        with open(args.compare, "r") as f:
+            regressions = compare_benchmarks(results, json.load(f), args.tolerance)
+        for regression in regressions:
+            print(f"[REGRESSION] {regression}")
+        sys.exit(1 if len(regressions) > 0 else 0)
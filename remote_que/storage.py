@@ -0,0 +1,240 @@
+import os
+import json
+import time
+import sqlite3
+from typing import List, Dict, TYPE_CHECKING
+
+from remote_que.config import QUE_FILE_HEADER_TYPE
+from remote_que.config import STATE_QUE, STATE_STARTED, STATE_RUNNING, STATE_FINISHED
+from remote_que.config import STATE_CRASHED, STATE_CRASHED_START
+from remote_que.config import get_db_file, get_started_file, get_running_file
+from remote_que.config import get_finished_file, get_crash_file, get_crash_start_file
+from remote_que.config import STORAGE_BACKENDS
+
+if TYPE_CHECKING:
+    import pandas as pd
+
+
+def json_default(obj):
+    # numpy / pandas scalars from que rows
+    if hasattr(obj, "item"):
+        return obj.item()
+    return str(obj)
+
+
+# csv state files (views) -> (path getter, states, jobs that have ever been in states)
+VIEWS = dict({
+    "started": (get_started_file, [STATE_STARTED], True),
+    "running": (get_running_file, [STATE_RUNNING], False),
+    "finished": (get_finished_file, [STATE_FINISHED], False),
+    "crashed": (get_crash_file, [STATE_CRASHED], False),
+    "crashed_start": (get_crash_start_file, [STATE_CRASHED_START], False),
+})
+
+
+class JobStorage:
+    """ Interface for job state storage (que manager & que readers).
+
+        A job is a dict {"state": str, "data": que row dict, "times": {state: time},
+        "info": dict (e.g. return_code)}. Transitions are recorded with append() and made
+        durable with flush() (batched - once per que pass). The csv state files (.started.csv,
+        .running.csv, ...) are views regenerated on demand (write_views - remote-que views,
+        compaction & que manager exit). Only views that jobs entered / left since they were
+        last written are rewritten.
+    """
+    name = None
+
+    def __init__(self, results_folder: str):
+        self.results_folder = results_folder
+        self.processed_ids = set()  # Ids of jobs that left the que
+        self.known_ids = set()
+        self._stale_views = set(VIEWS.keys())  # not known to be current when loaded
+
+    def append(self, command_id: int, state: str, data: dict = None, **info) -> None:
+        raise NotImplementedError
+
+    def flush(self) -> None:
+        raise NotImplementedError
+
+    def job(self, command_id: int) -> dict:
+        raise NotImplementedError
+
+    def jobs_in_state(self, states: List[str], ever: bool = False) -> List[dict]:
+        """ Jobs currently in states (or that have ever been in states) """
+        raise NotImplementedError
+
+    def count_by_state(self) -> Dict[str, int]:
+        raise NotImplementedError
+
+    def queued_by_priority(self, limit: int = None) -> List[dict]:
+        """ Que row data of queued jobs, sorted by que_priority """
+        raise NotImplementedError
+
+    def maybe_compact(self) -> bool:
+        return False
+
+    def close(self) -> None:
+        self.flush()
+
+    def _changed(self, state: str, prev_state: str = None) -> None:
+        # Views the job enters or leaves (a job never leaves the ever-started view)
+        for name, (_, states, ever) in VIEWS.items():
+            if state in states or (prev_state in states and not ever):
+                self._stale_views.add(name)
+
+    def state(self, command_id: int) -> str:
+        job = self.job(command_id)
+        return None if job is None else job["state"]
+
+    def sync_queued(self, que_data: "pd.DataFrame") -> int:
+        """ Record que file rows not known yet as queued jobs. Returns no. of new jobs """
+        new_rows = que_data[~que_data["command_id"].isin(self.known_ids)]
+        for row in new_rows.to_dict("records"):
+            self.append(row["command_id"], STATE_QUE, data=row)
+        return len(new_rows)
+
+    def view(self, states: List[str], ever: bool = False) -> "pd.DataFrame":
+        import pandas as pd
+
+        rows = [job["data"] for job in self.jobs_in_state(states, ever=ever)
+                if job["data"] is not None]
+        return pd.DataFrame(rows, columns=list(QUE_FILE_HEADER_TYPE.keys()))
+
+    def write_views(self) -> List[str]:
+        """ Regenerate the stale csv state files from storage (atomic rename - readers never
+            see a partial file). Returns the names of the rewritten views """
+        written = []
+        for name, (get_file, states, ever) in VIEWS.items():
+            if name not in self._stale_views:
+                continue
+            path = get_file(self.results_folder)
+            self.view(states, ever=ever).to_csv(path + ".tmp", index=False)
+            os.replace(path + ".tmp", path)
+            self._stale_views.discard(name)
+            written.append(name)
+        return written
+
+
+class SqliteStorage(JobStorage):
+    """ Indexed SQLite database (WAL mode). Each flush() commits one transaction. """
+    name = "sqlite"
+
+    SCHEMA = [
+        "CREATE TABLE IF NOT EXISTS jobs ("
+        " command_id INTEGER PRIMARY KEY, state TEXT NOT NULL, que_priority INTEGER,"
+        " user TEXT, data TEXT, times TEXT NOT NULL, info TEXT NOT NULL, updated REAL)",
+        "CREATE INDEX IF NOT EXISTS jobs_state_priority ON jobs (state, que_priority)",
+        "CREATE INDEX IF NOT EXISTS jobs_user_state ON jobs (user, state)",
+        "CREATE TABLE IF NOT EXISTS transitions ("
+        " command_id INTEGER NOT NULL, state TEXT NOT NULL, t REAL NOT NULL)",
+        "CREATE INDEX IF NOT EXISTS transitions_state ON transitions (state, command_id)",
+        "CREATE TABLE IF NOT EXISTS state_counts (state TEXT PRIMARY KEY, n INTEGER NOT NULL)",
+    ]
+
+    def __init__(self, results_folder: str, db_file: str = None):
+        super().__init__(results_folder)
+        self.db_file = get_db_file(results_folder) if db_file is None else db_file
+
+        self._db = sqlite3.connect(self.db_file)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        for statement in self.SCHEMA:
+            self._db.execute(statement)
+        self._db.commit()
+
+        for command_id, state in self._db.execute("SELECT command_id, state FROM jobs"):
+            self.known_ids.add(command_id)
+            if state != STATE_QUE:
+                self.processed_ids.add(command_id)
+
+    @staticmethod
+    def _row_to_job(row) -> dict:
+        state, data, times, info = row
+        return dict({"state": state, "data": None if data is None else json.loads(data),
+                     "times": json.loads(times), "info": json.loads(info)})
+
+    def job(self, command_id: int) -> dict:
+        row = self._db.execute("SELECT state, data, times, info FROM jobs WHERE command_id = ?",
+                               (int(command_id),)).fetchone()
+        return None if row is None else self._row_to_job(row)
+
+    def state(self, command_id: int) -> str:
+        row = self._db.execute("SELECT state FROM jobs WHERE command_id = ?",
+                               (int(command_id),)).fetchone()
+        return None if row is None else row[0]
+
+    def append(self, command_id: int, state: str, data: dict = None, **info) -> None:
+        command_id, now = int(command_id), time.time()
+        job = self.job(command_id)
+        if job is None:
+            job = dict({"state": None, "data": None, "times": dict(), "info": dict()})
+        prev_state = job["state"]
+        self._changed(state, prev_state)
+
+        if data is not None:
+            job["data"] = json.loads(json.dumps(data, default=json_default))
+        job["times"][state] = now
+        job["info"].update(info)
+
+        data = job["data"] or dict()
+        self._db.execute(
+            "INSERT OR REPLACE INTO jobs "
+            "(command_id, state, que_priority, user, data, times, info, updated) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            (command_id, state, data.get("que_priority"), data.get("user"),
+             None if job["data"] is None else json.dumps(job["data"]),
+             json.dumps(job["times"]), json.dumps(job["info"], default=json_default), now)
+        )
+        self._db.execute("INSERT INTO transitions (command_id, state, t) VALUES (?, ?, ?)",
+                         (command_id, state, now))
+
+        # Keep counts per state so status queries do not scan the jobs table
+        if prev_state is not None:
+            self._db.execute("UPDATE state_counts SET n = n - 1 WHERE state = ?", (prev_state,))
+        self._db.execute("INSERT INTO state_counts (state, n) VALUES (?, 1) "
+                         "ON CONFLICT(state) DO UPDATE SET n = n + 1", (state,))
+
+        self.known_ids.add(command_id)
+
+        if state != STATE_QUE:
+            self.processed_ids.add(command_id)
+        else:
+            self.processed_ids.discard(command_id)
+
+    def flush(self) -> None:
+        self._db.commit()
+
+    def jobs_in_state(self, states: List[str], ever: bool = False) -> List[dict]:
+        marks = ",".join("?" * len(states))
+        if ever:
+            query = f"SELECT state, data, times, info FROM jobs WHERE command_id IN " \
+                    f"(SELECT command_id FROM transitions WHERE state IN ({marks}))"
+        else:
+            query = f"SELECT state, data, times, info FROM jobs WHERE state IN ({marks})"
+        return [self._row_to_job(row) for row in self._db.execute(query, list(states))]
+
+    def count_by_state(self) -> Dict[str, int]:
+        return dict(self._db.execute("SELECT state, n FROM state_counts WHERE n > 0"))
+
+    def queued_by_priority(self, limit: int = None) -> List[dict]:
+        query = "SELECT data FROM jobs WHERE state = ? ORDER BY que_priority"
+        params = [STATE_QUE]
+        if limit is not None:
+            query += " LIMIT ?"
+            params.append(limit)
+        return [json.loads(row[0]) for row in self._db.execute(query, params)]
+
+    def close(self) -> None:
+        self.flush()
+        self._db.close()
+
+
+def get_storage(name: str, results_folder: str) -> JobStorage:
+    assert name in STORAGE_BACKENDS, f"Unknown storage {name} (available: {STORAGE_BACKENDS})"
+
+    if name == SqliteStorage.name:
+        return SqliteStorage(results_folder)
+
+    # journal.QueJournal is a JobStorage -> imported here
+    from remote_que.journal import QueJournal
+    return QueJournal(results_folder)
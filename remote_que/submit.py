@@ -0,0 +1,132 @@
+import os
+import io
+import csv
+import json
+import time
+import getpass
+from typing import List, Iterable, Iterator
+
+from remote_que.config import QUE_FILE_HEADER, QUE_FILE_HEADER_TYPE, DEFAULT_QUE_PRIORITY
+from remote_que.config import DEFAULT_LOCK_TIMEOUT, DEFAULT_MAX_EXPANSIONS
+from remote_que.config import get_que_file, get_last_id_file
+from remote_que.locking import que_lock
+from remote_que.que_parser import parse_value
+from remote_que.template import expand_jobs
+from remote_que.dependencies import resolve_dependencies
+
+
+def allocate_command_ids(results_folder: str, no_ids: int) -> List[int]:
+    """ Allocate no_ids new (increasing, time based) command ids. Must be called while
+        holding the exclusive que lock - last allocated id is kept in a file so ids never
+        collide, even if allocated in the same millisecond by different processes.
+    """
+    last_id_file = get_last_id_file(results_folder)
+
+    last_id = 0
+    if os.path.isfile(last_id_file):
+        with open(last_id_file, "r") as f:
+            try:
+                last_id = int(f.read().strip())
+            except ValueError:
+                pass
+
+    first_id = max(int(time.time() * 1000), last_id + 1)
+    command_ids = list(range(first_id, first_id + no_ids))
+
+    if no_ids > 0:
+        with open(last_id_file, "w") as f:
+            f.write(str(command_ids[-1]))
+
+    return command_ids
+
+
+def make_job(shell_command: str, que_priority: int = DEFAULT_QUE_PRIORITY,
+             preferred_resource: dict = None, user: str = None) -> dict:
+    """ Validated que row for a new job (command_id allocated at submit) """
+    job = dict({
+        "que_priority": que_priority,
+        "shell_command": shell_command,
+        "preferred_resource": dict() if preferred_resource is None else preferred_resource,
+        "user": getpass.getuser() if user is None else user,
+        "command_id": 0,
+    })
+
+    for k, v in QUE_FILE_HEADER_TYPE.items():
+        assert isinstance(job[k], v), f"Job {k} should be {v.__name__} (got {job[k]!r})"
+    assert "\n" not in shell_command, "Job shell_command should be a single line"
+
+    return job
+
+
+def _parse_job(job: dict) -> dict:
+    """ Job from a batch file (values may be strings, as read from csv) """
+    job = {k: v for k, v in job.items() if k in QUE_FILE_HEADER_TYPE and v not in (None, "")}
+    job.pop("command_id", None)
+
+    for k in ["que_priority", "preferred_resource"]:
+        if isinstance(job.get(k), str):
+            value = parse_value(job[k], QUE_FILE_HEADER_TYPE[k])
+            assert value is not None, f"Cannot parse job {k}: {job[k]}"
+            job[k] = value
+
+    return make_job(**job)
+
+
+def read_jobs_file(file_path: str) -> Iterator[dict]:
+    """ Jobs from a jsonl file (one json dict per line) or a csv file with a header (que file
+        columns, command_id is ignored).
+    """
+    with open(file_path, "r") as f:
+        if file_path.endswith(".csv"):
+            for row in csv.DictReader(f):
+                yield _parse_job(row)
+        else:
+            for line in f:
+                if len(line.strip()) > 0:
+                    yield _parse_job(json.loads(line))
+
+
+def submit_jobs(results_folder: str, jobs: Iterable[dict], expand: bool = True,
+                timeout: float = DEFAULT_LOCK_TIMEOUT,
+                max_expansions: int = DEFAULT_MAX_EXPANSIONS) -> List[int]:
+    """ Atomically append jobs (see make_job) to the que file. Command templates ([{...}])
+        are expanded to one job per combination - TemplateError (nothing is submitted) if a
+        template expands to more than max_expansions jobs. Job names in depends_on are resolved
+        to the command ids of the jobs of the batch with that name. Returns allocated command
+        ids.
+    """
+    jobs = list(expand_jobs(jobs, max_expansions) if expand else jobs)
+    que_file = get_que_file(results_folder)
+
+    with que_lock(results_folder, timeout=timeout):
+        new_file = not os.path.isfile(que_file) or os.path.getsize(que_file) <= 0
+        command_ids = allocate_command_ids(results_folder, len(jobs))
+        jobs = resolve_dependencies([dict(job, command_id=command_id)
+                                     for job, command_id in zip(jobs, command_ids)])
+
+        buffer = io.StringIO()
+        if new_file:
+            buffer.write(QUE_FILE_HEADER + "\n")
+        else:
+            # Make sure we start on a new line
+            with open(que_file, "rb") as f:
+                f.seek(-1, os.SEEK_END)
+                if f.read(1) != b"\n":
+                    buffer.write("\n")
+
+        writer = csv.writer(buffer, lineterminator="\n")
+        for job in jobs:
+            writer.writerow([job["que_priority"], job["shell_command"],
+                             repr(job["preferred_resource"]), job["user"], job["command_id"]])
+
+        with open(que_file, "a") as f:
+            f.write(buffer.getvalue())
+            f.flush()
+            os.fsync(f.fileno())
+
+    return command_ids
+
+
+def submit(results_folder: str, shell_command: str, **kwargs) -> int:
+    """ Submit one job. Returns its command id """
+    return submit_jobs(results_folder, [make_job(shell_command, **kwargs)])[0]
@@ -0,0 +1,297 @@
+from typing import List, Tuple, Dict, Optional
+import time
+
+from remote_que.config import DEFAULT_TELEMETRY_TTL, GPU_LINK_COSTS
+from remote_que.utils import get_gpu_pids, get_gpu_info, get_gpu_topology, get_cpu_topology
+from remote_que.utils import get_gpu_utilization
+from remote_que.transport import TransportPool
+
+
+GPU_INFO_COLUMNS = ["index", "type", "uuid", "mem_used", "mem_total", "mem_used_percent"]
+GPU_PROCS_COLUMNS = ["gpu_uuid", "pid", "used_memory", "index", "machine"]
+GPU_UTIL_COLUMNS = ["index", "sm_util", "mem_util"]
+
+
+class TelemetryBackend:
+    """ Interface for GPU telemetry sources.
+
+        gpu_info returns one dict per GPU (GPU_INFO_COLUMNS, index as str - nvgpu format) and
+        gpu_procs one dict per compute process (GPU_PROCS_COLUMNS).
+    """
+    name = None
+
+    def gpu_info(self, machine: str) -> List[dict]:
+        raise NotImplementedError
+
+    def gpu_procs(self, machine: str) -> List[dict]:
+        raise NotImplementedError
+
+    def sample(self, machine: str) -> Tuple[List[dict], List[dict]]:
+        """ (gpu_info, gpu_procs) of machine. Called in parallel for different machines """
+        return self.gpu_info(machine), self.gpu_procs(machine)
+
+    def gpu_utilization(self, machine: str) -> Optional[List[dict]]:
+        """ One dict per GPU (GPU_UTIL_COLUMNS - SM & memory bandwidth utilization in %),
+            None if not supported. Sampled by UtilizationSampler (background thread) """
+        return None
+
+    def gpu_topology(self, machine: str) -> Optional[Dict[Tuple[str, str], int]]:
+        """ Link cost between GPU index pairs (lower - closer), None if unknown """
+        return None
+
+    def cpu_topology(self, machine: str) -> Optional[dict]:
+        """ CPU cores per NUMA node, host memory & GPU NUMA nodes (see parse_cpu_topology),
+            None if unknown - CPUs are then not placed / pinned """
+        return None
+
+
+class NvidiaSmiBackend(TelemetryBackend):
+    """ Shell out to nvidia-smi - on remote machines through (multiplexed) ssh connections """
+    name = "nvidia-smi"
+
+    def __init__(self, transports: TransportPool = None):
+        self.transports = TransportPool() if transports is None else transports
+
+    def gpu_info(self, machine: str) -> List[dict]:
+        return get_gpu_info(machine, self.transports.get(machine).run)
+
+    def gpu_procs(self, machine: str) -> List[dict]:
+        procs = get_gpu_pids(machine, self.transports.get(machine).run)
+        if len(procs) <= 0:
+            return []
+        return procs.to_dict("records")
+
+    def gpu_utilization(self, machine: str) -> Optional[List[dict]]:
+        return get_gpu_utilization(machine, self.transports.get(machine).run)
+
+    def gpu_topology(self, machine: str) -> Optional[Dict[Tuple[str, str], int]]:
+        link_costs = get_gpu_topology(machine, self.transports.get(machine).run)
+        return link_costs if len(link_costs) > 0 else None
+
+    def cpu_topology(self, machine: str) -> Optional[dict]:
+        return get_cpu_topology(machine, self.transports.get(machine).run)
+
+
+class NvmlBackend(TelemetryBackend):
+    """ In-process NVML bindings (pip install nvidia-ml-py), no subprocess per sample.
+        Local machine only.
+    """
+    name = "nvml"
+
+    def __init__(self, transports: TransportPool = None):
+        import pynvml
+        self._nvml = pynvml
+        pynvml.nvmlInit()
+
+    def _handles(self):
+        nvml = self._nvml
+        return [nvml.nvmlDeviceGetHandleByIndex(i) for i in range(nvml.nvmlDeviceGetCount())]
+
+    @staticmethod
+    def _str(value) -> str:
+        return value.decode() if isinstance(value, bytes) else value
+
+    def gpu_info(self, machine: str) -> List[dict]:
+        nvml = self._nvml
+        infos = []
+        for i, handle in enumerate(self._handles()):
+            mem = nvml.nvmlDeviceGetMemoryInfo(handle)
+            mem_used, mem_total = mem.used // 2**20, mem.total // 2**20
+            infos.append({
+                "index": str(i),
+                "type": self._str(nvml.nvmlDeviceGetName(handle)),
+                "uuid": self._str(nvml.nvmlDeviceGetUUID(handle)),
+                "mem_used": mem_used,
+                "mem_total": mem_total,
+                "mem_used_percent": 100. * mem_used / mem_total,
+            })
+        return infos
+
+    def gpu_procs(self, machine: str) -> List[dict]:
+        nvml = self._nvml
+        procs = []
+        for i, handle in enumerate(self._handles()):
+            uuid = self._str(nvml.nvmlDeviceGetUUID(handle))
+            for p in nvml.nvmlDeviceGetComputeRunningProcesses(handle):
+                used_memory = (p.usedGpuMemory or 0) // 2**20
+                procs.append({"gpu_uuid": uuid, "pid": str(p.pid), "used_memory": used_memory,
+                              "index": str(i), "machine": machine})
+        return procs
+
+    def gpu_utilization(self, machine: str) -> Optional[List[dict]]:
+        nvml = self._nvml
+        utilization = []
+        for i, handle in enumerate(self._handles()):
+            rates = nvml.nvmlDeviceGetUtilizationRates(handle)
+            utilization.append({"index": str(i), "sm_util": float(rates.gpu),
+                                "mem_util": float(rates.memory)})
+        return utilization
+
+    def cpu_topology(self, machine: str) -> Optional[dict]:
+        return get_cpu_topology(machine)
+
+
+class FakeBackend(TelemetryBackend):
+    """ Simulated GPUs - for benchmarking / testing the scheduler on machines without GPUs """
+    name = "fake"
+
+    def __init__(self, no_gpus: int = 4, mem_total: int = 12000, gpu_type: str = "Fake GPU",
+                 transports: TransportPool = None, nvlink_pairs: bool = False,
+                 no_cpus: int = None, host_mem: int = None):
+        self.no_gpus = no_gpus
+        self.mem_total = mem_total
+        self.gpu_type = gpu_type
+        self.nvlink_pairs = nvlink_pairs
+        self.no_cpus = no_cpus
+        self.host_mem = host_mem
+        self._procs = dict()  # (machine, pid) -> proc dict
+        self._utilization = dict()  # (machine, GPU index) -> (SM %, memory bandwidth %)
+
+    def add_proc(self, machine: str, gpu_index: int, pid: int, used_memory: int) -> None:
+        self._procs[(machine, str(pid))] = {
+            "gpu_uuid": f"GPU-fake-{machine}-{gpu_index}", "pid": str(pid),
+            "used_memory": used_memory, "index": str(gpu_index), "machine": machine
+        }
+
+    def remove_proc(self, machine: str, pid: int) -> None:
+        self._procs.pop((machine, str(pid)), None)
+
+    def set_utilization(self, machine: str, gpu_index: int, sm_util: float,
+                        mem_util: float = 0.) -> None:
+        self._utilization[(machine, str(gpu_index))] = (sm_util, mem_util)
+
+    def gpu_procs(self, machine: str) -> List[dict]:
+        return [p for (m, _), p in self._procs.items() if m == machine]
+
+    def gpu_utilization(self, machine: str) -> Optional[List[dict]]:
+        """ Set by set_utilization (0 - idle) """
+        utilization = []
+        for i in range(self.no_gpus):
+            sm_util, mem_util = self._utilization.get((machine, str(i)), (0., 0.))
+            utilization.append({"index": str(i), "sm_util": sm_util, "mem_util": mem_util})
+        return utilization
+
+    def gpu_info(self, machine: str) -> List[dict]:
+        mem_used = dict()
+        for p in self.gpu_procs(machine):
+            mem_used[p["index"]] = mem_used.get(p["index"], 0) + p["used_memory"]
+
+        infos = []
+        for i in range(self.no_gpus):
+            used = mem_used.get(str(i), 0)
+            infos.append({
+                "index": str(i), "type": self.gpu_type, "uuid": f"GPU-fake-{machine}-{i}",
+                "mem_used": used, "mem_total": self.mem_total,
+                "mem_used_percent": 100. * used / self.mem_total,
+            })
+        return infos
+
+    def gpu_topology(self, machine: str) -> Optional[Dict[Tuple[str, str], int]]:
+        """ With nvlink_pairs: GPUs (2k, 2k + 1) are NVLinked, same PCIe switch in each half """
+        if not self.nvlink_pairs:
+            return None
+
+        link_costs = dict()
+        half = max(1, self.no_gpus // 2)
+        for i in range(self.no_gpus):
+            for j in range(self.no_gpus):
+                if i == j:
+                    link = "X"
+                elif i // 2 == j // 2:
+                    link = "NV"
+                else:
+                    link = "PXB" if i // half == j // half else "SYS"
+                link_costs[(str(i), str(j))] = GPU_LINK_COSTS[link]
+        return link_costs
+
+    def cpu_topology(self, machine: str) -> Optional[dict]:
+        """ With no_cpus: two NUMA nodes, first half of the GPUs on node 0 """
+        if self.no_cpus is None:
+            return None
+
+        half_cpus, half_gpus = max(1, self.no_cpus // 2), max(1, self.no_gpus // 2)
+        numa = dict({0: list(range(half_cpus)), 1: list(range(half_cpus, self.no_cpus))})
+        return dict({"numa": {node: cpus for node, cpus in numa.items() if len(cpus) > 0},
+                     "mem_total": -1 if self.host_mem is None else self.host_mem,
+                     "gpu_numa": {str(i): min(1, i // half_gpus) for i in range(self.no_gpus)}})
+
+
+TELEMETRY_BACKENDS = {
+    NvidiaSmiBackend.name: NvidiaSmiBackend,
+    NvmlBackend.name: NvmlBackend,
+    FakeBackend.name: FakeBackend,
+}
+
+
+def get_telemetry_backend(name: str, **kwargs) -> TelemetryBackend:
+    assert name in TELEMETRY_BACKENDS, f"Unknown telemetry backend {name} " \
+                                       f"(available: {list(TELEMETRY_BACKENDS.keys())})"
+    return TELEMETRY_BACKENDS[name](**kwargs)
+
+
+class GpuSnapshot:
+    """ GPU stats & compute procs of all machines, sampled once """
+    def __init__(self, gpu_infos: List[dict], gpu_procs: List[dict], timestamp: float,
+                 topology: Dict[str, Dict[Tuple[str, str], int]] = None,
+                 cpu_topology: Dict[str, dict] = None):
+        import pandas as pd
+
+        self.timestamp = timestamp
+        self.topology = dict() if topology is None else topology  # machine -> GPU link costs
+        # machine -> CPU topology (see TelemetryBackend.cpu_topology)
+        self.cpu_topology = dict() if cpu_topology is None else cpu_topology
+
+        gpus = pd.DataFrame(gpu_infos, columns=GPU_INFO_COLUMNS + ["machine"])
+        gpus["mem_free"] = gpus["mem_total"] - gpus["mem_used"]
+        gpus["unique_gpu"] = list(zip(gpus["machine"], gpus["index"]))
+        self.gpus = gpus
+
+        self.procs = pd.DataFrame(gpu_procs, columns=GPU_PROCS_COLUMNS)
+
+        # Number of compute procs per unique_gpu
+        self.proc_counts = self.procs.groupby(["machine", "index"]).size()
+        self.proc_counts.index = self.proc_counts.index.to_flat_index()
+
+
+class GpuTelemetry:
+    """ Cached telemetry snapshots. A new sample is taken only when the cached one is older
+        than ttl seconds (or was invalidated - e.g. after procs were started / finished).
+        Machines are sampled in parallel.
+    """
+    def __init__(self, backend: TelemetryBackend, machines: List[str],
+                 ttl: float = DEFAULT_TELEMETRY_TTL, transports: TransportPool = None):
+        self.backend = backend
+        self.machines = machines
+        self.ttl = ttl
+        self.transports = TransportPool() if transports is None else transports
+        self._snapshot = None  # type: GpuSnapshot
+        self._topology = dict()  # machine -> GPU link costs (static - queried once)
+        self._cpu_topology = dict()  # machine -> CPU topology (static - queried once)
+
+    def invalidate(self) -> None:
+        self._snapshot = None
+
+    def _static(self, cache: dict, query) -> dict:
+        """ Static machine info (query(machine) - queried once per machine, in parallel) of
+            machines where it is known """
+        missing = [m for m in self.machines if m not in cache]
+        if len(missing) > 0:
+            cache.update(zip(missing, self.transports.map(query, missing)))
+        return {m: cache[m] for m in self.machines if cache[m] is not None}
+
+    def snapshot(self, force: bool = False) -> GpuSnapshot:
+        now = time.time()
+        if force or self._snapshot is None or now - self._snapshot.timestamp > self.ttl:
+            gpu_infos, gpu_procs = [], []
+            samples = self.transports.map(self.backend.sample, self.machines)
+            for machine, (infos, procs) in zip(self.machines, samples):
+                for info in infos:
+                    gpu_infos.append(dict(info, machine=machine))
+                gpu_procs += procs
+
+            topology = self._static(self._topology, self.backend.gpu_topology)
+            cpu_topology = self._static(self._cpu_topology, self.backend.cpu_topology)
+
+            self._snapshot = GpuSnapshot(gpu_infos, gpu_procs, now, topology, cpu_topology)
+
+        return self._snapshot
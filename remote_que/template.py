@@ -0,0 +1,168 @@
+import re
+import ast
+import itertools
+from typing import List, Iterator, Iterable, Tuple, Any, TYPE_CHECKING
+
+from remote_que.config import DEFAULT_MAX_EXPANSIONS
+
+if TYPE_CHECKING:
+    import pandas as pd
+
+
+TEMPLATE_PATTERN = re.compile(r"\[{([^}]*)}\]")
+GROUP_PATTERN = re.compile(r"^\s*([A-Za-z_]\w*)\s*:(?!:)(.*)$", re.DOTALL)
+
+MAX_RANGE_ARGS = 3
+
+
+class TemplateError(ValueError):
+    pass
+
+
+def _eval_node(node: ast.AST) -> Any:
+    """ Evaluate literals, lists / tuples / sets and range(...) - nothing else """
+    if isinstance(node, ast.Constant):
+        return node.value
+
+    if isinstance(node, (ast.List, ast.Tuple, ast.Set)):
+        values = []
+        for elt in node.elts:
+            value = _eval_node(elt)
+            # Nested ranges are flattened - [range(3), 10] -> 0, 1, 2, 10
+            values.extend(value if isinstance(value, range) else [value])
+        return values
+
+    if isinstance(node, ast.UnaryOp) and isinstance(node.op, (ast.USub, ast.UAdd)):
+        value = _eval_node(node.operand)
+        if isinstance(value, (int, float)):
+            return -value if isinstance(node.op, ast.USub) else value
+
+    if isinstance(node, ast.Call) and isinstance(node.func, ast.Name) \
+            and node.func.id == "range" and len(node.keywords) == 0 \
+            and 0 < len(node.args) <= MAX_RANGE_ARGS:
+        args = [_eval_node(arg) for arg in node.args]
+        if all(isinstance(arg, int) for arg in args):
+            return range(*args)
+
+    raise TemplateError(f"Not allowed in command template: {ast.dump(node)}")
+
+
+def parse_placeholder(expression: str) -> Tuple[str, Any]:
+    """ Placeholder <[group:]values> -> (group or None, values). Values may be a literal,
+        a list / tuple of literals or range(...)
+    """
+    group = None
+    match = GROUP_PATTERN.match(expression)
+    if match is not None:
+        group, expression = match[1], match[2]
+
+    try:
+        tree = ast.parse(expression.strip(), mode="eval")
+    except SyntaxError as e:
+        raise TemplateError(f"Cannot parse command template [{{{expression}}}] ({e})")
+
+    values = _eval_node(tree.body)
+    if not isinstance(values, (list, range)):
+        values = [values]
+
+    return group, values
+
+
+def parse_template(command: str) -> Tuple[List[str], List[Tuple[str, Any]]]:
+    """ Split command to text parts (len(placeholders) + 1) and parsed placeholders """
+    splits, placeholders = [], []
+    position = 0
+    for match in TEMPLATE_PATTERN.finditer(command):
+        splits.append(command[position:match.start()])
+        placeholders.append(parse_placeholder(match[1]))
+        position = match.end()
+    splits.append(command[position:])
+    return splits, placeholders
+
+
+def _combinations(placeholders: List[Tuple[str, Any]]) -> Iterator[list]:
+    """ Placeholders with the same group are zipped, different groups -> product """
+    groups = dict()  # group -> placeholder positions
+    for i, (group, _) in enumerate(placeholders):
+        groups.setdefault(i if group is None else group, []).append(i)
+
+    group_values = []
+    for group, positions in groups.items():
+        values = [placeholders[i][1] for i in positions]
+        if len(set(len(v) for v in values)) > 1:
+            raise TemplateError(f"Zipped template group <{group}> values differ in length")
+        group_values.append((positions, values))
+
+    # product is lazy in its output (only inputs are materialized)
+    for combination in itertools.product(*[range(len(v[0])) for _, v in group_values]):
+        result = [None] * len(placeholders)
+        for value_idx, (positions, values) in zip(combination, group_values):
+            for position, value in zip(positions, values):
+                result[position] = value[value_idx]
+        yield result
+
+
+def _count_combinations(placeholders: List[Tuple[str, Any]]) -> int:
+    sizes = dict()
+    for i, (group, values) in enumerate(placeholders):
+        sizes[i if group is None else group] = len(values)
+
+    count = 1
+    for size in sizes.values():
+        count *= size
+    return count
+
+
+def count_expansions(command: str) -> int:
+    """ Number of commands a template expands to (without expanding it) """
+    return _count_combinations(parse_template(command)[1])
+
+
+def expand_command(command: str, max_expansions: int = DEFAULT_MAX_EXPANSIONS) -> Iterator[str]:
+    """ Lazily expand a command with [{...}] placeholders, e.g.:
+            train.py --lr [{[0.1, 0.01]}] --seed [{range(3)}]      -> 6 commands (product)
+            train.py --lr [{a:[0.1, 0.01]}] --bs [{a:[32, 64]}]    -> 2 commands (zip on <a>)
+        Raises TemplateError (before expanding) for more than max_expansions commands.
+    """
+    splits, placeholders = parse_template(command)
+
+    if len(placeholders) <= 0:
+        yield command
+        return
+
+    count = _count_combinations(placeholders)
+    if count > max_expansions:
+        raise TemplateError(f"Command template expands to {count} commands (max "
+                            f"{max_expansions}): {command}")
+
+    for combination in _combinations(placeholders):
+        parts = [splits[0]]
+        for value, split in zip(combination, splits[1:]):
+            parts.append(str(value))
+            parts.append(split)
+        yield "".join(parts)
+
+
+def expand_que_data(que_data: "pd.DataFrame",
+                    max_expansions: int = DEFAULT_MAX_EXPANSIONS) -> "pd.DataFrame":
+    """ Expand command templates of all que rows (single DataFrame build) """
+    import pandas as pd
+
+    rows = []
+    for row in que_data.to_dict("records"):
+        if TEMPLATE_PATTERN.search(row["shell_command"]) is None:
+            rows.append(row)
+            continue
+
+        # Expanded commands are new jobs (command_id allocated later)
+        for command in expand_command(row["shell_command"], max_expansions):
+            rows.append(dict(row, shell_command=command, command_id=0))
+    return pd.DataFrame(rows, columns=que_data.columns)
+
+
+def expand_jobs(jobs: Iterable[dict],
+                max_expansions: int = DEFAULT_MAX_EXPANSIONS) -> Iterator[dict]:
+    """ Lazily expand command templates of jobs (dicts with a shell_command) """
+    for job in jobs:
+        for command in expand_command(job["shell_command"], max_expansions):
+            yield dict(job, shell_command=command)
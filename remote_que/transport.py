@@ -0,0 +1,393 @@
+import os
+import shlex
+import asyncio
+import signal
+import socket
+import tempfile
+import threading
+import subprocess
+from subprocess import Popen
+from typing import List, Tuple, Dict, Callable, Any, Optional
+from concurrent.futures import ThreadPoolExecutor
+
+from remote_que.logger import logger
+from remote_que.config import LOCAL_MACHINES, DEFAULT_SSH_CONTROL_PERSIST
+from remote_que.config import DEFAULT_SSH_CONNECT_TIMEOUT, TRANSPORTS
+from remote_que.config import DEFAULT_EVENT_POLL_INTERVAL, DEFAULT_KILL_GRACE
+from remote_que.utils import process_start_time
+from remote_que.cgroups import remove_cgroup, remove_cgroup_command
+
+
+def _kill_group(pgid: int, cgroup: str = None) -> None:
+    try:
+        os.killpg(pgid, signal.SIGKILL)
+    except (ProcessLookupError, PermissionError):
+        pass
+    if cgroup is not None:
+        remove_cgroup(cgroup)
+
+
+def terminate_group(pgid: int, grace: float = DEFAULT_KILL_GRACE, cgroup: str = None) -> bool:
+    """ SIGTERM to a local process group (procs are started in their own session - the whole
+        proc tree), SIGKILL to what is left of it after grace seconds - from a timer thread,
+        does not block. The proc cgroup is then killed & removed. False if the group does not
+        exist """
+    try:
+        os.killpg(pgid, signal.SIGTERM if grace > 0 else signal.SIGKILL)
+    except (ProcessLookupError, PermissionError):
+        return False
+
+    if grace > 0:
+        timer = threading.Timer(grace, _kill_group, (pgid, cgroup))
+        timer.daemon = True
+        timer.start()
+    elif cgroup is not None:
+        remove_cgroup(cgroup)
+    return True
+
+
+class Transport:
+    """ How commands reach a machine (telemetry queries & que procs).
+
+        run() executes a short command and returns (return code, stdout). popen() launches a
+        que proc whose stdout / stderr are written to local files - in its own session, so the
+        proc tree is stopped as a whole (kill) and does not get signals of the que manager
+        terminal.
+    """
+    name = None
+
+    def __init__(self, machine: str):
+        self.machine = machine
+
+    def run(self, command: str, timeout: float = None) -> Tuple[int, str]:
+        raise NotImplementedError
+
+    def popen(self, command: str, stdout, stderr, pid_file: str = None) -> Popen:
+        raise NotImplementedError
+
+    async def popen_async(self, command: str, stdout, stderr,
+                          pid_file: str = None) -> "AsyncProc":
+        """ popen() for the asyncio que manager (proc exit is awaitable - AsyncProc.wait) """
+        raise NotImplementedError
+
+    def exit_status(self, status_file: str) -> Optional[int]:
+        """ Exit code a proc shell wrote to status_file (see SingleMachineSlot), which is then
+            removed. None if the proc did not write it (still running or killed) """
+        quoted = shlex.quote(status_file)
+        return_code, out = self.run(f"cat {quoted} && rm -f {quoted}")
+        try:
+            return int(out.strip()) if return_code == 0 else None
+        except ValueError:
+            return None
+
+    def kill(self, proc: Popen, pid_file: str = None, grace: float = DEFAULT_KILL_GRACE,
+             cgroup: str = None) -> None:
+        """ Stop the proc tree - SIGTERM, SIGKILL after grace seconds (see terminate_group).
+            Also cleans up children left running by a proc that has exited & removes its
+            cgroup (path, if it runs in one) """
+        if not terminate_group(proc.pid, grace, cgroup):
+            proc.kill()
+            if cgroup is not None:
+                remove_cgroup(cgroup)
+
+    def signal(self, proc: Popen, sig: int, pid_file: str = None) -> bool:
+        """ Send sig to the proc tree (e.g. SIGSTOP / SIGCONT to suspend / resume it). False if
+            the proc is gone """
+        try:
+            os.killpg(proc.pid, sig)
+        except (ProcessLookupError, PermissionError):
+            return False
+        return True
+
+    def close(self) -> None:
+        pass
+
+
+class AsyncProc:
+    """ Popen interface (poll / kill / pid) of an asyncio subprocess """
+    def __init__(self, process: asyncio.subprocess.Process):
+        self.process = process
+
+    @property
+    def pid(self) -> int:
+        return self.process.pid
+
+    @property
+    def returncode(self) -> int:
+        return self.process.returncode
+
+    def poll(self) -> int:
+        return self.process.returncode
+
+    async def wait(self) -> int:
+        return await self.process.wait()
+
+    def kill(self) -> None:
+        try:
+            self.process.kill()
+        except ProcessLookupError:
+            pass
+
+
+class PidProc:
+    """ Popen interface of a proc that is not a child of this process (reattached after a que
+        manager restart). Identified by PID & start time. Its exit code cannot be waited for
+        (poll() returns EXIT_UNKNOWN once it is gone - see Transport.exit_status) """
+    EXIT_UNKNOWN = -255
+
+    def __init__(self, pid: int, start_time: int):
+        self.pid = pid
+        self.start_time = start_time
+        self.returncode = None
+        self._pidfd = None
+        if hasattr(os, "pidfd_open"):
+            try:
+                self._pidfd = os.pidfd_open(pid)
+            except OSError:
+                pass
+
+    def poll(self) -> int:
+        if self.returncode is None and process_start_time(self.pid) != self.start_time:
+            self.returncode = self.EXIT_UNKNOWN
+            if self._pidfd is not None:
+                os.close(self._pidfd)
+                self._pidfd = None
+        return self.returncode
+
+    async def wait(self) -> int:
+        """ Wait for exit (pidfd is readable when the proc exits, else polled) """
+        while self.poll() is None:
+            if self._pidfd is None:
+                await asyncio.sleep(DEFAULT_EVENT_POLL_INTERVAL)
+                continue
+
+            loop = asyncio.get_running_loop()
+            exited = loop.create_future()
+            pidfd = self._pidfd
+            loop.add_reader(pidfd, lambda: exited.done() or exited.set_result(None))
+            try:
+                await exited
+            finally:
+                loop.remove_reader(pidfd)
+        return self.returncode
+
+    def kill(self) -> None:
+        if self.poll() is None:
+            try:
+                os.kill(self.pid, signal.SIGKILL)
+            except ProcessLookupError:
+                pass
+
+
+class LocalTransport(Transport):
+    """ Run on this machine. Also a stand-in for remote machines (see TransportPool) """
+    name = "local"
+
+    def run(self, command: str, timeout: float = None) -> Tuple[int, str]:
+        process = subprocess.run(command, shell=True, stdout=subprocess.PIPE, timeout=timeout)
+        return process.returncode, process.stdout.decode()
+
+    def exit_status(self, status_file: str) -> Optional[int]:
+        try:
+            with open(status_file) as f:
+                content = f.read()
+            os.remove(status_file)
+            return int(content.strip())
+        except (OSError, ValueError):
+            return None
+
+    def popen(self, command: str, stdout, stderr, pid_file: str = None) -> Popen:
+        return Popen(command, shell=True, stdout=stdout, stderr=stderr, start_new_session=True)
+
+    async def popen_async(self, command: str, stdout, stderr, pid_file: str = None) -> AsyncProc:
+        return AsyncProc(await asyncio.create_subprocess_shell(
+            command, stdout=stdout, stderr=stderr, start_new_session=True
+        ))
+
+
+class SshTransport(Transport):
+    """ Run over one multiplexed ssh connection per machine (ControlMaster). The handshake is
+        done once in connect() - later commands reuse the master connection.
+
+        Remote procs write their PID to pid_file (on the remote machine), as killing the local
+        ssh client does not stop the remote command. The remote proc shell leads its own
+        session (started by sshd) - the remote proc tree is stopped as its process group.
+    """
+    name = "ssh"
+
+    def __init__(self, machine: str, control_persist: int = DEFAULT_SSH_CONTROL_PERSIST,
+                 connect_timeout: int = DEFAULT_SSH_CONNECT_TIMEOUT):
+        super().__init__(machine)
+        self.control_path = os.path.join(tempfile.gettempdir(), "remote_que-ssh-%C")
+        self.control_persist = control_persist
+        self.connect_timeout = connect_timeout
+        self._connected = False
+
+    def _ssh_args(self) -> List[str]:
+        return ["ssh", "-o", "BatchMode=yes",
+                "-o", f"ConnectTimeout={self.connect_timeout}",
+                "-o", "ControlMaster=auto",
+                "-o", f"ControlPath={self.control_path}",
+                "-o", f"ControlPersist={self.control_persist}",
+                self.machine]
+
+    def connect(self) -> bool:
+        """ Start master connection (returns immediately if already running) """
+        if self._connected:
+            return True
+
+        check = subprocess.run(self._ssh_args()[:-1] + ["-O", "check", self.machine],
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        if check.returncode != 0:
+            master = subprocess.run(self._ssh_args()[:-1] + ["-M", "-N", "-f", self.machine],
+                                    stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+            if master.returncode != 0:
+                logger.warning(f"[SshTransport] Cannot connect to {self.machine} "
+                               f"({master.stderr.decode().strip()})")
+                return False
+
+        self._connected = True
+        return True
+
+    def run(self, command: str, timeout: float = None) -> Tuple[int, str]:
+        self.connect()
+        process = subprocess.run(self._ssh_args() + [command], stdout=subprocess.PIPE,
+                                 timeout=timeout)
+        return process.returncode, process.stdout.decode()
+
+    def _remote_args(self, command: str, pid_file: str = None) -> List[str]:
+        # Same working directory as the que manager (shared file system)
+        remote_command = f"cd {shlex.quote(os.getcwd())} && "
+        if pid_file is not None:
+            remote_command += f"echo $$ > {shlex.quote(pid_file)} && "
+        remote_command += f"exec sh -c {shlex.quote(command)}"
+        return self._ssh_args() + [remote_command]
+
+    def popen(self, command: str, stdout, stderr, pid_file: str = None) -> Popen:
+        self.connect()
+        return Popen(self._remote_args(command, pid_file), stdout=stdout, stderr=stderr,
+                     stdin=subprocess.DEVNULL, start_new_session=True)
+
+    async def popen_async(self, command: str, stdout, stderr, pid_file: str = None) -> AsyncProc:
+        await asyncio.get_running_loop().run_in_executor(None, self.connect)
+        process = await asyncio.create_subprocess_exec(
+            *self._remote_args(command, pid_file), stdout=stdout, stderr=stderr,
+            stdin=subprocess.DEVNULL, start_new_session=True
+        )
+        return AsyncProc(process)
+
+    def kill(self, proc: Popen, pid_file: str = None, grace: float = DEFAULT_KILL_GRACE,
+             cgroup: str = None) -> None:
+        # Remote PID may have been reused if the proc has already finished. SIGKILL after grace
+        # (& the cgroup removal) is run by a detached remote shell (this call does not wait)
+        remove = "" if cgroup is None else remove_cgroup_command(cgroup)
+        if pid_file is not None and proc.poll() is None:
+            quoted = shlex.quote(pid_file)
+            escalate = f"sleep {grace}; kill -KILL -- -$p; {remove}"
+            self.run(f"if [ -f {quoted} ]; then p=$(cat {quoted}); rm -f {quoted}; "
+                     f"kill -TERM -- -$p 2>/dev/null || kill -TERM $p; "
+                     f"({escalate}) </dev/null >/dev/null 2>&1 & fi")
+        elif cgroup is not None:
+            self.run(remove)
+        proc.kill()
+
+    def signal(self, proc: Popen, sig: int, pid_file: str = None) -> bool:
+        # Remote process group (the local ssh client only relays the remote command)
+        if pid_file is None or proc.poll() is not None:
+            return False
+        quoted = shlex.quote(pid_file)
+        return_code, _ = self.run(f"p=$(cat {quoted}) && kill -{int(sig)} -- -$p")
+        return return_code == 0
+
+    def close(self) -> None:
+        if self._connected:
+            subprocess.run(self._ssh_args()[:-1] + ["-O", "exit", self.machine],
+                           stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            self._connected = False
+
+
+class TransportPool:
+    """ One (persistent) transport per machine. Machines in LOCAL_MACHINES (or this host name)
+        always use LocalTransport. With transport="local" all machines are run locally (stand-in
+        to test multi machine ques on a single host).
+    """
+    def __init__(self, transport: str = "ssh", **kwargs):
+        assert transport in TRANSPORTS, f"Unknown transport {transport} " \
+                                        f"(available: {TRANSPORTS})"
+        self.transport = transport
+        self.kwargs = kwargs
+        self._transports = dict()  # type: Dict[str, Transport]
+        self._executor = None  # type: ThreadPoolExecutor
+        self._executor_workers = 0
+
+    @staticmethod
+    def is_local(machine: str) -> bool:
+        return machine in LOCAL_MACHINES or machine == socket.gethostname()
+
+    def get(self, machine: str) -> Transport:
+        transport = self._transports.get(machine)
+        if transport is None:
+            if self.transport == LocalTransport.name or self.is_local(machine):
+                transport = LocalTransport(machine)
+            else:
+                transport = SshTransport(machine, **self.kwargs)
+            self._transports[machine] = transport
+        return transport
+
+    def map(self, fn: Callable[[str], Any], machines: List[str]) -> List[Any]:
+        """ Call fn(machine) for all machines in parallel (results in machines order) """
+        if len(machines) <= 1:
+            return [fn(machine) for machine in machines]
+
+        if self._executor_workers < len(machines):
+            if self._executor is not None:
+                self._executor.shutdown(wait=False)
+            self._executor_workers = len(machines)
+            self._executor = ThreadPoolExecutor(max_workers=len(machines),
+                                                thread_name_prefix="remote_que_transport")
+        return list(self._executor.map(fn, machines))
+
+    def connect(self, machines: List[str]) -> List[bool]:
+        """ Open master connections to all machines (in parallel) """
+        def _connect(machine: str) -> bool:
+            transport = self.get(machine)
+            return transport.connect() if isinstance(transport, SshTransport) else True
+        return self.map(_connect, machines)
+
+    def close(self) -> None:
+        for transport in self._transports.values():
+            transport.close()
+        self._transports.clear()
+
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+            self._executor = None
+            self._executor_workers = 0
+
+
+if __name__ == "__main__":
+    # Benchmark: telemetry style queries over the pool (use machine names as arguments, e.g.
+    # python -m remote_que.transport host1 host2 - default runs a local stand-in for 20 nodes)
+    import sys
+    import time
+
+    machines = sys.argv[1:]
+    pool = TransportPool("ssh" if len(machines) > 0 else "local")
+    if len(machines) <= 0:
+        machines = [f"node{i}" for i in range(20)]
+
+    def _query(machine: str) -> int:
+        return pool.get(machine).run("sleep 0.1; hostname")[0]
+
+    pool.connect(machines)
+    for _ in range(3):
+        st = time.time()
+        serial = [_query(m) for m in machines]
+        serial_time = time.time() - st
+
+        st = time.time()
+        parallel = pool.map(_query, machines)
+        print(f"{len(machines)} machines | serial: {serial_time:.3f}s | "
+              f"parallel: {time.time() - st:.3f}s")
+
+    pool.close()
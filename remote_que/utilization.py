@@ -0,0 +1,103 @@
+from typing import Dict, List, Tuple
+import threading
+import time
+import numpy as np
+
+from remote_que.config import DEFAULT_UTIL_WINDOW, DEFAULT_UTIL_MIN_SAMPLES
+from remote_que.logger import logger
+from remote_que.telemetry import TelemetryBackend
+from remote_que.transport import TransportPool
+
+
+class RingBuffer:
+    """ Last size rows of a fixed width float array (the oldest row is overwritten) """
+    def __init__(self, size: int, width: int):
+        self.data = np.full((size, width), np.nan)
+        self.count = 0
+        self._next = 0
+
+    def push(self, row: Tuple[float, ...]) -> None:
+        self.data[self._next] = row
+        self._next = (self._next + 1) % len(self.data)
+        self.count = min(self.count + 1, len(self.data))
+
+    def rows(self) -> np.ndarray:
+        """ Stored rows (not in push order once the buffer wrapped) """
+        return self.data[:self.count]
+
+
+class UtilizationSampler:
+    """ Background thread sampling SM & memory bandwidth utilization of all GPUs every
+        interval seconds. Each GPU keeps its last window samples <(time, SM %, memory %)> in a
+        RingBuffer, so memory is fixed and a sample is O(no. of GPUs).
+
+        Machines whose backend does not report utilization have no samples (unknown).
+    """
+    def __init__(self, backend: TelemetryBackend, machines: List[str], interval: float,
+                 window: int = DEFAULT_UTIL_WINDOW, transports: TransportPool = None):
+        assert interval > 0, f"Utilization sample interval should be positive (got {interval})"
+        self.backend = backend
+        self.machines = machines
+        self.interval = interval
+        self.window = window
+        self.transports = TransportPool() if transports is None else transports
+
+        self._rings = dict()  # type: Dict[Tuple[str, str], RingBuffer]  # (machine, GPU index)
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None  # type: threading.Thread
+
+    def _sample_machine(self, machine: str):
+        try:
+            return self.backend.gpu_utilization(machine)
+        except Exception as e:
+            logger.warning(f"[WARNING] GPU utilization of {machine} failed ({e})")
+            return None
+
+    def sample(self) -> None:
+        """ One sample of all machines (in parallel) """
+        now = time.time()
+        samples = self.transports.map(self._sample_machine, self.machines)
+        with self._lock:
+            for machine, utilization in zip(self.machines, samples):
+                for gpu in utilization or []:
+                    key = (machine, str(gpu["index"]))
+                    if key not in self._rings:
+                        self._rings[key] = RingBuffer(self.window, 3)
+                    self._rings[key].push((now, gpu["sm_util"], gpu["mem_util"]))
+
+    def _run(self) -> None:
+        while not self._stop.is_set():
+            self.sample()
+            self._stop.wait(self.interval)
+
+    def start(self) -> None:
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="gpu-utilization",
+                                            daemon=True)
+            self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout=self.interval)
+            self._thread = None
+
+    def utilization(self, since: Dict[Tuple[str, str], float] = None,
+                    min_samples: int = DEFAULT_UTIL_MIN_SAMPLES
+                    ) -> Dict[Tuple[str, str], Tuple[float, float]]:
+        """ Mean (SM %, memory bandwidth %) per (machine, GPU index) over the window. Samples
+            taken before since[(machine, GPU index)] (e.g. last proc start on the GPU) are
+            ignored - NaN if fewer than min_samples remain """
+        since = dict() if since is None else since
+        with self._lock:
+            rows = {key: ring.rows().copy() for key, ring in self._rings.items()}
+
+        utilization = dict()
+        for key, samples in rows.items():
+            samples = samples[samples[:, 0] >= since.get(key, -np.inf)]
+            if len(samples) < max(min_samples, 1):
+                utilization[key] = (np.nan, np.nan)
+            else:
+                utilization[key] = (float(samples[:, 1].mean()), float(samples[:, 2].mean()))
+        return utilization
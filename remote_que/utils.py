@@ -1,50 +1,71 @@
-import psutil
+import re
 import subprocess
-import pandas as pd
+from typing import Callable, List, Tuple, Dict, Optional, TYPE_CHECKING
 
+from remote_que.config import GPU_LINK_COSTS
 
-def check_if_process_is_running(process_name: str) -> bool:
-    """ Check if there is any running process that contains the given name processName """
+if TYPE_CHECKING:
+    import pandas as pd
 
-    # Iterate over the all the running process
-    for proc in psutil.process_iter():
-        try:
-            # Check if process name contains the given name string.
-            if process_name.lower() in proc.name().lower():
-                return True
-        except (psutil.NoSuchProcess, psutil.AccessDenied, psutil.ZombieProcess):
-            pass
-    return False
+
+GPU_PIDS_SEPARATOR = "--gpus--"
+CPU_TOPOLOGY_SEPARATOR = "--numa--"
+ANSI_PATTERN = re.compile(r"\x1b\[[0-9;]*m")
+
+
+def process_start_time(pid: int) -> Optional[int]:
+    """ Start time of a local process (clock ticks after boot, from /proc). Identifies a process
+        together with its PID (PIDs are reused). None if it does not exist (or is a zombie) """
+    try:
+        with open(f"/proc/{pid}/stat", "rb") as f:
+            stat = f.read()
+    except OSError:
+        return None
+
+    # Fields after the command name (in parentheses, may contain spaces): state is field 3
+    fields = stat[stat.rfind(b")") + 2:].split()
+    if fields[0] in (b"Z", b"X"):
+        return None
+    return int(fields[19])
 
 
-def get_csv_from_string(out: str) -> pd.DataFrame:
+def get_csv_from_string(out: str) -> "pd.DataFrame":
+    import pandas as pd
+
     a = [x for x in out.split("\n") if len(x) > 0]
     a = pd.DataFrame([x.split(",") for x in a])
     return a
 
 
-def get_gpu_pids(machine: str) -> dict:
-    """ Dictionary with list of working pids for each used gpu_id  (FOR COMPUTE PROCS) """
+def _run_local(command: str) -> Tuple[int, str]:
+    process = subprocess.Popen([command], shell=True, stdout=subprocess.PIPE)
+    out, err = process.communicate()
+    return process.returncode, out.decode('ascii')
+
 
-    # TODO implement for external machine command
+def get_gpu_pids(machine: str, run: Callable[[str], Tuple[int, str]] = None) -> "pd.DataFrame":
+    """ Dictionary with list of working pids for each used gpu_id  (FOR COMPUTE PROCS)
+        run(command) -> (return code, stdout) executes commands on machine (default local).
+    """
+    run = _run_local if run is None else run
 
-    # Get pid of Compute processes
-    process = subprocess.Popen(
-        ['nvidia-smi --query-compute-apps=gpu_uuid,pid,used_memory --format=csv,noheader,nounits'],
-        shell=True, stdout=subprocess.PIPE)
-    out, err = process.communicate()
-    procs = get_csv_from_string(out.decode('ascii'))
+    # Get pid of Compute processes and gpu_uuid -> index in one call
+    _, out = run(
+        "nvidia-smi --query-compute-apps=gpu_uuid,pid,used_memory --format=csv,noheader,nounits"
+        " && echo " + GPU_PIDS_SEPARATOR + " && "
+        "nvidia-smi --query-gpu=gpu_uuid,index --format=csv,noheader,nounits"
+    )
+    out_procs, _, out_gpus = out.partition(GPU_PIDS_SEPARATOR)
+
+    procs = get_csv_from_string(out_procs)
     if len(procs) > 0:
         procs.columns = ["gpu_uuid", "pid", "used_memory"]
 
-    # Get gpu gpu_uuid
-    process = subprocess.Popen(
-        ['nvidia-smi --query-gpu=gpu_uuid,index --format=csv,noheader,nounits'],
-        shell=True, stdout=subprocess.PIPE)
-    out, err = process.communicate()
-    gpus = get_csv_from_string(out.decode('ascii'))
-    if len(gpus) > 0:
-        gpus.columns = ["gpu_uuid", "index"]
+    # Get gpu gpu_uuid (none - e.g. CPU only machine)
+    gpus = get_csv_from_string(out_gpus)
+    if len(gpus) <= 0:
+        return procs
+    gpus.columns = ["gpu_uuid", "index"]
 
     # Join GPUs on gpu_uuid to get index
     gpus = gpus.set_index("gpu_uuid")
@@ -55,3 +76,122 @@ def get_gpu_pids(machine: str) -> dict:
     return procs
 
 
+def get_gpu_info(machine: str, run: Callable[[str], Tuple[int, str]] = None) -> List[dict]:
+    """ GPU stats of machine in nvgpu.gpu_info() format """
+    run = _run_local if run is None else run
+
+    _, out = run("nvidia-smi --query-gpu=index,name,uuid,memory.used,memory.total "
+                 "--format=csv,noheader,nounits")
+
+    infos = []
+    for line in out.splitlines():
+        values = [x.strip() for x in line.split(",")]
+        if len(values) != 5:
+            continue
+
+        index, gpu_type, uuid, mem_used, mem_total = values
+        mem_used, mem_total = int(mem_used), int(mem_total)
+        infos.append({
+            "index": index, "type": gpu_type, "uuid": uuid, "mem_used": mem_used,
+            "mem_total": mem_total, "mem_used_percent": 100. * mem_used / mem_total
+        })
+    return infos
+
+
+def get_gpu_utilization(machine: str,
+                        run: Callable[[str], Tuple[int, str]] = None) -> List[dict]:
+    """ SM & memory bandwidth utilization (%, averaged by the driver over its last sample
+        period) of each GPU of machine """
+    run = _run_local if run is None else run
+
+    _, out = run("nvidia-smi --query-gpu=index,utilization.gpu,utilization.memory "
+                 "--format=csv,noheader,nounits")
+
+    utilization = []
+    for line in out.splitlines():
+        values = [x.strip() for x in line.split(",")]
+        if len(values) != 3:
+            continue
+
+        index, sm_util, mem_util = values
+        try:
+            utilization.append({"index": index, "sm_util": float(sm_util),
+                                "mem_util": float(mem_util)})
+        except ValueError:
+            continue  # [N/A] - not supported by the GPU
+    return utilization
+
+
+def parse_gpu_topology(out: str) -> Dict[Tuple[str, str], int]:
+    """ Link costs (see GPU_LINK_COSTS) between GPU index pairs from nvidia-smi topo -m """
+    lines = [ANSI_PATTERN.sub("", line) for line in out.splitlines()]
+    header = [x.strip() for x in lines[0].split("\t")] if len(lines) > 0 else []
+
+    link_costs = dict()
+    for line in lines[1:]:
+        cells = [x.strip() for x in line.split("\t")]
+        if not cells[0].startswith("GPU"):
+            continue
+
+        for column, link in zip(header[1:], cells[1:]):
+            if not column.startswith("GPU"):
+                continue
+            link = "NV" if link.startswith("NV") else link
+            if link in GPU_LINK_COSTS:
+                link_costs[(cells[0][3:], column[3:])] = GPU_LINK_COSTS[link]
+    return link_costs
+
+
+def get_gpu_topology(machine: str,
+                     run: Callable[[str], Tuple[int, str]] = None) -> Dict[Tuple[str, str], int]:
+    """ GPU interconnect of machine - link cost between GPU index pairs (empty if unknown) """
+    run = _run_local if run is None else run
+    code, out = run("nvidia-smi topo -m")
+    return parse_gpu_topology(out) if code == 0 else dict()
+
+
+def parse_cpu_topology(out: str) -> Optional[dict]:
+    """ CPU topology from the output of the get_cpu_topology command:
+            numa        NUMA node -> CPU ids
+            mem_total   host memory (MiB)
+            gpu_numa    GPU index -> NUMA node (GPUs without NUMA affinity are left out)
+        None if the CPUs are unknown """
+    out_cpus, _, out = out.partition(CPU_TOPOLOGY_SEPARATOR)
+    out_mem, _, out_gpus = out.partition(CPU_TOPOLOGY_SEPARATOR)
+
+    numa = dict()
+    for line in out_cpus.splitlines():
+        values = line.strip().split(",")
+        if line.startswith("#") or len(values) != 2 or not values[0].isdigit():
+            continue
+        node = int(values[1]) if values[1].isdigit() else 0
+        numa.setdefault(node, []).append(int(values[0]))
+    if len(numa) <= 0:
+        return None
+
+    mem_total = re.search(r"MemTotal:\s+(\d+)", out_mem)
+    gpu_numa = dict()
+    for line in out_gpus.splitlines():
+        values = line.split()
+        if len(values) == 2 and values[1].isdigit():
+            gpu_numa[values[0]] = int(values[1])
+
+    return dict({"numa": numa,
+                 "mem_total": -1 if mem_total is None else int(mem_total.group(1)) // 1024,
+                 "gpu_numa": gpu_numa})
+
+
+def get_cpu_topology(machine: str, run: Callable[[str], Tuple[int, str]] = None) -> Optional[dict]:
+    """ CPU cores per NUMA node, host memory & NUMA node of each GPU (see parse_cpu_topology)
+        of machine - one call. None if unknown """
+    run = _run_local if run is None else run
+
+    # GPU NUMA node from sysfs (nvidia-smi bus id 00000000:3B:00.0 -> 0000:3b:00.0)
+    code, out = run(
+        "lscpu -p=CPU,NODE && echo " + CPU_TOPOLOGY_SEPARATOR + " && "
+        "grep MemTotal /proc/meminfo && echo " + CPU_TOPOLOGY_SEPARATOR + " && "
+        "(nvidia-smi --query-gpu=index,pci.bus_id --format=csv,noheader 2>/dev/null | "
+        "while IFS=', ' read i b; do b=$(echo ${b#0000} | tr A-F a-f); "
+        "echo $i $(cat /sys/bus/pci/devices/$b/numa_node 2>/dev/null); done)"
+    )
+    return parse_cpu_topology(out) if code == 0 else None
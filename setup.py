@@ -19,10 +19,10 @@ setup(
     description="Remote launch que of linux commands",
     entry_points={
         "console_scripts": [
-            "remote-que=remote_que.cmds:start",
+            "remote-que=remote_que.cmds:main",
         ]
     },
-    packages=find_packages(),
+    packages=find_packages(exclude=["tests", "tests.*"]),
     url="https://github.com/andreicnica/remote_que.git",
     author="Andrei Nica",
     author_email="andreic.nica@gmail.com",
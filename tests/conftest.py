@@ -0,0 +1,11 @@
+import pytest
+
+
+def pytest_configure(config):
+    config.addinivalue_line("markers", "benchmark: scheduler benchmark suite on simulated GPUs "
+                                       "(slow - deselect with -m 'not benchmark')")
+
+
+@pytest.fixture
+def results_folder(tmp_path):
+    return str(tmp_path)
@@ -0,0 +1,44 @@
+import pytest
+
+from remote_que import agent
+from remote_que.agent import FrameReader, encode_frame, is_loopback, parse_address
+
+
+MESSAGES = [{"type": "launch", "jobs": [{"command_id": 1, "command": "echo é"}]},
+            {"type": "events", "events": []}, {"type": "shutdown"}]
+
+
+def test_frames_split_and_batched():
+    data = b"".join(encode_frame(message) for message in MESSAGES)
+
+    # Byte by byte (partial frames are kept)
+    reader = FrameReader()
+    received = []
+    for i in range(len(data)):
+        received += reader.feed(data[i:i + 1])
+    assert received == MESSAGES
+
+    # Several frames in one read
+    assert FrameReader().feed(data) == MESSAGES
+
+
+def test_json_frames(monkeypatch):
+    # Sender without msgpack
+    monkeypatch.setattr(agent, "msgpack", None)
+    data = encode_frame(MESSAGES[0])
+    assert data[4] == agent.CODEC_JSON
+    assert FrameReader().feed(data) == [MESSAGES[0]]
+
+
+@pytest.mark.parametrize("address, expected", [
+    ("node0:7000", ("node0", 7000)),
+    (":7000", ("127.0.0.1", 7000)),
+    ("/tmp/agent.sock", "/tmp/agent.sock"),
+])
+def test_parse_address(address, expected):
+    assert parse_address(address)[1] == expected
+
+
+def test_is_loopback():
+    assert is_loopback("127.0.0.1") and is_loopback("::1") and is_loopback("localhost")
+    assert not is_loopback("0.0.0.0") and not is_loopback("node0")
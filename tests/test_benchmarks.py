@@ -0,0 +1,75 @@
+import os
+import json
+
+import pytest
+
+from remote_que.config import BACKFILL_MODES, PACKING_STRATEGIES
+from remote_que.simulator import BENCHMARK_CPU_KEYS, Simulator, compare_benchmarks
+from remote_que.simulator import run_benchmarks, synthetic_trace
+
+
+# Que sizes simulated (the full suite - simulator.BENCHMARK_SIZES - is run with
+# python -m remote_que.simulator). Results are checked for regressions against a saved
+# baseline (python -m remote_que.simulator --save <file>) if BENCHMARK_BASELINE_ENV is set
+BENCHMARK_TEST_SIZES = [10, 1000]
+BENCHMARK_BASELINE_ENV = "REMOTE_QUE_BENCHMARK_BASELINE"
+BENCHMARK_TOLERANCE = 0.25
+
+
+def result(cpu: float, makespan: float = 100.) -> dict:
+    return dict({key: cpu for key in BENCHMARK_CPU_KEYS}, unscheduled=0, makespan=makespan,
+                wait_p90=1., gpu_utilization=0.5)
+
+
+def test_compare_benchmarks():
+    baseline = {"10": result(1.)}
+    assert compare_benchmarks({"10": result(1.2)}, baseline, tolerance=0.25) == []
+    assert len(compare_benchmarks({"10": result(1.3)}, baseline, tolerance=0.25)) == \
+        len(BENCHMARK_CPU_KEYS)
+
+    # Changed scheduling metrics are reported, not regressions. Sizes without a baseline
+    # are skipped
+    assert compare_benchmarks({"10": result(1., makespan=50.), "1000": result(9.)}, baseline,
+                              tolerance=0.25) == []
+
+
+@pytest.mark.benchmark
+def test_benchmark_suite():
+    results = {str(size): result for size, result in run_benchmarks(BENCHMARK_TEST_SIZES)}
+
+    for size, result in results.items():
+        assert result["jobs"] == int(size)
+        assert result["unscheduled"] == 0
+        assert 0 < result["gpu_utilization"] <= 1
+        assert result["passes"] > 0
+
+    baseline_file = os.environ.get(BENCHMARK_BASELINE_ENV)
+    if baseline_file is not None:
+        with open(baseline_file) as f:
+            regressions = compare_benchmarks(results, json.load(f), BENCHMARK_TOLERANCE)
+        assert regressions == []
+
+
+def simulate(no_jobs: int = 200, **kwargs) -> dict:
+    """ One simulation of a synthetic trace on 4 machines x 8 GPUs """
+    machines = [f"node{i}" for i in range(4)]
+    return Simulator(machines, no_gpus=8, **kwargs).run(synthetic_trace(no_jobs, no_gpus=32))
+
+
+@pytest.mark.benchmark
+def test_simulation_deterministic():
+    # Same trace & seed -> same schedule
+    first, second = simulate(), simulate()
+    for key in ["unscheduled", "makespan", "wait_p50", "wait_p90", "gpu_utilization",
+                "passes"]:
+        assert first[key] == second[key]
+
+
+@pytest.mark.benchmark
+@pytest.mark.parametrize("backfill", BACKFILL_MODES)
+@pytest.mark.parametrize("packing", PACKING_STRATEGIES)
+def test_simulation_policies(backfill, packing):
+    result = simulate(backfill=backfill, packing=packing, fair_share_weight=1.,
+                      user_gpu_caps={"*": 16})
+    assert result["unscheduled"] == 0
+    assert 0 < result["gpu_utilization"] <= 1
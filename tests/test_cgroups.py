@@ -0,0 +1,64 @@
+import os
+import errno
+import subprocess
+
+from remote_que import cgroups
+from remote_que.cgroups import cgroup_command, cgroup_path, remove_cgroup
+from remote_que.config import CGROUP_ROOT
+from remote_que.transport import LocalTransport
+
+
+def test_cgroup_named_by_command_id():
+    assert cgroup_path(1700000000123) == f"{CGROUP_ROOT}/proc_1700000000123"
+    command = cgroup_command(cgroup_path(7), cpus=2, host_mem=1024)
+    assert f"mkdir -p {CGROUP_ROOT}/proc_7 " in command
+    assert f"echo $$ > {CGROUP_ROOT}/proc_7/cgroup.procs" in command
+    assert "$$/" not in command
+
+
+def test_remove_cgroup(tmp_path):
+    path = str(tmp_path / "proc_1")
+    os.mkdir(path)
+    remove_cgroup(path)
+    assert not os.path.exists(path)
+
+    remove_cgroup(path)  # already removed
+
+
+def test_remove_populated_cgroup_retried(tmp_path, monkeypatch):
+    # rmdir of a cgroup with procs left in it fails with EBUSY
+    path = str(tmp_path / "proc_2")
+    os.mkdir(path)
+    open(os.path.join(path, "cgroup.kill"), "w").close()
+    attempts = []
+
+    def busy_rmdir(p):
+        attempts.append(p)
+        raise OSError(errno.EBUSY, "busy")
+
+    monkeypatch.setattr(cgroups.os, "rmdir", busy_rmdir)
+    monkeypatch.setattr(cgroups.threading, "Timer", lambda t, fn, args: FakeTimer(fn, args))
+
+    remove_cgroup(path, attempts=3)
+    assert attempts == [path] * 4
+    with open(os.path.join(path, "cgroup.kill")) as f:
+        assert f.read() == "1"
+
+
+class FakeTimer:
+    def __init__(self, fn, args):
+        self.fn, self.args = fn, args
+        self.daemon = False
+
+    def start(self):
+        self.fn(*self.args)
+
+
+def test_reaped_proc_cgroup_removed(tmp_path):
+    path = str(tmp_path / "proc_3")
+    os.mkdir(path)
+    proc = subprocess.Popen("true", shell=True, start_new_session=True)
+    proc.wait()
+
+    LocalTransport("localhost").kill(proc, cgroup=path)
+    assert not os.path.exists(path)
@@ -0,0 +1,51 @@
+import os
+import json
+import time
+
+import pandas as pd
+import pytest
+
+from remote_que.cmds import main, parse_time
+from remote_que.config import STATE_QUE, STATE_STARTED, STATE_FINISHED
+from remote_que.config import get_stats_file, get_finished_file
+from remote_que.journal import QueJournal
+
+
+def test_parse_time():
+    assert parse_time("1700000000") == 1700000000.
+    assert abs(parse_time("2h") - (time.time() - 7200)) < 60
+    with pytest.raises(ValueError):
+        parse_time("yesterday")
+
+
+def test_status_stats_without_uptime(results_folder, capsys):
+    with open(get_stats_file(results_folder), "w") as f:
+        json.dump(dict({"counters": dict({"passes": 3})}), f)
+
+    main(["status", results_folder])
+    out = capsys.readouterr().out
+    assert "Que manager: not running" in out
+    assert "uptime -, 3 passes, 0 started" in out
+
+
+def test_views_written_on_demand(results_folder, capsys):
+    journal = QueJournal(results_folder, fsync=False)
+    for command_id in [1, 2]:
+        journal.append(command_id, STATE_QUE, data=dict({"command_id": command_id}))
+    journal.append(1, STATE_STARTED)
+    journal.append(1, STATE_FINISHED)
+    journal.close()
+    assert not os.path.isfile(get_finished_file(results_folder))
+
+    main(["views", results_folder])
+    assert "Wrote 5 views" in capsys.readouterr().out
+    assert pd.read_csv(get_finished_file(results_folder))["command_id"].tolist() == [1]
+
+
+def test_running_tail_from_stats(results_folder, capsys):
+    with open(get_stats_file(results_folder), "w") as f:
+        json.dump(dict({"time": time.time(), "tails": dict({"7": ["epoch 1", "epoch 2"]})}), f)
+
+    main(["running", results_folder, "--tail"])
+    out = capsys.readouterr().out
+    assert "-- 7\n  epoch 1\n  epoch 2" in out
@@ -0,0 +1,64 @@
+import pytest
+
+from remote_que.dependencies import DependencyError, DependencyGraph
+from remote_que.dependencies import job_parents, resolve_dependencies
+
+
+def job(command_id, **resource):
+    return dict({"command_id": command_id, "preferred_resource": resource})
+
+
+def test_job_parents():
+    assert job_parents({}) == []
+    assert job_parents({"depends_on": 3}) == [3]
+    assert job_parents({"depends_on": (1, 2)}) == [1, 2]
+
+
+def test_resolve_names_to_command_ids():
+    jobs = [job(1, name="prep"), job(2, name="train"), job(3, name="train"),
+            job(4, depends_on=["train", 1, 1])]
+    resolved = resolve_dependencies(jobs)
+
+    assert resolved[:3] == jobs[:3]
+    assert resolved[3]["preferred_resource"]["depends_on"] == [1, 2, 3]
+
+
+@pytest.mark.parametrize("jobs", [
+    [job(1, depends_on="missing")],
+    [job(1, depends_on=1)],
+    [job(1, depends_on=True)],
+    [job(1, depends_on=2), job(2, depends_on=3), job(3, depends_on=1)],
+])
+def test_resolve_rejects_invalid(jobs):
+    with pytest.raises(DependencyError):
+        resolve_dependencies(jobs)
+
+
+def test_graph_ready_after_all_parents_finished():
+    graph = DependencyGraph()
+    assert graph.add(3, [(1, None), (2, "finished")]) == []
+    assert graph.add(4, [(1, None), (3, None)]) == []
+    assert 3 in graph and not graph.ready(3)
+    assert graph.waiting() == {3: 1, 4: 2}
+
+    assert graph.finished(1) == [3]
+    assert graph.ready(3) and not graph.ready(4)
+    assert graph.finished(3) == [4]
+    assert len(graph) == 0
+
+
+def test_graph_failed_parent_cancels_descendants():
+    graph = DependencyGraph()
+    graph.add(2, [(1, None)])
+    graph.add(3, [(2, None)])
+    graph.add(4, [(5, None)])
+
+    assert sorted(graph.failed(1)) == [2, 3]
+    assert 2 not in graph and 3 not in graph
+    assert graph.waiting() == {4: 1}
+
+
+def test_graph_add_with_failed_parent():
+    graph = DependencyGraph()
+    assert graph.add(2, [(1, "failed"), (3, None)]) == [1]
+    assert 2 not in graph and graph.ready(2)
@@ -0,0 +1,76 @@
+import pytest
+
+from remote_que.config import STATE_STARTED, STATE_FINISHED
+from remote_que.fairshare import FairShare, parse_user_values, job_gpus
+
+
+def test_parse_user_values():
+    assert parse_user_values("alice=2, *=1") == {"alice": 2., "*": 1.}
+    assert parse_user_values("bob=8", int) == {"bob": 8}
+    with pytest.raises(AssertionError):
+        parse_user_values("alice")
+
+
+def test_no_adjustment_without_weight():
+    fair_share = FairShare(weight=0)
+    fair_share.add_usage("alice", 10, t=0)
+    assert fair_share.adjustments(["alice", "bob"], now=0) == {"alice": 0., "bob": 0.}
+
+
+def test_heavy_user_moved_back():
+    fair_share = FairShare(weight=2, half_life=3600)
+    fair_share.add_usage("alice", 10, t=0)
+    fair_share.add_usage("bob", 1, t=0)
+
+    adjustments = fair_share.adjustments(["alice", "bob", "carol"], now=0)
+    assert adjustments["carol"] == 0
+    assert 0 < adjustments["bob"] < adjustments["alice"] < 2
+
+
+def test_bigger_share_smaller_adjustment():
+    fair_share = FairShare(weight=1, shares={"alice": 3})
+    fair_share.add_usage("alice", 5, t=0)
+    fair_share.add_usage("bob", 5, t=0)
+
+    adjustments = fair_share.adjustments(["alice", "bob"], now=0)
+    assert adjustments["alice"] < adjustments["bob"]
+
+
+def test_usage_decay():
+    fair_share = FairShare(half_life=100)
+    fair_share.add_usage("alice", 8, t=0)
+    assert fair_share.usage("alice", now=100) == pytest.approx(4)
+    assert fair_share.usage("alice", now=300) == pytest.approx(1)
+
+    # Stored usage is rescaled when the reference time gets too old
+    fair_share.add_usage("alice", 2, t=100 * 1000)
+    assert fair_share.usage("alice", now=100 * 1000) == pytest.approx(2)
+
+
+def test_running_jobs_charged():
+    fair_share = FairShare(half_life=1e9)
+    fair_share.start("job", "alice", no_gpus=2, t=0)
+    assert fair_share.user_gpus() == {"alice": 2}
+    assert fair_share.usage("alice", now=1800) == pytest.approx(1)
+
+    fair_share.end("job", t=3600)
+    assert fair_share.user_gpus() == {}
+    assert fair_share.usage("alice", now=3600) == pytest.approx(2)
+
+
+def test_add_job_from_storage():
+    job = dict({"state": STATE_FINISHED, "data": {"user": "alice"}, "info": {"gpus": "0,1"},
+                "times": {STATE_STARTED: 0, STATE_FINISHED: 3600}})
+    assert job_gpus(job) == 2
+
+    fair_share = FairShare(half_life=1e9)
+    assert fair_share.add_job(job)
+    assert not fair_share.add_job(dict(job, state=STATE_STARTED))
+    assert fair_share.usage("alice", now=3600) == pytest.approx(2)
+
+
+def test_caps():
+    fair_share = FairShare(caps={"alice": 4, "*": 8})
+    assert fair_share.cap("alice") == 4
+    assert fair_share.cap("bob") == 8
+    assert FairShare().cap("bob") is None
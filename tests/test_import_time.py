@@ -0,0 +1,45 @@
+import os
+import sys
+import subprocess
+from typing import List, Tuple
+
+import pytest
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Module -> (max cumulative import time in seconds, heavy modules it must not import), measured
+# in a cold interpreter (nothing preloaded)
+IMPORT_BUDGETS = dict({
+    "remote_que.cmds": (0.05, ["pandas", "numpy", "psutil", "nvgpu"]),
+    "remote_que.submit": (0.05, ["pandas", "numpy", "psutil", "nvgpu"]),
+    "remote_que.agent": (0.2, ["pandas", "numpy", "nvgpu"]),
+    "remote_que.run_remote_que": (0.2, ["pandas", "numpy", "psutil", "nvgpu"]),
+})
+IMPORT_ROUNDS = 3  # fresh interpreters per module (fastest is kept - less noise)
+
+
+def import_time(module: str, heavy: List[str]) -> Tuple[float, List[str]]:
+    """ Cumulative import time of module in a fresh interpreter (python -X importtime, without
+        interpreter startup) & heavy modules it imported """
+    check = f"import {module}, sys; print(*[m for m in {heavy!r} if m in sys.modules])"
+    process = subprocess.run([sys.executable, "-X", "importtime", "-c", check], cwd=ROOT,
+                             stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=True)
+
+    duration = None
+    for line in process.stderr.decode().splitlines():
+        parts = [x.strip() for x in line.split("|")]
+        if len(parts) == 3 and parts[2] == module:
+            duration = int(parts[1]) / 1e6
+    return duration, process.stdout.decode().split()
+
+
+@pytest.mark.parametrize("module", list(IMPORT_BUDGETS.keys()))
+def test_import_budget(module):
+    budget, heavy = IMPORT_BUDGETS[module]
+    results = [import_time(module, heavy) for _ in range(IMPORT_ROUNDS)]
+
+    assert results[0][1] == [], f"{module} imports {', '.join(results[0][1])}"
+    duration = min(duration for duration, _ in results)
+    assert duration <= budget, f"{module} import took {duration * 1000:.1f} ms " \
+                               f"(budget {budget * 1000:.0f} ms)"
@@ -0,0 +1,101 @@
+import os
+
+import pandas as pd
+
+from remote_que.config import STATE_QUE, STATE_STARTED, STATE_RUNNING, STATE_FINISHED
+from remote_que.config import get_journal_file, get_finished_file, get_running_file
+from remote_que.journal import QueJournal
+
+
+def row(command_id, priority=1):
+    return dict({"que_priority": priority, "shell_command": f"job {command_id}",
+                 "preferred_resource": {}, "user": "u", "command_id": command_id})
+
+
+def test_replay_after_restart(results_folder):
+    journal = QueJournal(results_folder, fsync=False)
+    journal.append(1, STATE_QUE, data=row(1, priority=2))
+    journal.append(2, STATE_QUE, data=row(2, priority=1))
+    journal.append(1, STATE_STARTED, pid=10)
+    journal.append(1, STATE_RUNNING)
+    journal.close()
+
+    journal = QueJournal(results_folder, fsync=False)
+    assert journal.state(1) == STATE_RUNNING
+    assert journal.job(1)["info"] == {"pid": 10}
+    assert set(journal.job(1)["times"]) == {STATE_QUE, STATE_STARTED, STATE_RUNNING}
+    assert journal.processed_ids == {1} and journal.known_ids == {1, 2}
+    assert journal.count_by_state() == {STATE_RUNNING: 1, STATE_QUE: 1}
+    assert [job["command_id"] for job in journal.queued_by_priority()] == [2]
+    assert len(journal.jobs_in_state([STATE_STARTED], ever=True)) == 1
+    journal.close()
+
+
+def test_only_flushed_records_are_durable(results_folder):
+    journal = QueJournal(results_folder, fsync=False)
+    journal.append(1, STATE_QUE, data=row(1))
+    journal.flush()
+    journal.append(1, STATE_STARTED)
+
+    assert QueJournal(results_folder).state(1) == STATE_QUE
+
+
+def test_corrupt_last_line_skipped(results_folder):
+    journal = QueJournal(results_folder, fsync=False)
+    journal.append(1, STATE_QUE, data=row(1))
+    journal.close()
+    with open(get_journal_file(results_folder), "a") as f:
+        f.write('{"t": 1, "id": 1, "s": "fin')
+
+    assert QueJournal(results_folder).state(1) == STATE_QUE
+
+
+def test_requeued_job_is_queued_again(results_folder):
+    journal = QueJournal(results_folder, fsync=False)
+    journal.append(1, STATE_QUE, data=row(1))
+    journal.append(1, STATE_STARTED)
+    journal.append(1, STATE_QUE, requeued=True)
+
+    assert 1 not in journal.processed_ids
+    assert journal.queued_by_priority() == [row(1)]
+
+
+def test_compaction(results_folder):
+    journal = QueJournal(results_folder, fsync=False, compact_min=10)
+    for command_id in range(3):
+        journal.append(command_id, STATE_QUE, data=row(command_id))
+        for state in [STATE_STARTED, STATE_RUNNING, STATE_FINISHED]:
+            journal.append(command_id, state, return_code=0)
+    journal.flush()
+
+    assert journal.maybe_compact()
+    with open(get_journal_file(results_folder)) as f:
+        assert len(f.readlines()) == 3
+    assert not journal.maybe_compact()
+
+    # Same state after replay of the compacted journal & views were written
+    jobs = journal.jobs
+    journal.close()
+    assert QueJournal(results_folder).jobs == jobs
+    assert pd.read_csv(get_finished_file(results_folder))["command_id"].tolist() == [0, 1, 2]
+
+
+def test_only_changed_views_rewritten(results_folder):
+    journal = QueJournal(results_folder, fsync=False)
+    assert len(journal.write_views()) == 5  # not known to be current after load
+    assert journal.write_views() == []
+
+    journal.append(1, STATE_QUE, data=row(1))
+    assert journal.write_views() == []
+
+    journal.append(1, STATE_STARTED)
+    journal.append(1, STATE_RUNNING)
+    assert journal.write_views() == ["started", "running"]
+    assert pd.read_csv(get_running_file(results_folder))["command_id"].tolist() == [1]
+
+    # Job leaves the running view
+    journal.append(1, STATE_FINISHED)
+    assert journal.write_views() == ["running", "finished"]
+    assert len(pd.read_csv(get_running_file(results_folder))) == 0
+    assert pd.read_csv(get_finished_file(results_folder))["command_id"].tolist() == [1]
+    assert not any(name.endswith(".tmp") for name in os.listdir(results_folder))
@@ -0,0 +1,79 @@
+import os
+import sys
+import subprocess
+
+import pytest
+
+from remote_que.locking import QueLock, QueLockTimeout, que_lock
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+@pytest.fixture
+def other_process(tmp_path):
+    """ Start a process holding a lock: other_process(lock_file, exclusive) """
+    processes = []
+
+    def start(lock_file: str, exclusive: bool = True) -> subprocess.Popen:
+        code = f"from remote_que.locking import QueLock\n" \
+               f"with QueLock({lock_file!r}, exclusive={exclusive}):\n" \
+               f"    print('locked', flush=True)\n" \
+               f"    input()\n"
+        process = subprocess.Popen([sys.executable, "-c", code], cwd=ROOT,
+                                   stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        assert process.stdout.readline().strip() == b"locked"
+        processes.append(process)
+        return process
+
+    yield start
+    for process in processes:
+        process.kill()
+        process.wait()
+
+
+def test_exclusive_owner_reported(tmp_path, other_process):
+    lock_file = str(tmp_path / "lock")
+    process = other_process(lock_file)
+
+    lock = QueLock(lock_file, timeout=0.1)
+    with pytest.raises(QueLockTimeout) as error:
+        lock.acquire()
+    assert error.value.owner_pid == process.pid
+    assert lock.is_held_by_other() and not lock.locked
+
+    # Released by the kernel when the owner dies
+    process.kill()
+    process.wait()
+    with QueLock(lock_file, timeout=1):
+        pass
+
+
+def test_shared_readers(tmp_path, other_process):
+    lock_file = str(tmp_path / "lock")
+    other_process(lock_file, exclusive=False)
+
+    with QueLock(lock_file, exclusive=False, timeout=0.1):
+        pass
+    with pytest.raises(QueLockTimeout):
+        QueLock(lock_file, timeout=0.1).acquire()
+
+
+def test_reentrant(results_folder):
+    with que_lock(results_folder) as outer:
+        with que_lock(results_folder, exclusive=False) as inner:
+            assert inner.locked
+        with que_lock(results_folder):
+            pass
+        assert outer.locked and not QueLock(outer.lock_file).is_held_by_other()
+    assert not outer.locked
+
+
+def test_no_shared_to_exclusive_upgrade(results_folder):
+    with que_lock(results_folder, exclusive=False):
+        with pytest.raises(RuntimeError):
+            que_lock(results_folder).acquire()
+
+    # Lock state is unchanged by the refused upgrade
+    with que_lock(results_folder, timeout=0):
+        pass
@@ -0,0 +1,83 @@
+import os
+import sys
+import time
+
+from remote_que import output
+from remote_que.output import OutputFile, OutputOptions, OutputTail
+from remote_que.run_process import SingleMachineSlot, START_PENDING, START_CONFIRMED
+
+
+def append(path, data):
+    with open(path, "ab") as f:
+        f.write(data)
+
+
+def test_tail_is_bounded(tmp_path):
+    path = str(tmp_path / "proc_1_out")
+    tail = OutputTail(path, no_lines=3)
+    assert tail.poll() == 0 and tail.tail() == []  # no file yet
+
+    append(path, b"".join(b"line %d\n" % i for i in range(10)) + b"part")
+    tail.poll()
+    assert tail.tail() == ["line 8", "line 9", "part"]
+    assert tail.tail(2) == ["line 9", "part"]
+
+    append(path, b"ial\n")
+    assert tail.poll() == 4
+    assert tail.tail() == ["line 8", "line 9", "partial"]
+    tail.close()
+
+
+def test_watch_pattern_split_between_reads(tmp_path, monkeypatch):
+    monkeypatch.setattr(output, "TAIL_BLOCK", 4)
+    path = str(tmp_path / "proc_1_out")
+    tail = OutputTail(path, watch="model loaded")
+
+    append(path, b"loading... model lo")
+    tail.poll()
+    assert not tail.seen
+
+    append(path, b"aded\n")
+    tail.poll()
+    assert tail.seen
+    tail.close()
+
+
+def test_only_end_of_large_output_read(tmp_path, monkeypatch):
+    monkeypatch.setattr(output, "TAIL_MAX_READ", 64)
+    path = str(tmp_path / "proc_1_out")
+    append(path, b"x" * 1000 + b"\nlast\n")
+
+    tail = OutputTail(path)
+    assert tail.poll() == 64
+    assert tail.tail(1) == ["last"]
+    tail.close()
+
+
+def test_rotation_keeps_tail(tmp_path):
+    path = str(tmp_path / "proc_1_out")
+    output_file = OutputFile(path, OutputOptions(max_bytes=10, compress="none", tail_lines=2))
+    append(path, b"first line\nsecond line\n")
+
+    assert output_file.rotate()
+    assert os.path.getsize(path) == 0
+    assert output_file.tail.tail() == ["first line", "second line"]
+
+    append(path, b"third\n")
+    output_file.rotate()
+    assert output_file.tail.tail() == ["second line", "third"]
+    output_file.tail.close()
+
+
+def test_start_confirmed_from_tail(tmp_path):
+    slot = SingleMachineSlot(["0"], str(tmp_path), log_start_confirm="ready",
+                             wait_time_start=0, output=OutputOptions(compress="none"))
+    command = f"{sys.executable} -c \"import time; print('ready'); time.sleep(5)\""
+    slot.start_command(1, command, None)
+
+    deadline = time.time() + 5
+    while slot.check_start() == START_PENDING and time.time() < deadline:
+        time.sleep(0.05)
+    assert slot.start_state == START_CONFIRMED
+    assert slot.tail() == ["ready"]
+    slot.kill()
@@ -0,0 +1,159 @@
+import numpy as np
+import pytest
+
+from remote_que.config import PACKING_STRATEGIES
+from remote_que.placement import GpuState, place_que, plan_pass, plan_preemption
+from remote_que.telemetry import FakeBackend, GpuTelemetry
+
+
+MACHINES = ["node0", "node1"]
+
+
+def gpu_state(no_gpus: int = 4, procs=(), machines=MACHINES, **kwargs) -> GpuState:
+    """ Fake GPUs - procs <(machine, GPU index, used memory)> """
+    backend = FakeBackend(no_gpus=no_gpus, mem_total=12000, **kwargs)
+    for pid, (machine, gpu, used_memory) in enumerate(procs):
+        backend.add_proc(machine, gpu, pid=pid, used_memory=used_memory)
+    return GpuState.from_snapshot(GpuTelemetry(backend, machines).snapshot())
+
+
+def test_place_que_one_proc_per_gpu():
+    state = gpu_state()
+    que = [(i, {"no_gpus": 1, "max_procs_on_gpu": 1}) for i in range(10)]
+    placed = place_que(state, que, rng=np.random.RandomState(0))
+
+    assert [p.que_idx for p in placed] == list(range(8))
+    gpus = [(p.machine, g) for p in placed for g in p.gpus]
+    assert len(set(gpus)) == 8
+
+
+def test_multi_gpu_request_on_one_machine():
+    state = gpu_state(procs=[("node0", 0, 1000)] * 2)
+    que = [(0, {"no_gpus": 4, "max_procs_on_gpu": 1})]
+    placed = place_que(state, que, rng=np.random.RandomState(0))
+
+    assert len(placed) == 1
+    assert placed[0].machine == "node1" and sorted(placed[0].gpus) == ["0", "1", "2", "3"]
+
+
+def test_max_procs_on_gpu():
+    # GPUs with up to max_procs_on_gpu procs already running are used
+    state = gpu_state(procs=[("node0", 0, 1000), ("node0", 1, 1000), ("node0", 1, 1000)],
+                      machines=["node0"])
+    mask = state.gpu_mask(dict({"preferred_gpu": -1, "max_procs_on_gpu": 1,
+                                "min_free_mem": -1, "max_gpu_util": -1,
+                                "max_mem_bw_util": -1}))
+    assert mask.tolist() == [True, False, True, True]
+
+
+def test_filters():
+    state = gpu_state(procs=[("node0", 0, 11000), ("node1", 0, 1000)])
+    placed = place_que(state, [(0, {"preferred_gpu": 0, "min_free_mem": 5000})])
+    assert [(p.machine, p.gpus) for p in placed] == [("node1", ["0"])]
+
+    # Nothing fits -> not placed (later requests still are)
+    state = gpu_state()
+    placed = place_que(state, [(0, {"no_gpus": 5}), (1, {"no_gpus": 1})])
+    assert [p.que_idx for p in placed] == [1]
+
+
+def test_cpu_only_request():
+    state = gpu_state()
+    placed = place_que(state, [(0, {"no_gpus": 0})])
+    assert len(placed) == 1 and placed[0].gpus == [] and placed[0].machine in MACHINES
+
+
+@pytest.mark.parametrize("strategy", PACKING_STRATEGIES)
+def test_packing_with_known_memory(strategy):
+    # Jobs with known memory share GPUs while memory fits
+    state = gpu_state(no_gpus=1)
+    que = [(i, {"no_gpus": 1}) for i in range(6)]
+    placed = place_que(state, que, rng=np.random.RandomState(0), memories=lambda i: 5000.,
+                       strategy=strategy)
+
+    assert len(placed) == 4
+    assert sorted(state.used_mem) == [10000, 10000]
+
+
+def test_best_fit_prefers_fullest_gpu():
+    state = gpu_state(procs=[("node0", 2, 8000)])
+    placed = place_que(state, [(0, {"no_gpus": 1})], memories=lambda i: 2000.,
+                       strategy="best-fit")
+    assert (placed[0].machine, placed[0].gpus) == ("node0", ["2"])
+
+
+def test_topology_prefers_linked_gpus():
+    # GPU pairs 0-1 & 2-3 are linked - one GPU of each pair is in use
+    state = gpu_state(procs=[("node0", 0, 1000), ("node0", 2, 1000)], machines=["node0"],
+                      nvlink_pairs=True)
+    placed = place_que(state, [(0, {"no_gpus": 2})], memories=lambda i: 1000.,
+                       strategy="spread")
+    assert sorted(placed[0].gpus) in (["0", "1"], ["2", "3"])
+
+
+def test_easy_backfill():
+    # GPUs busy until t=100, except GPU 3. A 2 GPU job reserves GPU 3 & one freed at t=100,
+    # a short job is backfilled on GPU 3, a long one is not
+    state = gpu_state(procs=[("node0", g, 1000) for g in range(3)] * 2, machines=["node0"])
+    releases = {("node0", str(g)): [100., 200.] for g in range(3)}
+    runtimes = {0: 500., 1: 500., 2: 50.}
+    que = [(i, {"no_gpus": 2 if i == 0 else 1, "max_procs_on_gpu": 1}) for i in range(3)]
+
+    placed = plan_pass(state, que, estimate=lambda i, metric: runtimes[i]
+                       if metric == "runtime" else None, backfill="easy", releases=releases,
+                       now=0., rng=np.random.RandomState(0))
+
+    assert [(p.que_idx, p.gpus) for p in placed] == [(2, ["3"])]
+
+
+def test_no_backfill_no_reservation():
+    state = gpu_state(procs=[("node0", g, 1000) for g in range(3)] * 2, machines=["node0"])
+    que = [(i, {"no_gpus": 2 if i == 0 else 1, "max_procs_on_gpu": 1}) for i in range(3)]
+    placed = plan_pass(state, que, estimate=lambda i, metric: 500. if metric == "runtime"
+                       else None, backfill="none", now=0.)
+    assert [(p.que_idx, p.gpus) for p in placed] == [(1, ["3"])]
+
+
+def test_user_gpu_caps():
+    state = gpu_state()
+    que = [(i, {"no_gpus": 2}) for i in range(4)]
+    placed = place_que(state, que, users=lambda i: "alice" if i < 3 else "bob",
+                       gpu_caps=lambda user: 4 if user == "alice" else None,
+                       user_gpus={"alice": 2})
+    assert [p.que_idx for p in placed] == [0, 3]
+
+
+def test_utilization_limits():
+    state = gpu_state(procs=[("node0", 0, 1000), ("node0", 1, 1000)])
+    state.track_utilization({("node0", "0"): (90., 10.), ("node0", "1"): (10., 10.)})
+    mask = state.gpu_mask(dict({"preferred_gpu": -1, "max_procs_on_gpu": -1,
+                                "min_free_mem": -1, "max_gpu_util": 50,
+                                "max_mem_bw_util": -1}))
+
+    # Busy GPU over the limit is excluded, unknown utilization only on GPUs without procs
+    assert mask.tolist() == [False, True, True, True, True, True, True, True]
+
+
+def test_preemption_fewest_victims():
+    # Each GPU runs one que proc (victim) & another proc
+    state = gpu_state(procs=[("node0", g, 3000) for g in range(4)] * 2)
+    resource = {"no_gpus": 2, "max_procs_on_gpu": 1}
+    victims = [("a", "node0", ["0"], 3000.), ("b", "node0", ["1", "2"], 3000.),
+               ("c", "node0", ["3"], 3000.)]
+    state.track_procs({("node1", str(g)): 2 for g in range(4)})
+
+    keys, placement = plan_preemption(state, 0, resource, victims)
+    assert keys == ["a", "b"] and placement is None
+
+    keys, placement = plan_preemption(state, 0, resource, victims, place=True,
+                                      rng=np.random.RandomState(0))
+    assert keys == ["a", "b"]
+    assert placement.machine == "node0" and len(placement.gpus) == 2
+    assert set(placement.gpus) <= {"0", "1", "2"}
+
+
+def test_suspended_victims_keep_memory():
+    state = gpu_state(no_gpus=1, procs=[("node0", 0, 11000), ("node1", 0, 11000)])
+    victims = [("a", "node0", ["0"], 0.)]
+    keys, _ = plan_preemption(state, 0, {"no_gpus": 1, "min_free_mem": 5000}, victims)
+    assert keys == []
@@ -0,0 +1,52 @@
+import pytest
+
+from remote_que.config import QUE_FILE_HEADER
+from remote_que.que_parser import QueFileReader, parse_que_line, parse_value
+
+
+def test_parse_value():
+    assert parse_value(" 3 ", int) == 3
+    assert parse_value("{'no_gpus': 2}", dict) == {"no_gpus": 2}
+    assert parse_value("python x.py", str) == "python x.py"
+    assert parse_value("3", dict) is None
+    assert parse_value("__import__('os')", int) is None
+
+
+def test_parse_que_line():
+    line = '2,"python t.py --a 1",{\'no_gpus\': 2},alice,17\n'
+    assert parse_que_line(line) == [2, "python t.py --a 1", {"no_gpus": 2}, "alice", 17]
+    assert parse_que_line("2,python t.py,{},alice\n") is None
+    assert parse_que_line("x,python t.py,{},alice,0\n") is None
+
+
+def write(path, lines):
+    with open(path, "w") as f:
+        f.write("\n".join([QUE_FILE_HEADER] + lines) + "\n")
+
+
+def test_reader_reports_invalid_lines_once(tmp_path):
+    que_file = str(tmp_path / "que.csv")
+    write(que_file, ["1,a,{},u,1", "bad line", "2,b,{},u,2"])
+    reader = QueFileReader(que_file)
+
+    que_data, invalid = reader.read()
+    assert que_data["command_id"].tolist() == [1, 2]
+    assert invalid == ["bad line\n"]
+
+    # Unchanged file - not parsed again
+    que_data, invalid = reader.read()
+    assert len(que_data) == 2 and invalid == []
+
+    # New lines are parsed, known invalid lines are not reported again
+    write(que_file, ["1,a,{},u,1", "bad line", "2,b,{},u,2", "3,c,{},u,3", "other bad"])
+    que_data, invalid = reader.read()
+    assert que_data["command_id"].tolist() == [1, 2, 3]
+    assert invalid == ["other bad\n"]
+
+
+def test_reader_corrupt_header(tmp_path):
+    que_file = str(tmp_path / "que.csv")
+    with open(que_file, "w") as f:
+        f.write("que_priority,shell_command\n")
+    with pytest.raises(ValueError):
+        QueFileReader(que_file).read()
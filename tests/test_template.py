@@ -0,0 +1,62 @@
+import pandas as pd
+import pytest
+
+from remote_que.template import TemplateError, count_expansions, expand_command
+from remote_que.template import expand_jobs, expand_que_data, parse_placeholder
+
+
+def test_no_template():
+    assert list(expand_command("python train.py --lr 0.1")) == ["python train.py --lr 0.1"]
+    assert count_expansions("python train.py") == 1
+
+
+def test_product():
+    commands = list(expand_command("t.py --lr [{[0.1, 0.01]}] --seed [{range(3)}]"))
+    assert len(commands) == count_expansions("t.py --lr [{[0.1, 0.01]}] --seed [{range(3)}]")
+    assert commands[:3] == ["t.py --lr 0.1 --seed 0", "t.py --lr 0.1 --seed 1",
+                            "t.py --lr 0.1 --seed 2"]
+    assert commands[-1] == "t.py --lr 0.01 --seed 2"
+
+
+def test_zipped_groups():
+    command = "t.py --lr [{a:[0.1, 0.01]}] --bs [{a:[32, 64]}] --seed [{[1, 2]}]"
+    assert count_expansions(command) == 4
+    assert list(expand_command(command))[:2] == ["t.py --lr 0.1 --bs 32 --seed 1",
+                                                 "t.py --lr 0.1 --bs 32 --seed 2"]
+
+    with pytest.raises(TemplateError):
+        list(expand_command("t.py [{a:[1, 2]}] [{a:[1, 2, 3]}]"))
+
+
+def test_placeholder_values():
+    assert parse_placeholder("[1, -2, 'x']") == (None, [1, -2, "x"])
+    assert parse_placeholder("g: [range(2), 5]") == ("g", [0, 1, 5])
+    assert parse_placeholder("7") == (None, [7])
+
+
+@pytest.mark.parametrize("expression", ["__import__('os')", "1 + 2", "range(x)", "[a]",
+                                        "range(1, 2, 3, 4)", "[1"])
+def test_only_literals(expression):
+    with pytest.raises(TemplateError):
+        parse_placeholder(expression)
+
+
+def test_max_expansions():
+    # Rejected before anything is expanded (range is lazy)
+    with pytest.raises(TemplateError):
+        next(expand_command("t.py [{range(1000000)}] [{range(1000000)}]"))
+    with pytest.raises(TemplateError):
+        list(expand_jobs([dict(shell_command="t.py [{range(5)}]")], max_expansions=4))
+    assert len(list(expand_jobs([dict(shell_command="t.py [{range(4)}]")],
+                                max_expansions=4))) == 4
+
+
+def test_expand_que_data():
+    columns = ["que_priority", "shell_command", "preferred_resource", "user", "command_id"]
+    que_data = pd.DataFrame([[1, "a [{[1, 2]}]", {}, "u", 0], [2, "b", {}, "u", 7]],
+                            columns=columns)
+    expanded = expand_que_data(que_data)
+
+    assert expanded["shell_command"].tolist() == ["a 1", "a 2", "b"]
+    assert expanded["command_id"].tolist() == [0, 0, 7]
+    assert expanded["que_priority"].tolist() == [1, 1, 2]